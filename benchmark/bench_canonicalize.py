@@ -0,0 +1,87 @@
+# Peak memory and time of canonicalizing a large result: fetchall + sort vs. streaming into a bounded heap
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'scoring_program'))
+from scoring_utils import execute_sql, canonicalize_rows, process_item
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", default=None, type=str, help="path to mimic_iv.sqlite (a synthetic chartevents table is generated if omitted)")
+    parser.add_argument("--table", default="chartevents", type=str, help="table to select from")
+    parser.add_argument("--num_rows", default=1000000, type=int, help="number of rows of the synthetic table")
+    args = parser.parse_args()
+    return args
+
+
+def build_synthetic_db(db_path, num_rows):
+    con = sqlite3.connect(db_path)
+    with open(os.path.join(REPO_DIR, "data/mimic_iv/mimic_iv.sql")) as f:
+        con.executescript(f.read())
+    rng = random.Random(0)
+    rows = (
+        (i, rng.randint(10000000, 10000100), rng.randint(20000000, 20000300), rng.randint(30000000, 30000300), rng.choice([220045, 220210, 220277]),
+         "2100-%02d-%02d %02d:%02d:00" % (rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59)), rng.uniform(0, 200), "bpm")
+        for i in range(num_rows)
+    )
+    con.executemany("INSERT INTO chartevents VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    con.commit()
+    con.close()
+
+
+def canonicalize_fetchall(sql, db_path):
+    rows = execute_sql(sql, db_path)
+    return str(sorted([[process_item(c) for c in row] for row in rows])[:100])
+
+
+def canonicalize_streaming(sql, db_path):
+    return execute_sql(sql, db_path, consume=canonicalize_rows)
+
+
+def measure(fn, sql, db_path):
+    start_time = time.time()
+    result = fn(sql, db_path)
+    elapsed = time.time() - start_time
+
+    tracemalloc.start()
+    fn(sql, db_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = args.db_path
+        if db_path is None:
+            db_path = os.path.join(tmp_dir, "synthetic.sqlite")
+            build_synthetic_db(db_path, args.num_rows)
+
+        sql = f"SELECT * FROM {args.table}"
+        result_fetchall, secs_fetchall, peak_fetchall = measure(canonicalize_fetchall, sql, db_path)
+        result_streaming, secs_streaming, peak_streaming = measure(canonicalize_streaming, sql, db_path)
+        assert result_fetchall == result_streaming, "canonical results differ"
+
+        report = {
+            "sql": sql,
+            "fetchall_secs": secs_fetchall,
+            "fetchall_peak_mb": peak_fetchall / 2**20,
+            "streaming_secs": secs_streaming,
+            "streaming_peak_mb": peak_streaming / 2**20,
+        }
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
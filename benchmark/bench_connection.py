@@ -0,0 +1,63 @@
+# Per-query sqlite3.connect vs. one persistent read-only connection per worker
+
+import os
+import sys
+import json
+import time
+import argparse
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'scoring_program'))
+from scoring_utils import execute_sql_wrapper, execute_all, close_worker, CACHE_SIZE, MMAP_SIZE
+from postprocessing import post_process_sql
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", required=True, type=str, help="path to mimic_iv.sqlite")
+    parser.add_argument("--label_path", default=os.path.join(REPO_DIR, "data/mimic_iv/valid/label.json"), type=str, help="gold queries to execute")
+    parser.add_argument("--repeat", default=3, type=int, help="number of timed runs per mode")
+    parser.add_argument("--cache_size", default=CACHE_SIZE, type=int, help="PRAGMA cache_size of the persistent connection")
+    parser.add_argument("--mmap_size", default=MMAP_SIZE, type=int, help="PRAGMA mmap_size of the persistent connection")
+    args = parser.parse_args()
+    return args
+
+
+def run_per_query(sql_dict, db_path):
+    close_worker()  # no worker connection: execute_sql opens and closes one per query
+    return {key: execute_sql_wrapper(key, sql_dict[key], db_path, tag='real')[-1] for key in sql_dict}
+
+
+def run_persistent(sql_dict, db_path, cache_size, mmap_size):
+    return execute_all(sql_dict, db_path, tag='real', cache_size=cache_size, mmap_size=mmap_size)
+
+
+def main(args):
+    with open(args.label_path) as f:
+        sql_dict = {id_: post_process_sql(sql) for id_, sql in json.load(f).items()}
+
+    timings = {'per_query': [], 'persistent': []}
+    results = {}
+    for _ in range(args.repeat):
+        start_time = time.time()
+        results['per_query'] = run_per_query(sql_dict, args.db_path)
+        timings['per_query'].append(time.time() - start_time)
+
+        start_time = time.time()
+        results['persistent'] = run_persistent(sql_dict, args.db_path, args.cache_size, args.mmap_size)
+        timings['persistent'].append(time.time() - start_time)
+
+    assert results['per_query'] == results['persistent'], "results differ between connection modes"
+
+    report = {
+        'num_queries': len(sql_dict),
+        'per_query_secs': min(timings['per_query']),
+        'persistent_secs': min(timings['persistent']),
+    }
+    report['speedup'] = report['per_query_secs'] / report['persistent_secs']
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
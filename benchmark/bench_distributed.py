@@ -0,0 +1,102 @@
+# Joint executor (scheduler.execute_joint, the path scoring.py uses): one apply_async per query (the previous
+# run_tasks) vs. guided chunks sized by expected runtime over imap_unordered
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing as mp
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'scoring_program'))
+import scheduler
+from scheduler import execute_joint, run_chunk
+from worker_sizing import worker_count, usable_cpus, usable_memory, cgroup_cpu_quota
+from postprocessing import post_process_batch
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", required=True, type=str, help="path to mimic_iv.sqlite")
+    parser.add_argument("--data_dir", default=os.path.join(REPO_DIR, "data/mimic_iv"), type=str, help="directory with {split}/label.json")
+    parser.add_argument("--splits", default=["train", "valid", "test"], nargs="+", type=str, help="splits to execute")
+    parser.add_argument("--num_workers", default=[0, 1, 2, 4], nargs="+", type=int, help="worker counts to sweep (0: sized by worker_count())")
+    parser.add_argument("--repeat", default=3, type=int, help="number of timed runs per setting")
+    parser.add_argument("--output", default="bench_distributed.json", type=str, help="where to write the results")
+    args = parser.parse_args()
+    return args
+
+
+def per_task_run_tasks(pool, tasks, kwds, callback, cache_stats, num_workers=1, weights=None):
+    # run_tasks before chunking: one apply_async and one callback per task
+    def collect(result):
+        outcomes, pid, stats = result
+        if stats is not None:
+            cache_stats[pid] = stats
+        for outcome in outcomes:
+            callback(outcome)
+    if pool is None:
+        collect(run_chunk(tasks, kwds))
+        return
+    pending = [pool.apply_async(run_chunk, args=([task], kwds), callback=collect) for task in tasks]
+    for result in pending:
+        result.wait()
+
+
+def run_joint(sql_dict, db_path, num_workers, chunked):
+    chunked_run_tasks = scheduler.run_tasks
+    if not chunked:
+        scheduler.run_tasks = per_task_run_tasks
+    try:
+        start_time = time.time()
+        real_result, _ = execute_joint(sql_dict, {}, db_path, num_workers=num_workers)
+        return real_result, time.time() - start_time
+    finally:
+        scheduler.run_tasks = chunked_run_tasks
+
+
+def main(args):
+    report = {
+        'cpu_count': mp.cpu_count(),
+        'usable_cpus': usable_cpus(),
+        'cgroup_cpu_quota': cgroup_cpu_quota(),
+        'usable_memory': usable_memory(),
+        'worker_count': worker_count(),
+        'runs': [],
+    }
+    print(f"cpu_count={report['cpu_count']} usable_cpus={report['usable_cpus']} worker_count={report['worker_count']}")
+    for split in args.splits:
+        with open(os.path.join(args.data_dir, split, 'label.json')) as f:
+            sql_dict = post_process_batch(json.load(f))
+        for num_workers in args.num_workers:
+            workers = num_workers or worker_count()
+            timings = {'per_query': [], 'chunked': []}
+            results = {}
+            for _ in range(args.repeat):
+                results['per_query'], secs = run_joint(sql_dict, args.db_path, workers, chunked=False)
+                timings['per_query'].append(secs)
+                results['chunked'], secs = run_joint(sql_dict, args.db_path, workers, chunked=True)
+                timings['chunked'].append(secs)
+            assert results['per_query'] == results['chunked'], "results differ between the executors"
+
+            run = {
+                'split': split,
+                'num_queries': len(sql_dict),
+                'num_workers': workers,
+                'auto_sized': num_workers == 0,
+                'per_query_secs': min(timings['per_query']),
+                'chunked_secs': min(timings['chunked']),
+            }
+            run['speedup'] = run['per_query_secs'] / run['chunked_secs']
+            report['runs'].append(run)
+            print(f"{split} ({len(sql_dict)} queries), {workers} workers: per query {run['per_query_secs']:.2f} secs, chunked {run['chunked_secs']:.2f} secs ({run['speedup']:.2f}x)")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
@@ -0,0 +1,73 @@
+# Lowercase/strip normalization of read_csv(lower=True): the previous applymap over every cell vs. normalize_strings
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import pandas as pd
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'preprocess'))
+from preprocess_utils import normalize_strings
+from synthetic_mimic_iv import SyntheticMIMICIV
+
+TABLES = ["icu/chartevents.csv", "hosp/labevents.csv", "hosp/prescriptions.csv", "hosp/transfers.csv"]
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_events", default=1000000, type=int, help="event rows of the synthetic data")
+    parser.add_argument("--tables", default=TABLES, nargs="+", type=str, help="raw tables to normalize")
+    parser.add_argument("--repeat", default=3, type=int, help="number of timed runs per method")
+    parser.add_argument("--work_dir", default=None, type=str, help="where the synthetic data is written (a temporary directory if omitted)")
+    parser.add_argument("--output", default="bench_normalize.json", type=str, help="where to write the results")
+    args = parser.parse_args()
+    return args
+
+
+def applymap_normalize(df):
+    # read_csv(lower=True) before normalize_strings
+    return df.applymap(lambda x: x.lower().strip() if pd.notnull(x) and type(x) == str else x)
+
+
+def main(args):
+    report = {"num_events": args.num_events, "tables": []}
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        with contextlib.redirect_stdout(io.StringIO()):
+            SyntheticMIMICIV(work_dir, max(200, args.num_events // 1000), args.num_events).generate()
+        for table in args.tables:
+            df = pd.read_csv(os.path.join(work_dir, table))
+            timings = {"applymap": [], "normalize_strings": []}
+            for _ in range(args.repeat):
+                start_time = time.time()
+                expected = applymap_normalize(df)
+                timings["applymap"].append(time.time() - start_time)
+
+                start_time = time.time()
+                normalized = normalize_strings(df)
+                timings["normalize_strings"].append(time.time() - start_time)
+            assert normalized.equals(expected) and normalized.dtypes.equals(expected.dtypes), f"normalization differs: {table}"
+
+            result = {
+                "table": table,
+                "num_rows": len(df),
+                "object_columns": {col: int(df[col].nunique()) for col in df.columns[df.dtypes == object]},
+                "applymap_secs": min(timings["applymap"]),
+                "normalize_strings_secs": min(timings["normalize_strings"]),
+            }
+            result["speedup"] = result["applymap_secs"] / result["normalize_strings_secs"]
+            report["tables"].append(result)
+            print(f"{table} ({len(df)} rows): applymap {result['applymap_secs']:.3f} secs, normalize_strings {result['normalize_strings_secs']:.3f} secs ({result['speedup']:.1f}x)")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
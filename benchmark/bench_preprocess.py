@@ -0,0 +1,118 @@
+# Time of each Build_MIMIC_IV stage and generate_db on synthetic raw MIMIC-IV at several scales
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import contextlib
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'preprocess'))
+from preprocess_db_mimic_iv import Build_MIMIC_IV
+from synthetic_mimic_iv import SyntheticMIMICIV
+
+STAGES = [
+    "build_admission_table",
+    "build_dictionary_table",
+    "build_diagnosis_table",
+    "build_procedure_table",
+    "build_labevent_table",
+    "build_prescriptions_table",
+    "build_cost_table",
+    "build_chartevent_table",
+    "build_inputevent_table",
+    "build_outputevent_table",
+    "build_microbiology_table",
+    "generate_db",
+]
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_events", default=[1000, 100000, 1000000], nargs="+", type=int, help="event rows of the synthetic data, one run per value")
+    parser.add_argument("--events_per_patient", default=1000, type=int, help="raw patients = num_events / events_per_patient (at least 200)")
+    parser.add_argument("--num_patient", default=100, type=int, help="patients sampled by Build_MIMIC_IV (as in preprocess.sh)")
+    parser.add_argument("--gzip", action="store_true", help="read .csv.gz files")
+    parser.add_argument("--direct_load", action="store_true", help="insert each table into the database as it is built")
+    parser.add_argument("--skip_csv", action="store_true", help="do not write the CSV files (with --direct_load)")
+    parser.add_argument("--work_dir", default=None, type=str, help="where the synthetic data and the database are written (a temporary directory if omitted)")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the preprocessing")
+    parser.add_argument("--output", default="bench_preprocess.json", type=str, help="where to write the results")
+    args = parser.parse_args()
+    return args
+
+
+def run(work_dir, num_events, args):
+    data_dir = os.path.join(work_dir, "raw")
+    out_dir = os.path.join(work_dir, "out")
+    os.makedirs(os.path.join(out_dir, "mimic_iv"), exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, "data/mimic_iv/mimic_iv.sql"), os.path.join(out_dir, "mimic_iv"))
+
+    num_patients = max(200, num_events // args.events_per_patient)
+    start_time = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        raw_rows = SyntheticMIMICIV(data_dir, num_patients, num_events, gzip=args.gzip).generate()
+    generate_secs = time.time() - start_time
+
+    stdout = sys.stdout if args.verbose else io.StringIO()
+    stages = {}
+    with contextlib.redirect_stdout(stdout):
+        mimic_writer = Build_MIMIC_IV(
+            data_dir=data_dir,
+            out_dir=out_dir,
+            db_name="mimic_iv",
+            num_patient=args.num_patient,
+            sample_icu_patient_only=False,
+            timeshift=True,
+            start_year=2100,
+            time_span=0,
+            cur_patient_ratio=0.1,
+            current_time="2100-12-31 23:59:00",
+            direct_load=args.direct_load,
+            write_csv=not args.skip_csv,
+        )
+        for stage in STAGES:
+            start_time = time.time()
+            getattr(mimic_writer, stage)()
+            stages[stage] = time.time() - start_time
+        mimic_writer.conn.close()
+
+    conn = sqlite3.connect(os.path.join(out_dir, "mimic_iv", "mimic_iv.sqlite"))
+    db_rows = {}
+    for table in ["chartevents", "labevents", "prescriptions", "inputevents", "outputevents", "microbiologyevents", "cost"]:
+        db_rows[table] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    conn.close()
+    return {
+        "num_events": num_events,
+        "num_raw_patients": num_patients,
+        "raw_rows": raw_rows,
+        "db_rows": db_rows,
+        "synthetic_data_secs": generate_secs,
+        "stages": stages,
+        "total_secs": sum(stages.values()),
+    }
+
+
+def main(args):
+    report = {"gzip": args.gzip, "direct_load": args.direct_load, "skip_csv": args.skip_csv, "num_patient": args.num_patient, "runs": []}
+    for num_events in args.num_events:
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+            result = run(work_dir, num_events, args)
+        report["runs"].append(result)
+        print(f"{num_events} event rows: {result['total_secs']:.2f} secs")
+        for stage, secs in result["stages"].items():
+            print(f"  {stage}: {secs:.3f} secs")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
@@ -0,0 +1,178 @@
+# End-to-end scoring benchmark over the shipped splits, with a per-stage time breakdown
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import platform
+import argparse
+import subprocess
+import tempfile
+import multiprocessing as mp
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCORING_DIR = os.path.join(REPO_DIR, 'scoring_program')
+sys.path.insert(0, SCORING_DIR)
+from scoring_utils import execute_all, execute_all_distributed, execute_sql, canonicalize_rows, process_answer, reliability_score, penalize
+from postprocessing import post_process_batch
+from scheduler import execute_joint
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", required=True, type=str, help="locally built mimic_iv.sqlite")
+    parser.add_argument("--data_dir", default=os.path.join(REPO_DIR, "data/mimic_iv"), type=str, help="directory with {split}/label.json and answer.json")
+    parser.add_argument("--splits", default=["valid", "test"], nargs="+", type=str, help="splits to score")
+    parser.add_argument("--executors", default=["serial", "distributed", "joint"], nargs="+", choices=["serial", "distributed", "joint", "batched"], help="executors to compare (batched: joint with template batching)")
+    parser.add_argument("--num_workers", default=[1, 2, 4], nargs="+", type=int, help="worker counts to sweep (distributed and joint executors)")
+    parser.add_argument("--prediction", default="perturbed", choices=["gold", "perturbed"], help="use the gold SQL as prediction or a deterministic mix of gold, null and other gold queries")
+    parser.add_argument("--cli", action="store_true", help="also time scoring.py and scoring_v2.py as subprocesses (needs scoring_program/mimic_iv.sqlite)")
+    parser.add_argument("--output", default="bench_scoring.json", type=str, help="where to write the results")
+    args = parser.parse_args()
+    return args
+
+
+def make_prediction(real_dict, mode, seed=0):
+    if mode == "gold":
+        return dict(real_dict)
+    rng = random.Random(seed)
+    values = list(real_dict.values())
+    pred_dict = {}
+    for key in real_dict:
+        r = rng.random()
+        pred_dict[key] = real_dict[key] if r < 0.6 else "null" if r < 0.75 else rng.choice(values)
+    return pred_dict
+
+
+def timed(stages, name, fn, *args, **kwargs):
+    start_time = time.time()
+    result = fn(*args, **kwargs)
+    stages[name] = stages.get(name, 0.0) + time.time() - start_time
+    return result
+
+
+def canonicalization_secs(sql_list, db_path):
+    # share of the execution stage spent canonicalizing: rows are fetched first, then canonicalized on their own
+    secs = 0.0
+    for sql in set(sql_list):
+        if sql == "null":
+            continue
+        try:
+            rows = execute_sql(sql, db_path)
+        except Exception:
+            continue
+        start_time = time.time()
+        canonicalize_rows(rows)
+        secs += time.time() - start_time
+    return secs
+
+
+def score(scores):
+    return {f"accuracy{name}": penalize(scores, penalty=penalty) * 100 for name, penalty in [("0", 0), ("5", 5), ("10", 10), ("N", len(scores))]}
+
+
+def bench_scoring(label_path, pred_mode, db_path, executor, num_workers):
+    stages = {}
+    with open(label_path) as f:
+        real_dict = timed(stages, "load", json.load, f)
+    pred_dict = make_prediction(real_dict, pred_mode)
+
+    real_dict = timed(stages, "post_process_sql", post_process_batch, real_dict)
+    pred_dict = timed(stages, "post_process_sql", post_process_batch, pred_dict)
+
+    if executor == "serial":
+        real_result = timed(stages, "execute", execute_all, real_dict, db_path, tag="real")
+        pred_result = timed(stages, "execute", execute_all, pred_dict, db_path, tag="pred")
+    elif executor == "distributed":
+        real_result = timed(stages, "execute", execute_all_distributed, real_dict, db_path, tag="real", num_workers=num_workers)
+        pred_result = timed(stages, "execute", execute_all_distributed, pred_dict, db_path, tag="pred", num_workers=num_workers)
+    else:
+        real_result, pred_result = timed(stages, "execute", execute_joint, real_dict, pred_dict, db_path, num_workers=num_workers, batch_templates=executor == "batched")
+
+    scores = timed(stages, "reliability_score", reliability_score, real_result, pred_result)
+    scores_dict = timed(stages, "reliability_score", score, scores)
+    stages["canonicalize (part of execute)"] = canonicalization_secs(list(real_dict.values()) + list(pred_dict.values()), db_path)
+    return stages, scores_dict
+
+
+def bench_scoring_v2(answer_path, pred_mode):
+    stages = {}
+    with open(answer_path) as f:
+        real_dict = timed(stages, "load", json.load, f)
+    pred_dict = make_prediction(real_dict, pred_mode)
+
+    real_result = timed(stages, "canonicalize", lambda: {key: process_answer(real_dict[key]) for key in real_dict})
+    pred_result = timed(stages, "canonicalize", lambda: {key: process_answer(pred_dict[key]) for key in pred_dict})
+
+    scores = timed(stages, "reliability_score", reliability_score, real_result, pred_result)
+    scores_dict = timed(stages, "reliability_score", score, scores)
+    return stages, scores_dict
+
+
+def bench_cli(script, ref_file, ref_dict, pred_dict):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for sub_dir, file_name, content in [("ref", ref_file, ref_dict), ("res", "prediction.json", pred_dict)]:
+            os.makedirs(os.path.join(tmp_dir, "input", sub_dir))
+            with open(os.path.join(tmp_dir, "input", sub_dir, file_name), "w") as f:
+                json.dump(content, f)
+        start_time = time.time()
+        subprocess.run([sys.executable, os.path.join(SCORING_DIR, script), os.path.join(tmp_dir, "input"), tmp_dir], check=True, stdout=subprocess.DEVNULL)
+        return time.time() - start_time
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main(args):
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "cpu_count": mp.cpu_count(),
+        "prediction": args.prediction,
+        "runs": [],
+    }
+    for split in args.splits:
+        label_path = os.path.join(args.data_dir, split, "label.json")
+        answer_path = os.path.join(args.data_dir, split, "answer.json")
+
+        for executor in args.executors:
+            for num_workers in ([1] if executor == "serial" else args.num_workers):
+                stages, scores_dict = bench_scoring(label_path, args.prediction, args.db_path, executor, num_workers)
+                run = {"split": split, "script": "scoring.py", "executor": executor, "num_workers": num_workers, "stages": stages, "scores": scores_dict}
+                run["total_secs"] = sum(secs for name, secs in stages.items() if "part of" not in name)
+                report["runs"].append(run)
+                print(f"{split} scoring.py {executor} x{num_workers}: {run['total_secs']:.3f} secs {stages}")
+
+        if os.path.exists(answer_path):
+            stages, scores_dict = bench_scoring_v2(answer_path, args.prediction)
+            run = {"split": split, "script": "scoring_v2.py", "executor": None, "num_workers": 1, "stages": stages, "scores": scores_dict, "total_secs": sum(stages.values())}
+            report["runs"].append(run)
+            print(f"{split} scoring_v2.py: {run['total_secs']:.3f} secs {stages}")
+
+        if args.cli:
+            with open(label_path) as f:
+                real_dict = json.load(f)
+            cli_secs = bench_cli("scoring.py", "label.json", real_dict, make_prediction(real_dict, args.prediction))
+            report["runs"].append({"split": split, "script": "scoring.py (cli)", "total_secs": cli_secs})
+            if os.path.exists(answer_path):
+                with open(answer_path) as f:
+                    answer_dict = json.load(f)
+                cli_secs = bench_cli("scoring_v2.py", "answer.json", answer_dict, make_prediction(answer_dict, args.prediction))
+                report["runs"].append({"split": split, "script": "scoring_v2.py (cli)", "total_secs": cli_secs})
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
@@ -0,0 +1,90 @@
+# Memory per worker and total time: workers reading mimic_iv.sqlite vs. one shared in-memory copy loaded by the parent
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing as mp
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'scoring_program'))
+from scoring_utils import execute_sql, canonicalize_rows, init_worker, load_shared_db, release_shared_db, CACHE_SIZE, MMAP_SIZE
+from postprocessing import post_process_sql
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", required=True, type=str, help="path to mimic_iv.sqlite")
+    parser.add_argument("--label_path", default=os.path.join(REPO_DIR, "data/mimic_iv/valid/label.json"), type=str, help="queries to execute")
+    parser.add_argument("--num_workers", default=4, type=int, help="number of pool workers")
+    args = parser.parse_args()
+    return args
+
+
+def memory_status():
+    # RSS counts shared pages once per process; PSS splits them between the processes mapping them
+    status = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            if key in ("VmRSS", "RssAnon", "RssFile", "RssShmem"):
+                status[key] = int(value.split()[0])
+    if os.path.exists("/proc/self/smaps_rollup"):
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    status["Pss"] = int(line.split()[1])
+    return status
+
+
+def execute_and_probe(sql, db_path):
+    try:
+        execute_sql(sql, db_path, consume=canonicalize_rows)
+    except Exception:
+        pass
+    return os.getpid(), memory_status()
+
+
+def run(sql_list, db_path, num_workers, mmap_size):
+    start_time = time.time()
+    pool = mp.Pool(processes=num_workers, initializer=init_worker, initargs=(db_path, CACHE_SIZE, mmap_size))
+    probes = pool.starmap(execute_and_probe, [(sql, db_path) for sql in sql_list], chunksize=1)
+    pool.close()
+    pool.join()
+    elapsed = time.time() - start_time
+
+    last_probe = {pid: status for pid, status in probes}  # memory of each worker after its last query
+    return {
+        "total_secs": elapsed,
+        "workers": len(last_probe),
+        "rss_kb_per_worker": sum(status["VmRSS"] for status in last_probe.values()) / len(last_probe),
+        "pss_kb_per_worker": sum(status.get("Pss", 0) for status in last_probe.values()) / len(last_probe),
+        "shmem_kb_per_worker": sum(status.get("RssShmem", 0) for status in last_probe.values()) / len(last_probe),
+    }
+
+
+def main(args):
+    with open(args.label_path) as f:
+        sql_list = [post_process_sql(sql) for sql in json.load(f).values() if sql != "null"]
+
+    report = {"num_queries": len(sql_list), "num_workers": args.num_workers}
+    report["file"] = run(sql_list, args.db_path, args.num_workers, MMAP_SIZE)
+
+    start_time = time.time()
+    shared_path, mmap_size = load_shared_db(args.db_path)
+    load_secs = time.time() - start_time
+    if shared_path is None:
+        raise Exception("The database could not be copied to shared memory")
+    try:
+        report["shared_memory"] = run(sql_list, shared_path, args.num_workers, mmap_size)
+        report["shared_memory"]["load_secs"] = load_secs
+        report["shared_memory"]["total_secs"] += load_secs
+    finally:
+        release_shared_db(shared_path)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
@@ -0,0 +1,93 @@
+# Startup cost of the scoring entry points: import time of the old and new module sets, and a small
+# evaluation through the CLI (new process per run) vs. the in-process score() API
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCORING_DIR = os.path.join(REPO_DIR, 'scoring_program')
+
+IMPORTS = {
+    'python': 'pass',
+    # module-level imports of scoring.py before it became a wrapper of scorer.py
+    'legacy_scoring': 'import json, os, sys, sqlite3, numpy, pandas, multiprocessing; import scoring_utils, postprocessing, scheduler, profiling',
+    # module-level imports of scoring_v2.py before it became a wrapper of scorer.py
+    'legacy_scoring_v2': 'import json, os, sys, sqlite3, numpy, pandas, multiprocessing; import scoring_utils',
+    'scorer': 'import scorer',
+    'scoring': 'import scoring',
+    'scoring_v2': 'import scoring_v2',
+}
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", default=None, type=str, help="mimic_iv.sqlite; if given, also time a small evaluation end to end")
+    parser.add_argument("--label_path", default=os.path.join(REPO_DIR, "sample_data/train/label.json"), type=str, help="gold queries of the small evaluation (also used as prediction)")
+    parser.add_argument("--repeat", default=10, type=int, help="runs per measurement (the median is reported)")
+    parser.add_argument("--output", default="bench_startup.json", type=str, help="where to write the results")
+    args = parser.parse_args()
+    return args
+
+
+def time_process(command, repeat, cwd=SCORING_DIR):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.time() - start_time)
+    return statistics.median(timings)
+
+def time_in_process(label_path, db_path, repeat):
+    sys.path.insert(0, SCORING_DIR)
+    start_time = time.time()
+    from scorer import score
+    import_secs = time.time() - start_time
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        scores_dict = score(label_path, label_path, db_path, num_workers=1)
+        timings.append(time.time() - start_time)
+    return import_secs, statistics.median(timings), scores_dict
+
+
+def main(args):
+    report = {'imports': {}}
+    for name, statement in IMPORTS.items():
+        report['imports'][name] = time_process([sys.executable, '-c', statement], args.repeat)
+        print(f"{name}: {report['imports'][name]:.3f} secs")
+
+    if args.db_path is not None:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for sub_dir in ['input/ref', 'input/res', 'output', 'program']:
+                os.makedirs(os.path.join(work_dir, sub_dir))
+            shutil.copy(args.label_path, os.path.join(work_dir, 'input/ref/label.json'))
+            shutil.copy(args.label_path, os.path.join(work_dir, 'input/res/prediction.json'))
+            # a copy of the scoring program next to the database, as the CLI expects
+            for name in os.listdir(SCORING_DIR):
+                if name.endswith('.py'):
+                    shutil.copy(os.path.join(SCORING_DIR, name), os.path.join(work_dir, 'program'))
+            os.symlink(os.path.abspath(args.db_path), os.path.join(work_dir, 'program/mimic_iv.sqlite'))
+            command = [sys.executable, 'scoring.py', os.path.join(work_dir, 'input'), os.path.join(work_dir, 'output')]
+            report['cli_secs'] = time_process(command, args.repeat, cwd=os.path.join(work_dir, 'program'))
+            with open(os.path.join(work_dir, 'output/scores.json')) as f:
+                cli_scores = json.load(f)
+        report['api_import_secs'], report['api_secs'], api_scores = time_in_process(args.label_path, args.db_path, args.repeat)
+        assert cli_scores == api_scores, "scores differ between the CLI and score()"
+        print(f"scoring.py per evaluation: {report['cli_secs']:.3f} secs")
+        print(f"score() per evaluation: {report['api_secs']:.3f} secs (after a one-time import of {report['api_import_secs']:.3f} secs)")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
@@ -0,0 +1,76 @@
+# Inlined literals vs. literals bound as parameters with prepared statements reused per shape
+
+import os
+import sys
+import json
+import time
+import argparse
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'scoring_program'))
+from scoring_utils import execute_sql_wrapper, init_worker, close_worker, statement_cache_stats, STATEMENT_CACHE_SIZE
+from postprocessing import post_process_sql
+from sql_shape import parameterize
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", required=True, type=str, help="path to mimic_iv.sqlite")
+    parser.add_argument("--label_path", default=os.path.join(REPO_DIR, "data/mimic_iv/train/label.json"), type=str, help="gold queries to execute")
+    parser.add_argument("--cache_sizes", default=[16, 128, STATEMENT_CACHE_SIZE], nargs="+", type=int, help="statement cache sizes to sweep")
+    parser.add_argument("--repeat", default=3, type=int, help="number of timed runs per mode")
+    parser.add_argument("--output", default="bench_statement_cache.json", type=str, help="where to write the results")
+    args = parser.parse_args()
+    return args
+
+
+def run(sql_dict, db_path, parameterize_literals, cache_size):
+    init_worker(db_path, parameterize_literals=parameterize_literals, statement_cache_size=cache_size)
+    try:
+        start_time = time.time()
+        results = {key: execute_sql_wrapper(key, sql_dict[key], db_path, tag='real')[-1] for key in sql_dict}
+        secs = time.time() - start_time
+    finally:
+        close_worker()
+    return results, secs, statement_cache_stats()
+
+
+def main(args):
+    with open(args.label_path) as f:
+        sql_dict = {id_: post_process_sql(sql) for id_, sql in json.load(f).items()}
+    sqls = [sql for sql in sql_dict.values() if sql != 'null']
+
+    start_time = time.time()
+    shapes = [parameterize(sql)[0] for sql in sqls]
+    parameterize_secs = time.time() - start_time
+
+    report = {
+        'num_queries': len(sqls),
+        'distinct_sql': len(set(sqls)),
+        'distinct_shapes': len(set(shapes)),
+        'parameterize_secs': parameterize_secs,
+        'runs': [],
+    }
+    baseline = None
+    for parameterize_literals, cache_size in [(False, STATEMENT_CACHE_SIZE)] + [(True, size) for size in args.cache_sizes]:
+        timings = []
+        for _ in range(args.repeat):
+            results, secs, stats = run(sql_dict, args.db_path, parameterize_literals, cache_size)
+            timings.append(secs)
+        if baseline is None:
+            baseline = results
+        assert results == baseline, "results differ with parameterized literals"
+        run_report = {'parameterize_literals': parameterize_literals, 'cache_size': cache_size, 'secs': min(timings)}
+        if stats is not None:
+            run_report.update({'hits': stats['hits'], 'misses': stats['misses'], 'hit_rate': stats['hit_rate']})
+        report['runs'].append(run_report)
+        print(json.dumps(run_report))
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
@@ -0,0 +1,18 @@
+CREATE INDEX IF NOT EXISTS idx_prescriptions_hadm_id ON prescriptions (hadm_id);
+CREATE INDEX IF NOT EXISTS idx_diagnoses_icd_hadm_id ON diagnoses_icd (hadm_id);
+CREATE INDEX IF NOT EXISTS idx_d_items_label ON d_items (label);
+CREATE INDEX IF NOT EXISTS idx_d_icd_diagnoses_long_title ON d_icd_diagnoses (long_title);
+CREATE INDEX IF NOT EXISTS idx_d_labitems_label ON d_labitems (label);
+CREATE INDEX IF NOT EXISTS idx_labevents_hadm_id ON labevents (hadm_id);
+CREATE INDEX IF NOT EXISTS idx_d_icd_procedures_long_title ON d_icd_procedures (long_title);
+CREATE INDEX IF NOT EXISTS idx_procedures_icd_icd_code ON procedures_icd (icd_code);
+CREATE INDEX IF NOT EXISTS idx_chartevents_itemid ON chartevents (itemid);
+CREATE INDEX IF NOT EXISTS idx_microbiologyevents_hadm_id ON microbiologyevents (hadm_id);
+CREATE INDEX IF NOT EXISTS idx_inputevents_stay_id ON inputevents (stay_id);
+CREATE INDEX IF NOT EXISTS idx_prescriptions_drug ON prescriptions (drug);
+CREATE INDEX IF NOT EXISTS idx_diagnoses_icd_icd_code ON diagnoses_icd (icd_code);
+CREATE INDEX IF NOT EXISTS idx_procedures_icd_hadm_id ON procedures_icd (hadm_id);
+CREATE INDEX IF NOT EXISTS idx_cost_event_id ON cost (event_id);
+CREATE INDEX IF NOT EXISTS idx_admissions_age ON admissions (age);
+CREATE INDEX IF NOT EXISTS idx_transfers_careunit ON transfers (careunit);
+CREATE INDEX IF NOT EXISTS idx_labevents_itemid ON labevents (itemid);
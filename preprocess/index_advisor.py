@@ -0,0 +1,217 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scoring_program"))
+from postprocessing import post_process_sql
+from scoring_utils import connect_readonly, canonicalize_rows, fetch_within_budget
+
+
+FULL_SCAN_PATTERN = re.compile(r"^SCAN (\w+)$")  # "SCAN chartevents" (no index used)
+INDEX_USE_PATTERN = re.compile(r"USING (?:COVERING )?INDEX (\w+)")  # persistent index read by a plan step
+AUTOMATIC_INDEX_PATTERN = re.compile(r"^SEARCH (\w+) USING AUTOMATIC (?:PARTIAL )?(?:COVERING )?INDEX \((\w+)[=><]")  # index rebuilt for every execution
+PREDICATE_PATTERNS = [
+    re.compile(r"\b(\w+)\.(\w+)\s*(?:=|<>|!=|>=|<=|>|<|\bIN\b|\bBETWEEN\b)", re.IGNORECASE),  # table.col = ...
+    re.compile(r"(?:=|\bIN\b)\s*\(?\s*(\w+)\.(\w+)\b", re.IGNORECASE),  # ... = table.col (join condition)
+]
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", required=True, type=str, help="database built by preprocess_db.py")
+    parser.add_argument("--data_dir", default="../data/mimic_iv", type=str, help="directory with the {train,valid,test}/label.json workloads")
+    parser.add_argument("--splits", default=["train", "valid", "test"], nargs="+", type=str, help="workloads to analyze")
+    parser.add_argument("--min_queries", default=10, type=int, help="minimum number of full scans an index must remove")
+    parser.add_argument("--index_path", default="../data/mimic_iv/mimic_iv_index.sql", type=str, help="where to write the proposed CREATE INDEX statements")
+    parser.add_argument("--report_path", default=None, type=str, help="where to write the per-query speedup report (json)")
+    parser.add_argument("--repeat", default=3, type=int, help="timed executions per query (the fastest is reported)")
+    args = parser.parse_args()
+    return args
+
+
+def load_workload(data_dir, splits):
+    workload = {}
+    for split in splits:
+        with open(os.path.join(data_dir, split, "label.json")) as f:
+            label = json.load(f)
+        for id_, sql in label.items():
+            if sql != "null":
+                workload[id_] = post_process_sql(sql)
+    return workload
+
+
+def table_columns(con):
+    tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    return {table: {row[1] for row in con.execute(f"PRAGMA table_info({table})")} for table in tables}
+
+
+def query_plan(con, sql):
+    return [row[3] for row in con.execute("EXPLAIN QUERY PLAN " + sql).fetchall()]
+
+
+def unindexed_accesses(plan, columns):
+    # tables read without a persistent index: full scans and automatic (per-execution) indexes
+    tables, automatic_columns = set(), set()
+    for detail in plan:
+        match = FULL_SCAN_PATTERN.match(detail)
+        if match and match.group(1) in columns:
+            tables.add(match.group(1))
+        match = AUTOMATIC_INDEX_PATTERN.match(detail)
+        if match and match.group(1) in columns:
+            tables.add(match.group(1))
+            automatic_columns.add((match.group(1), match.group(2)))
+    return tables, automatic_columns
+
+
+def predicate_columns(sql, columns):
+    found = set()
+    for pattern in PREDICATE_PATTERNS:
+        for table, column in pattern.findall(sql):
+            table, column = table.lower(), column.lower()
+            if table in columns and column in columns[table] and column != "row_id":
+                found.add((table, column))
+    return found
+
+
+def propose_indexes(con, workload, min_queries):
+    # greedy set cover: every (query, table) accessed without an index needs one index on one of its predicate columns
+    columns = table_columns(con)
+    needs = {}
+    for id_, sql in workload.items():
+        try:
+            plan = query_plan(con, sql)
+        except sqlite3.Error:
+            continue
+        tables, automatic_columns = unindexed_accesses(plan, columns)
+        candidates = predicate_columns(sql, columns) | automatic_columns
+        for table in tables:
+            table_candidates = {(t, c) for t, c in candidates if t == table}
+            if table_candidates:
+                needs[(id_, table)] = table_candidates
+
+    indexes = []
+    uncovered = dict(needs)
+    while uncovered:
+        gain = Counter(candidate for table_candidates in uncovered.values() for candidate in table_candidates)
+        (table, column), count = sorted(gain.items(), key=lambda x: (-x[1], x[0]))[0]
+        if count < min_queries:
+            break
+        indexes.append({"table": table, "column": column, "queries": count})
+        uncovered = {need: table_candidates for need, table_candidates in uncovered.items() if (table, column) not in table_candidates}
+    return indexes
+
+
+def index_name(index):
+    return f"idx_{index['table']}_{index['column']}"
+
+
+def index_statements(indexes):
+    return [f"CREATE INDEX IF NOT EXISTS {index_name(index)} ON {index['table']} ({index['column']});" for index in indexes]
+
+
+def indexes_used(db_path, sql):
+    con = connect_readonly(db_path)
+    try:
+        return {match.group(1) for detail in query_plan(con, sql) for match in INDEX_USE_PATTERN.finditer(detail)}
+    except sqlite3.Error:
+        return set()
+    finally:
+        con.close()
+
+
+def run_workload(db_path, workload, repeat):
+    con = connect_readonly(db_path)
+    timings, results = {}, {}
+    for id_, sql in workload.items():
+        elapsed = []
+        for _ in range(repeat):
+            start_time = time.time()
+            try:
+                results[id_] = fetch_within_budget(con, sql, consume=canonicalize_rows).digest
+            except sqlite3.Error:
+                results[id_] = "error"
+            elapsed.append(time.time() - start_time)
+        timings[id_] = min(elapsed)
+    con.close()
+    return timings, results
+
+
+def main(args):
+    workload = load_workload(args.data_dir, args.splits)
+    con = connect_readonly(args.db_path)
+    indexes = propose_indexes(con, workload, args.min_queries)
+    con.close()
+    print(f"{len(indexes)} indexes proposed for {len(workload)} queries")
+
+    # apply the indexes to a copy of the database and compare speed and results on the gold workload; indexes
+    # read by a query whose result changes (e.g. a SUM() over floats visited in another order) are dropped
+    # and the workload is run again, until no result changes or the changes cannot be attributed to an index
+    dropped = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        indexed_path = os.path.join(tmp_dir, "indexed.sqlite")
+        src = connect_readonly(args.db_path)
+        dst = sqlite3.connect(indexed_path)
+        src.backup(dst)
+        src.close()
+        dst.executescript("\n".join(index_statements(indexes)))
+        dst.close()
+
+        before_timings, before_results = run_workload(args.db_path, workload, args.repeat)
+        while True:
+            after_timings, after_results = run_workload(indexed_path, workload, args.repeat)
+            changed = [id_ for id_ in workload if before_results[id_] != after_results[id_]]
+            names = {index_name(index) for index in indexes}
+            culprits = {name for id_ in changed for name in indexes_used(indexed_path, workload[id_])} & names
+            if not culprits:
+                break
+            for index in indexes:
+                if index_name(index) in culprits:
+                    print(f"dropping {index_name(index)}: it changes the result of {[id_ for id_ in changed if index_name(index) in indexes_used(indexed_path, workload[id_])]}")
+            dst = sqlite3.connect(indexed_path)
+            dst.executescript("".join(f"DROP INDEX {name};" for name in sorted(culprits)))
+            dst.close()
+            dropped += [index_name(index) for index in indexes if index_name(index) in culprits]
+            indexes = [index for index in indexes if index_name(index) not in culprits]
+
+    statements = index_statements(indexes)
+    per_query = [
+        {"id": id_, "before_secs": before_timings[id_], "after_secs": after_timings[id_], "speedup": before_timings[id_] / max(after_timings[id_], 1e-9)}
+        for id_ in workload
+    ]
+    report = {
+        "indexes": statements,
+        "dropped_indexes": dropped,
+        "num_queries": len(workload),
+        "before_secs": sum(before_timings.values()),
+        "after_secs": sum(after_timings.values()),
+        "changed_results": changed,
+        "per_query": sorted(per_query, key=lambda x: -x["before_secs"]),
+    }
+    print(f"gold workload: {report['before_secs']:.2f} secs -> {report['after_secs']:.2f} secs")
+    print(f"queries with changed results: {len(changed)}")
+    for item in report["per_query"][:10]:
+        print(f"{item['id']}: {item['before_secs']:.4f} -> {item['after_secs']:.4f} secs (x{item['speedup']:.1f})")
+    if args.report_path is not None:
+        with open(args.report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    if changed:  # not caused by a proposed index; the index file is left as it was
+        print(f"gold results change with the proposed indexes: {changed}")
+        sys.exit(1)
+
+    with open(args.index_path, "w") as f:
+        f.write("\n".join(statements) + "\n")
+    print(f"{len(statements)} indexes kept (written to {args.index_path})")
+    for index, statement in zip(indexes, statements):
+        print(f"{statement}  -- removes {index['queries']} unindexed accesses")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
+    print("Done!\n")
@@ -16,6 +16,11 @@ def config():
     parser.add_argument("--time_span", default=None, type=int, help="time span starting from start_year")
     parser.add_argument("--cur_patient_ratio", default=0.0, type=float, help="ratio of inpatient")
     parser.add_argument("--current_time", default=None, type=str, help="any record past current_time is removed")
+    parser.add_argument("--num_workers", default=None, type=int, help="processes parsing the large event tables (default: the usable CPUs)")
+    parser.add_argument("--num_stage_workers", default=None, type=int, help="processes running independent table builds at once (default: the usable CPUs; 1 runs them one after another)")
+    parser.add_argument("--direct_load", action="store_true", help="insert each table into the database as it is built instead of reading the CSV files back")
+    parser.add_argument("--skip_csv", action="store_true", help="do not write the CSV file of each table (requires --direct_load)")
+    parser.add_argument("--build_index", action="store_true", help="create the secondary indexes in {db_name}_index.sql")
     args = parser.parse_args()
 
     return args
@@ -26,6 +31,7 @@ def main(args):
         assert args.start_year is not None, 'To do a time shift, "start_year" must be specified'
         assert args.time_span is not None, 'To do a time shift, "time_span" must be specified'
         assert args.current_time is not None, 'To do a time shift, "current_time" must be specified'
+    assert args.direct_load or not args.skip_csv, 'Without "direct_load", the database is loaded from the CSV files'
 
     if args.db_name == "mimic_iv":
         from preprocess_db_mimic_iv import Build_MIMIC_IV
@@ -42,21 +48,14 @@ def main(args):
             time_span=args.time_span,
             cur_patient_ratio=args.cur_patient_ratio,
             current_time=args.current_time,
+            num_workers=args.num_workers,
+            direct_load=args.direct_load,
+            write_csv=not args.skip_csv,
         )
 
-        mimic_writer.build_admission_table()  # patients, admissions, icustays, transfers
-        mimic_writer.build_dictionary_table()  # d_icu_diagnoses, d_icu_procedures, d_items, d_labitems
-        mimic_writer.build_diagnosis_table()  # diagnoses_icd
-        mimic_writer.build_procedure_table()  # procedures_icd
-        mimic_writer.build_labevent_table()  # labevents
-        mimic_writer.build_prescriptions_table()  # prescriptions
-        mimic_writer.build_cost_table()  # cost
-        mimic_writer.build_chartevent_table()  # chartevents
-        mimic_writer.build_inputevent_table()  # inputevents_cv
-        mimic_writer.build_outputevent_table()  # outputevents
-        mimic_writer.build_microbiology_table()  # microbiologyevents
+        mimic_writer.run_stages(num_processes=args.num_stage_workers)  # build_admission_table, ..., build_microbiology_table
 
-        mimic_writer.generate_db()
+        mimic_writer.generate_db(build_index=args.build_index)
 
     else:
         NotImplementedError
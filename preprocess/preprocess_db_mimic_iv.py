@@ -1,5 +1,8 @@
+import io
 import os
 import time
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import random
@@ -13,7 +16,7 @@ import warnings
 
 warnings.filterwarnings("ignore")
 
-from preprocess_utils import Sampler, adjust_time, read_csv, generate_random_date
+from preprocess_utils import Sampler, adjust_time, shift_time, format_time, parse_time, read_csv, generate_random_date, usable_cpus
 
 
 CHARTEVENT2ITEMID = {
@@ -32,6 +35,60 @@ CHARTEVENT2ITEMID = {
 # Disambiguate values in the fields d_item.label, d_labitems.label, and prescription.drug, keeping only the most frequent label.
 label_mapper = {'micafungin': 'inputevents', 'propofol': 'inputevents', 'progesterone': 'prescriptions', 'lr': 'inputevents', 'ambisome': 'inputevents', 'ceftaroline': 'inputevents', 'epinephrine': 'inputevents', 'magnesium sulfate': 'inputevents', 'albumin 25%': 'inputevents', 'caspofungin': 'inputevents', 'ciprofloxacin': 'inputevents', 'atropine': 'inputevents', 'fentanyl': 'inputevents', 'dextrose 50%': 'inputevents', 'atovaquone': 'inputevents', 'penicillin g potassium': 'inputevents', 'heparin': 'prescriptions', 'diltiazem': 'inputevents', 'dilantin': 'inputevents', 'esmolol': 'inputevents', 'testosterone': 'labevents', 'dopamine': 'inputevents', 'potassium phosphate': 'inputevents', 'albumin': 'labevents', 'ensure': 'inputevents', 'verapamil': 'inputevents', 'procainamide': 'prescriptions', 'ceftriaxone': 'inputevents', 'ceftazidime': 'inputevents', 'd5ns': 'inputevents', 'citrate': 'inputevents', 'tobramycin': 'labevents', 'solution': 'inputevents', 'phenylephrine': 'inputevents', 'primidone': 'prescriptions', 'vasopressin': 'inputevents', 'doxycycline': 'inputevents', 'albumin 5%': 'inputevents', 'ribavirin': 'inputevents', 'metronidazole': 'inputevents', 'multivitamins': 'inputevents', 'potassium': 'prescriptions', 'tamiflu': 'inputevents', 'factor xiii': 'labevents', 'meropenem': 'inputevents', 'oxycodone': 'labevents', 'protamine sulfate': 'inputevents', 'd5 1/2ns': 'inputevents', 'rocuronium': 'inputevents', 'calcium chloride': 'inputevents', 'test': 'prescriptions', 'phenobarbital': 'prescriptions', 'calcium gluconate': 'inputevents', 'linezolid': 'inputevents', 'potassium chloride': 'inputevents', 'clindamycin': 'inputevents', 'adenosine': 'inputevents', 'morphine sulfate': 'inputevents', 'chloroquine': 'inputevents', 'folic acid': 'inputevents', 'amikacin': 'prescriptions', 'nafcillin': 'inputevents', 'daptomycin': 'inputevents', 'd5lr': 'inputevents', 'sodium': 'labevents', 'quinidine': 'prescriptions', 'moxifloxacin': 'inputevents', 'mannitol': 'inputevents', 'ampicillin': 'inputevents', 'isoniazid': 'inputevents', 'fluconazole': 'inputevents', 'lithium': 'labevents', 'keflex': 'inputevents', 'folate': 'inputevents', 'colistin': 'inputevents', 'ranitidine': 'inputevents', 'argatroban': 'inputevents', 'dobutamine': 'inputevents', 'cisatracurium': 'inputevents', 'dextrose 5%': 'inputevents', 'levofloxacin': 'inputevents', 'factor viii': 'inputevents', 'acetaminophen': 'prescriptions', 'd': 'prescriptions', 'lidocaine': 'prescriptions', 'theophylline': 'labevents', 'vancomycin': 'prescriptions', 'methotrexate': 'prescriptions', 'aminophylline': 'inputevents', 'hydrochloric acid': 'inputevents', 'nesiritide': 'inputevents', 'hydromorphone (dilaudid)': 'inputevents', 'octreotide': 'inputevents', 'gentamicin': 'prescriptions', 'nicardipine': 'inputevents', 'rifampin': 'inputevents', 'amiodarone': 'inputevents', 'tigecycline': 'inputevents', 'magnesium': 'labevents', 'insulin': 'prescriptions', 'hydralazine': 'inputevents', 'labetalol': 'inputevents', 'cyclosporine': 'inputevents', 'sodium bicarbonate 8.4%': 'inputevents', 'potassium acetate': 'inputevents', 'aztreonam': 'inputevents', 'cefepime': 'inputevents', 'carbamazepine': 'labevents', 'norepinephrine': 'inputevents', 'digoxin': 'prescriptions', 'milrinone': 'inputevents', 'heparin sodium': 'inputevents', 'valproic acid': 'labevents', 'foscarnet': 'inputevents', 'mannitol 20%': 'inputevents', 'd5 1/4ns': 'inputevents', 'phenytoin': 'labevents', 'iron': 'labevents', 'acetylcysteine': 'inputevents', 'epoprostenol (veletri)': 'inputevents', 'pyrazinamide': 'inputevents', 'sodium acetate': 'inputevents', 'acyclovir': 'inputevents', 'oxacillin': 'inputevents', 'ketamine': 'inputevents', 'fosphenytoin': 'inputevents', 'sterile water': 'inputevents', 'metoprolol': 'inputevents', 'nitroglycerin': 'inputevents', 'erythromycin': 'inputevents', 'estradiol': 'labevents', 'voriconazole': 'inputevents', 'pamidronate': 'inputevents', 'cefazolin': 'inputevents', 'azithromycin': 'inputevents', 'fondaparinux': 'inputevents', 'lepirudin': 'inputevents', 'thiamine': 'inputevents', 'thrombin': 'labevents', 'zinc': 'prescriptions'}
 
+# tables in the order generate_db loads them; the icd_code of the ICD tables is read back as str
+TABLE_NAMES = [
+    "patients",
+    "admissions",
+    "d_icd_diagnoses",
+    "d_icd_procedures",
+    "d_items",
+    "d_labitems",
+    "diagnoses_icd",
+    "procedures_icd",
+    "labevents",
+    "prescriptions",
+    "cost",
+    "chartevents",
+    "inputevents",
+    "outputevents",
+    "microbiologyevents",
+    "icustays",
+    "transfers",
+]
+ICD_TABLES = ["d_icd_diagnoses", "d_icd_procedures", "diagnoses_icd", "procedures_icd"]
+COST_SOURCE_TABLES = ["diagnoses_icd", "labevents", "procedures_icd", "prescriptions"]  # tables build_cost_table charges
+
+# strings that the CSV round trip (to_csv, then read_csv) turns into NULL once lowercased; direct_load stores them as NULL too
+CSV_NA_VALUES = ["", "n/a", "nan", "-nan", "null"]
+
+# state shared between the stages: the cohort and time offsets fixed by build_admission_table (which also draws
+# from the Sampler rng, as build_cost_table does later), and the item dictionaries of build_dictionary_table
+COHORT_STATE = ["rng", "cur_patient_list", "non_cur_patient", "patient_list", "hadm_list", "subjectid2admittime_dict", "HADM_ID2admtime_dict", "HADM_ID2dischtime_dict"]
+DICTIONARY_STATE = ["D_ICD_DIAGNOSES_dict", "D_ICD_PROCEDURES_dict", "D_LABITEMS_dict", "D_ITEMS_dict"]
+
+# stage: (stages it depends on, state it reads, state it sets), in the order of a serial run
+BUILD_STAGES = {
+    "build_admission_table": ([], ["rng"], COHORT_STATE),  # patients, admissions, icustays, transfers
+    "build_dictionary_table": ([], [], DICTIONARY_STATE),  # d_icd_diagnoses, d_icd_procedures, d_items, d_labitems
+    "build_diagnosis_table": (["build_admission_table", "build_dictionary_table"], ["hadm_list", "subjectid2admittime_dict", "HADM_ID2admtime_dict", "D_ICD_DIAGNOSES_dict"], []),
+    "build_procedure_table": (
+        ["build_admission_table", "build_dictionary_table"],
+        ["hadm_list", "subjectid2admittime_dict", "HADM_ID2admtime_dict", "HADM_ID2dischtime_dict", "D_ICD_PROCEDURES_dict"],
+        [],
+    ),
+    "build_labevent_table": (["build_admission_table", "build_dictionary_table"], ["hadm_list", "subjectid2admittime_dict", "D_LABITEMS_dict"], []),
+    "build_prescriptions_table": (["build_admission_table"], ["hadm_list", "subjectid2admittime_dict"], []),
+    "build_cost_table": (["build_diagnosis_table", "build_procedure_table", "build_labevent_table", "build_prescriptions_table"], ["rng", "tables"], ["rng", "tables"]),
+    "build_chartevent_table": (["build_admission_table"], ["patient_list", "hadm_list", "subjectid2admittime_dict"], []),
+    "build_inputevent_table": (["build_admission_table", "build_dictionary_table"], ["hadm_list", "subjectid2admittime_dict", "D_ITEMS_dict"], []),
+    "build_outputevent_table": (["build_admission_table", "build_dictionary_table"], ["hadm_list", "subjectid2admittime_dict", "D_ITEMS_dict"], []),
+    "build_microbiology_table": (["build_admission_table"], ["hadm_list", "subjectid2admittime_dict"], []),
+}
+BUILD_STATE = {name for _, inputs, outputs in BUILD_STAGES.values() for name in inputs + outputs}
+
+# build-time settings of the output database: nothing needs to survive a crash during the build, which starts over anyway
+BUILD_PRAGMAS = ["PRAGMA journal_mode=OFF", "PRAGMA synchronous=OFF", "PRAGMA cache_size=-262144"]  # 256 MiB page cache
+
 
 class Build_MIMIC_IV(Sampler):
     def __init__(
@@ -47,15 +104,28 @@ class Build_MIMIC_IV(Sampler):
         start_year=None,
         time_span=None,
         current_time=None,
+        num_workers=None,
+        direct_load=False,
+        write_csv=True,
         verbose=True,
     ):
         super().__init__()
 
         self.data_dir = data_dir
         self.out_dir = os.path.join(out_dir, db_name)
+        self.db_name = db_name
 
         self.deid = deid
         self.timeshift = timeshift
+        self.num_workers = num_workers  # processes parsing the event tables (None: the usable CPUs)
+
+        # direct_load: insert each table into the database as soon as its stage has built it, instead of
+        # writing a CSV file that generate_db reads back; the CSV files are then optional (write_csv)
+        assert direct_load or write_csv, "Without direct_load, the tables are loaded from the CSV files"
+        self.direct_load = direct_load
+        self.write_csv = write_csv
+        self.tables = {}  # built tables still needed by a later stage (see COST_SOURCE_TABLES)
+        self.saved_tables = None  # in the worker processes of run_stages: the tables saved by the stage, loaded by the parent
 
         self.sample_icu_patient_only = sample_icu_patient_only
         self.num_patient = num_patient
@@ -75,12 +145,25 @@ class Build_MIMIC_IV(Sampler):
 
         self.conn = sqlite3.connect(os.path.join(self.out_dir, db_name + ".sqlite"))
         self.cur = self.conn.cursor()
+        for pragma in BUILD_PRAGMAS:
+            self.cur.execute(pragma)
         with open(os.path.join(self.out_dir, db_name + ".sql"), "r") as sql_file:
             sql_script = sql_file.read()
         self.cur.executescript(sql_script)
 
         self.chartevent2itemid = {k.lower(): v for k, v in CHARTEVENT2ITEMID.items()}  # Database records are converted to lowercase to remove duplicates that differ only in case sensitivity
 
+    def event_filter_dict(self, **filters):
+        """
+        filter_dict pushed down into the streaming read of an event table: the given filters (e.g. the
+        itemids kept by the stage) and, without de-identification, the admissions of the cohort.
+        De-identification shuffles values over all rows of the table, so hadm_id is filtered after it then.
+        """
+        filter_dict = {key: list(values) for key, values in filters.items()}
+        if not self.deid:
+            filter_dict["hadm_id"] = self.hadm_list
+        return filter_dict or None
+
     def build_admission_table(self):
         print("Processing patients, admissions, icustays, transfers")
         start_time = time.time()
@@ -180,10 +263,10 @@ class Build_MIMIC_IV(Sampler):
         """
         if self.timeshift:
             # 1) get the earliest admission time of each patient, compute the offset, and save it
-            ADMITTIME_earliest = {subj_id: min(ADMISSIONS_table["admittime"][ADMISSIONS_table["subject_id"] == subj_id].values) for subj_id in ADMISSIONS_table["subject_id"].unique()}
+            ADMITTIME_earliest = ADMISSIONS_table.groupby("subject_id", sort=False)["admittime"].min()  # in order of appearance, as the sampler draws below
+            earliest_year = parse_time(ADMITTIME_earliest.values).astype("datetime64[Y]").astype(int) + 1970
             self.subjectid2admittime_dict = {
-                subj_id: self.first_admit_year_sampler(self.start_year, self.time_span, datetime.strptime(ADMITTIME_earliest[subj_id], "%Y-%m-%d %H:%M:%S").year)
-                for subj_id in ADMISSIONS_table["subject_id"].unique()
+                subj_id: self.first_admit_year_sampler(self.start_year, self.time_span, year) for subj_id, year in zip(ADMITTIME_earliest.index, earliest_year)
             }
 
         ################################################################################
@@ -296,10 +379,10 @@ class Build_MIMIC_IV(Sampler):
         ICUSTAYS_table["row_id"] = range(len(ICUSTAYS_table))
         TRANSFERS_table["row_id"] = range(len(TRANSFERS_table))
 
-        PATIENTS_table.to_csv(os.path.join(self.out_dir, "patients.csv"), index=False)
-        ADMISSIONS_table.to_csv(os.path.join(self.out_dir, "admissions.csv"), index=False)
-        ICUSTAYS_table.to_csv(os.path.join(self.out_dir, "icustays.csv"), index=False)
-        TRANSFERS_table.to_csv(os.path.join(self.out_dir, "transfers.csv"), index=False)
+        self.save_table("patients", PATIENTS_table)
+        self.save_table("admissions", ADMISSIONS_table)
+        self.save_table("icustays", ICUSTAYS_table)
+        self.save_table("transfers", TRANSFERS_table)
 
         print(f"patients, admissions, icustays, transfers processed (took {round(time.time() - start_time, 4)} secs)")
 
@@ -331,7 +414,7 @@ class Build_MIMIC_IV(Sampler):
         D_ICD_DIAGNOSES_table = D_ICD_DIAGNOSES_table.reset_index(drop=False)
         D_ICD_DIAGNOSES_table = D_ICD_DIAGNOSES_table.rename(columns={"index": "row_id"})  # add row_id
         D_ICD_DIAGNOSES_table["row_id"] = range(len(D_ICD_DIAGNOSES_table))
-        D_ICD_DIAGNOSES_table.to_csv(os.path.join(self.out_dir, "d_icd_diagnoses.csv"), index=False)
+        self.save_table("d_icd_diagnoses", D_ICD_DIAGNOSES_table)
         self.D_ICD_DIAGNOSES_dict = {item: val for item, val in zip(D_ICD_DIAGNOSES_table["icd_code"].values, D_ICD_DIAGNOSES_table["long_title"].values)}
 
         """
@@ -357,7 +440,7 @@ class Build_MIMIC_IV(Sampler):
         D_ICD_PROCEDURES_table = D_ICD_PROCEDURES_table.reset_index(drop=False)
         D_ICD_PROCEDURES_table = D_ICD_PROCEDURES_table.rename(columns={"index": "row_id"})  # add row_id
         D_ICD_PROCEDURES_table["row_id"] = range(len(D_ICD_PROCEDURES_table))
-        D_ICD_PROCEDURES_table.to_csv(os.path.join(self.out_dir, "d_icd_procedures.csv"), index=False)
+        self.save_table("d_icd_procedures", D_ICD_PROCEDURES_table)
         self.D_ICD_PROCEDURES_dict = {item: val for item, val in zip(D_ICD_PROCEDURES_table["icd_code"].values, D_ICD_PROCEDURES_table["long_title"].values)}
 
         """
@@ -384,7 +467,7 @@ class Build_MIMIC_IV(Sampler):
         D_LABITEMS_table = D_LABITEMS_table.reset_index(drop=False)
         D_LABITEMS_table = D_LABITEMS_table.rename(columns={"index": "row_id"})  # add row_id
         D_LABITEMS_table["row_id"] = range(len(D_LABITEMS_table))
-        D_LABITEMS_table.to_csv(os.path.join(self.out_dir, "d_labitems.csv"), index=False)
+        self.save_table("d_labitems", D_LABITEMS_table)
         self.D_LABITEMS_dict = {item: val for item, val in zip(D_LABITEMS_table["itemid"].values, D_LABITEMS_table["label"].values)}
 
         """
@@ -412,7 +495,7 @@ class Build_MIMIC_IV(Sampler):
         D_ITEMS_table = D_ITEMS_table.reset_index(drop=False)
         D_ITEMS_table = D_ITEMS_table.rename(columns={"index": "row_id"})  # add row_id
         D_ITEMS_table["row_id"] = range(len(D_ITEMS_table))
-        D_ITEMS_table.to_csv(os.path.join(self.out_dir, "d_items.csv"), index=False)
+        self.save_table("d_items", D_ITEMS_table)
         self.D_ITEMS_dict = {item: val for item, val in zip(D_ITEMS_table["itemid"].values, D_ITEMS_table["label"].values)}
 
         print(f"d_icd_diagnoses, d_icd_procedures, d_labitems, d_items processed (took {round(time.time() - start_time, 4)} secs)")
@@ -447,16 +530,15 @@ class Build_MIMIC_IV(Sampler):
 
         # timeshift
         if self.timeshift:
-            DIAGNOSES_ICD_table["charttime"] = adjust_time(DIAGNOSES_ICD_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
-            DIAGNOSES_ICD_table = DIAGNOSES_ICD_table.dropna(subset=["charttime"])
-            TIME = np.array([datetime.strptime(tt, "%Y-%m-%d %H:%M:%S") for tt in DIAGNOSES_ICD_table["charttime"].values])
+            TIME = shift_time(DIAGNOSES_ICD_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
+            DIAGNOSES_ICD_table["charttime"] = format_time(TIME)
             DIAGNOSES_ICD_table = DIAGNOSES_ICD_table[TIME >= self.start_pivot_datetime]
 
         # save csv
         DIAGNOSES_ICD_table = DIAGNOSES_ICD_table.reset_index(drop=False)
         DIAGNOSES_ICD_table = DIAGNOSES_ICD_table.rename(columns={"index": "row_id"})
         DIAGNOSES_ICD_table["row_id"] = range(len(DIAGNOSES_ICD_table))
-        DIAGNOSES_ICD_table.to_csv(os.path.join(self.out_dir, "diagnoses_icd.csv"), index=False)
+        self.save_table("diagnoses_icd", DIAGNOSES_ICD_table)
 
         print(f"diagnoses_icd processed (took {round(time.time() - start_time, 4)} secs)")
 
@@ -495,16 +577,15 @@ class Build_MIMIC_IV(Sampler):
 
         # timeshift
         if self.timeshift:
-            PROCEDURES_ICD_table["charttime"] = adjust_time(PROCEDURES_ICD_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
-            PROCEDURES_ICD_table = PROCEDURES_ICD_table.dropna(subset=["charttime"])
-            TIME = np.array([datetime.strptime(tt, "%Y-%m-%d %H:%M:%S") for tt in PROCEDURES_ICD_table["charttime"].values])
+            TIME = shift_time(PROCEDURES_ICD_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
+            PROCEDURES_ICD_table["charttime"] = format_time(TIME)
             PROCEDURES_ICD_table = PROCEDURES_ICD_table[TIME >= self.start_pivot_datetime]
 
         # save csv
         PROCEDURES_ICD_table = PROCEDURES_ICD_table.reset_index(drop=False)
         PROCEDURES_ICD_table = PROCEDURES_ICD_table.rename(columns={"index": "row_id"})
         PROCEDURES_ICD_table["row_id"] = range(len(PROCEDURES_ICD_table))
-        PROCEDURES_ICD_table.to_csv(os.path.join(self.out_dir, "procedures_icd.csv"), index=False)
+        self.save_table("procedures_icd", PROCEDURES_ICD_table)
 
         print(f"procedures_icd processed (took {round(time.time() - start_time, 4)} secs)")
 
@@ -518,6 +599,9 @@ class Build_MIMIC_IV(Sampler):
             filename="hosp/labevents.csv",
             columns=["subject_id", "hadm_id", "itemid", "charttime", "valuenum", "valueuom"],
             lower=True,
+            filter_dict=self.event_filter_dict(itemid=self.D_LABITEMS_dict),
+            memory_efficient=True,
+            num_workers=self.num_workers,
         )
         LABEVENTS_table = LABEVENTS_table.dropna(subset=["hadm_id", "valuenum", "valueuom"])
 
@@ -531,16 +615,15 @@ class Build_MIMIC_IV(Sampler):
 
         # timeshift
         if self.timeshift:
-            LABEVENTS_table["charttime"] = adjust_time(LABEVENTS_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
-            LABEVENTS_table = LABEVENTS_table.dropna(subset=["charttime"])
-            TIME = np.array([datetime.strptime(tt, "%Y-%m-%d %H:%M:%S") for tt in LABEVENTS_table["charttime"].values])
+            TIME = shift_time(LABEVENTS_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
+            LABEVENTS_table["charttime"] = format_time(TIME)
             LABEVENTS_table = LABEVENTS_table[TIME >= self.start_pivot_datetime]
 
         # save csv
         LABEVENTS_table = LABEVENTS_table.reset_index(drop=False)
         LABEVENTS_table = LABEVENTS_table.rename(columns={"index": "row_id"})
         LABEVENTS_table["row_id"] = range(len(LABEVENTS_table))
-        LABEVENTS_table.to_csv(os.path.join(self.out_dir, "labevents.csv"), index=False)
+        self.save_table("labevents", LABEVENTS_table)
 
         print(f"labevents processed (took {round(time.time() - start_time, 4)} secs)")
 
@@ -584,17 +667,16 @@ class Build_MIMIC_IV(Sampler):
 
         # timeshift
         if self.timeshift:
-            PRESCRIPTIONS_table["starttime"] = adjust_time(PRESCRIPTIONS_table, "starttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
+            TIME = shift_time(PRESCRIPTIONS_table, "starttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
+            PRESCRIPTIONS_table["starttime"] = format_time(TIME)
             PRESCRIPTIONS_table["stoptime"] = adjust_time(PRESCRIPTIONS_table, "stoptime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
-            PRESCRIPTIONS_table = PRESCRIPTIONS_table.dropna(subset=["starttime"])
-            TIME = np.array([datetime.strptime(tt, "%Y-%m-%d %H:%M:%S") for tt in PRESCRIPTIONS_table["starttime"].values])
             PRESCRIPTIONS_table = PRESCRIPTIONS_table[TIME >= self.start_pivot_datetime]
 
         # save csv
         PRESCRIPTIONS_table = PRESCRIPTIONS_table.reset_index(drop=False)
         PRESCRIPTIONS_table = PRESCRIPTIONS_table.rename(columns={"index": "row_id"})
         PRESCRIPTIONS_table["row_id"] = range(len(PRESCRIPTIONS_table))
-        PRESCRIPTIONS_table.to_csv(os.path.join(self.out_dir, "prescriptions.csv"), index=False)
+        self.save_table("prescriptions", PRESCRIPTIONS_table)
 
         print(f"prescriptions processed (took {round(time.time() - start_time, 4)} secs)")
 
@@ -602,10 +684,10 @@ class Build_MIMIC_IV(Sampler):
         print("Processing COST table")
         start_time = time.time()
 
-        DIAGNOSES_ICD_table = read_csv(self.out_dir, "diagnoses_icd.csv").astype({"icd_code": str})
-        LABEVENTS_table = read_csv(self.out_dir, "labevents.csv")
-        PROCEDURES_ICD_table = read_csv(self.out_dir, "procedures_icd.csv").astype({"icd_code": str})
-        PRESCRIPTIONS_table = read_csv(self.out_dir, "prescriptions.csv")
+        DIAGNOSES_ICD_table = self.tables.pop("diagnoses_icd").astype({"icd_code": str})
+        LABEVENTS_table = self.tables.pop("labevents")
+        PROCEDURES_ICD_table = self.tables.pop("procedures_icd").astype({"icd_code": str})
+        PRESCRIPTIONS_table = self.tables.pop("prescriptions")
 
         cnt = 0
         data_filter = []
@@ -696,7 +778,7 @@ class Build_MIMIC_IV(Sampler):
         data_filter.append(temp)
 
         COST_table = pd.concat(data_filter, ignore_index=True)
-        COST_table.to_csv(os.path.join(self.out_dir, "cost.csv"), index=False)
+        self.save_table("cost", COST_table)
 
         print(f"cost processed (took {round(time.time() - start_time, 4)} secs)")
 
@@ -717,27 +799,20 @@ class Build_MIMIC_IV(Sampler):
         CHARTEVENTS_table = read_csv(
             data_dir=self.data_dir,
             filename="icu/chartevents.csv",
-            dtype={
-                "subject_id": int,
-                "hadm_id": int,
-                "stay_id": int,
-                "charttime": str,
-                "itemid": str,  # int,
-                "valuenum": "float64",
-                "valueuom": str,
-            },
             columns=["subject_id", "hadm_id", "stay_id", "charttime", "itemid", "valuenum", "valueuom"],
             lower=True,
-            filter_dict={"itemid": self.chartevent2itemid.values(), "subject_id": self.patient_list},
-            memory_efficient=False, # MODIFIED
+            filter_dict=self.event_filter_dict(itemid=self.chartevent2itemid.values(), subject_id=self.patient_list),
+            memory_efficient=True,
+            num_workers=self.num_workers,
         )
 
         CHARTEVENTS_table = CHARTEVENTS_table.dropna()
         CHARTEVENTS_table = CHARTEVENTS_table.astype(CHARTEVENTS_table_dtype)
 
         if self.timeshift:  # change the order due to the large number of rows in CHARTEVENTS_table
-            CHARTEVENTS_table["charttime"] = adjust_time(CHARTEVENTS_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
-            CHARTEVENTS_table = CHARTEVENTS_table.dropna(subset=["charttime"])
+            TIME = shift_time(CHARTEVENTS_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
+            CHARTEVENTS_table["charttime"] = format_time(TIME)
+            CHARTEVENTS_table = CHARTEVENTS_table[TIME.notnull()]
 
         # de-identification
         if self.deid:
@@ -747,14 +822,13 @@ class Build_MIMIC_IV(Sampler):
 
         # timeshift
         if self.timeshift:
-            TIME = np.array([datetime.strptime(tt, "%Y-%m-%d %H:%M:%S") for tt in CHARTEVENTS_table["charttime"].values])
-            CHARTEVENTS_table = CHARTEVENTS_table[TIME >= self.start_pivot_datetime]
+            CHARTEVENTS_table = CHARTEVENTS_table[TIME.loc[CHARTEVENTS_table.index] >= self.start_pivot_datetime]
 
         # save csv
         CHARTEVENTS_table = CHARTEVENTS_table.reset_index(drop=False)
         CHARTEVENTS_table = CHARTEVENTS_table.rename(columns={"index": "row_id"})
         CHARTEVENTS_table["row_id"] = range(len(CHARTEVENTS_table))
-        CHARTEVENTS_table.to_csv(os.path.join(self.out_dir, "chartevents.csv"), index=False)
+        self.save_table("chartevents", CHARTEVENTS_table)
 
         print(f"chartevents processed (took {round(time.time() - start_time, 4)} secs)")
 
@@ -767,6 +841,9 @@ class Build_MIMIC_IV(Sampler):
             filename="icu/inputevents.csv",
             columns=["subject_id", "hadm_id", "stay_id", "starttime", "itemid", "totalamount", "totalamountuom"],
             lower=True,
+            filter_dict=self.event_filter_dict(itemid=self.D_ITEMS_dict),
+            memory_efficient=True,
+            num_workers=self.num_workers,
         )
 
         INPUTEVENTS_table = INPUTEVENTS_table.dropna(subset=["hadm_id", "stay_id", "totalamount", "totalamountuom"])
@@ -783,16 +860,15 @@ class Build_MIMIC_IV(Sampler):
 
         # timeshift
         if self.timeshift:
-            INPUTEVENTS_table["starttime"] = adjust_time(INPUTEVENTS_table, "starttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
-            INPUTEVENTS_table = INPUTEVENTS_table.dropna(subset=["starttime"])
-            TIME = np.array([datetime.strptime(tt, "%Y-%m-%d %H:%M:%S") for tt in INPUTEVENTS_table["starttime"].values])
+            TIME = shift_time(INPUTEVENTS_table, "starttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
+            INPUTEVENTS_table["starttime"] = format_time(TIME)
             INPUTEVENTS_table = INPUTEVENTS_table[TIME >= self.start_pivot_datetime]
 
         # save csv
         INPUTEVENTS_table = INPUTEVENTS_table.reset_index(drop=False)
         INPUTEVENTS_table = INPUTEVENTS_table.rename(columns={"index": "row_id"})
         INPUTEVENTS_table["row_id"] = range(len(INPUTEVENTS_table))
-        INPUTEVENTS_table.to_csv(os.path.join(self.out_dir, "inputevents.csv"), index=False)
+        self.save_table("inputevents", INPUTEVENTS_table)
 
         print(f"inputevents processed (took {round(time.time() - start_time, 4)} secs)")
 
@@ -806,6 +882,9 @@ class Build_MIMIC_IV(Sampler):
             filename="icu/outputevents.csv",
             columns=["subject_id", "hadm_id", "stay_id", "charttime", "itemid", "value", "valueuom"],
             lower=True,
+            filter_dict=self.event_filter_dict(itemid=self.D_ITEMS_dict),
+            memory_efficient=True,
+            num_workers=self.num_workers,
         )
 
         # preprocess
@@ -826,16 +905,15 @@ class Build_MIMIC_IV(Sampler):
 
         # timeshift
         if self.timeshift:
-            OUTPUTEVENTS_table["charttime"] = adjust_time(OUTPUTEVENTS_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
-            OUTPUTEVENTS_table = OUTPUTEVENTS_table.dropna(subset=["charttime"])
-            TIME = np.array([datetime.strptime(tt, "%Y-%m-%d %H:%M:%S") for tt in OUTPUTEVENTS_table["charttime"].values])
+            TIME = shift_time(OUTPUTEVENTS_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
+            OUTPUTEVENTS_table["charttime"] = format_time(TIME)
             OUTPUTEVENTS_table = OUTPUTEVENTS_table[TIME >= self.start_pivot_datetime]
 
         # save csv
         OUTPUTEVENTS_table = OUTPUTEVENTS_table.reset_index(drop=False)
         OUTPUTEVENTS_table = OUTPUTEVENTS_table.rename(columns={"index": "row_id"})
         OUTPUTEVENTS_table["row_id"] = range(len(OUTPUTEVENTS_table))
-        OUTPUTEVENTS_table.to_csv(os.path.join(self.out_dir, "outputevents.csv"), index=False)
+        self.save_table("outputevents", OUTPUTEVENTS_table)
 
         print(f"outputevents processed (took {round(time.time() - start_time, 4)} secs)")
 
@@ -849,6 +927,9 @@ class Build_MIMIC_IV(Sampler):
             filename="hosp/microbiologyevents.csv",
             columns=["subject_id", "hadm_id", "chartdate", "charttime", "spec_type_desc", "test_name", "org_name"],
             lower=True,
+            filter_dict=self.event_filter_dict(),
+            memory_efficient=True,
+            num_workers=self.num_workers,
         )
 
         # If charttime is null, use chartdate as charttime
@@ -866,77 +947,121 @@ class Build_MIMIC_IV(Sampler):
 
         # timeshift
         if self.timeshift:
-            MICROBIOLOGYEVENTS_table["charttime"] = adjust_time(
-                MICROBIOLOGYEVENTS_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id"
-            )
-            MICROBIOLOGYEVENTS_table = MICROBIOLOGYEVENTS_table.dropna(subset=["charttime"])
-            TIME = np.array([datetime.strptime(tt, "%Y-%m-%d %H:%M:%S") for tt in MICROBIOLOGYEVENTS_table["charttime"].values])
+            TIME = shift_time(MICROBIOLOGYEVENTS_table, "charttime", current_time=self.current_time, offset_dict=self.subjectid2admittime_dict, patient_col="subject_id")
+            MICROBIOLOGYEVENTS_table["charttime"] = format_time(TIME)
             MICROBIOLOGYEVENTS_table = MICROBIOLOGYEVENTS_table[TIME >= self.start_pivot_datetime]
 
         # save csv
         MICROBIOLOGYEVENTS_table = MICROBIOLOGYEVENTS_table.reset_index(drop=False)
         MICROBIOLOGYEVENTS_table = MICROBIOLOGYEVENTS_table.rename(columns={"index": "row_id"})
         MICROBIOLOGYEVENTS_table["row_id"] = range(len(MICROBIOLOGYEVENTS_table))
-        MICROBIOLOGYEVENTS_table.to_csv(os.path.join(self.out_dir, "microbiologyevents.csv"), index=False)
+        self.save_table("microbiologyevents", MICROBIOLOGYEVENTS_table)
 
         print(f"microbiologyevents processed (took {round(time.time() - start_time, 4)} secs)")
 
 
-    def generate_db(self):
-
-        rows = read_csv(self.out_dir, "patients.csv")
-        rows.to_sql("patients", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "admissions.csv")
-        rows.to_sql("admissions", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "d_icd_diagnoses.csv").astype({"icd_code": str})
-        rows.to_sql("d_icd_diagnoses", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "d_icd_procedures.csv").astype({"icd_code": str})
-        rows.to_sql("d_icd_procedures", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "d_items.csv")
-        rows.to_sql("d_items", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "d_labitems.csv")
-        rows.to_sql("d_labitems", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "diagnoses_icd.csv").astype({"icd_code": str})
-        rows.to_sql("diagnoses_icd", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "procedures_icd.csv").astype({"icd_code": str})
-        rows.to_sql("procedures_icd", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "labevents.csv")
-        rows.to_sql("labevents", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "prescriptions.csv")
-        rows.to_sql("prescriptions", self.conn, if_exists="append", index=False)
-
-        rows = read_csv(self.out_dir, "cost.csv")
-        rows.to_sql("cost", self.conn, if_exists="append", index=False)
+    def save_table(self, table_name, table):
+        if self.write_csv:
+            table.to_csv(os.path.join(self.out_dir, f"{table_name}.csv"), index=False)
+        if not (self.direct_load or table_name in COST_SOURCE_TABLES):
+            return
+        table = table.copy()
+        for col in table.columns[table.dtypes == object]:  # NULL where reading the CSV file back gives NaN
+            table.loc[table[col].isin(CSV_NA_VALUES), col] = None
+        if self.saved_tables is not None:
+            self.saved_tables.append((table_name, table))
+            return
+        if self.direct_load:
+            self.insert_table(table_name, table)
+        if table_name in COST_SOURCE_TABLES:
+            self.tables[table_name] = table
+
+    def insert_table(self, table_name, table):
+        # bulk insert of the rows of table, in one transaction
+        columns = list(table.columns)
+        rows = table.astype(object).where(pd.notnull(table), None)  # numpy scalars => Python values, NaN => NULL
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})",
+                rows.itertuples(index=False, name=None),
+            )
 
-        rows = read_csv(self.out_dir, "chartevents.csv")
-        rows.to_sql("chartevents", self.conn, if_exists="append", index=False)
+    def run_stages(self, num_processes=None):
+        """
+        Run all the build stages. With one process, they run one after another in the order of BUILD_STAGES.
+        Otherwise each stage is submitted to a pool of num_processes worker processes (default: the usable
+        CPUs) once the stages it depends on are done, with the settings and the state it reads (the
+        cohort, the time offsets, the rng, ...) passed explicitly. The state a stage sets is merged back
+        when it finishes, and its tables are loaded into the database in the serial order, so that the
+        CSV files and the database are byte-identical to a serial run.
+        """
+        num_processes = num_processes or usable_cpus()
+        if num_processes == 1:
+            for stage in BUILD_STAGES:
+                getattr(self, stage)()
+            return
+
+        settings = {name: value for name, value in vars(self).items() if name not in BUILD_STATE and name not in ["conn", "cur", "saved_tables"]}
+        if self.num_workers is None:  # the CPUs are shared by the stages running at once
+            settings["num_workers"] = max(1, usable_cpus() // num_processes)
+
+        pending = list(BUILD_STAGES)
+        running = {}
+        saved = {}  # stage => tables to load once the stages before it are loaded
+        load_order = list(BUILD_STAGES)
+        with ProcessPoolExecutor(num_processes) as executor:
+            while pending or running:
+                for stage in list(pending):
+                    after, inputs, _ = BUILD_STAGES[stage]
+                    if all(dependency in saved for dependency in after):
+                        state = {name: getattr(self, name) for name in inputs if hasattr(self, name)}
+                        running[executor.submit(run_build_stage, stage, settings, state)] = stage
+                        pending.remove(stage)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    output, state, saved_tables = future.result()
+                    print(output, end="")
+                    for name, value in state.items():
+                        setattr(self, name, value)
+                    for table_name, table in saved_tables:
+                        if table_name in COST_SOURCE_TABLES:
+                            self.tables[table_name] = table
+                    saved[stage] = saved_tables
+                while load_order and load_order[0] in saved:
+                    for table_name, table in saved[load_order.pop(0)]:
+                        if self.direct_load:
+                            self.insert_table(table_name, table)
+
+    def generate_db(self, build_index=False):
+
+        if not self.direct_load:  # load the CSV files written by the stages
+            for table_name in TABLE_NAMES:
+                rows = read_csv(self.out_dir, f"{table_name}.csv")
+                if table_name in ICD_TABLES:
+                    rows = rows.astype({"icd_code": str})
+                self.insert_table(table_name, rows)
 
-        rows = read_csv(self.out_dir, "inputevents.csv")
-        rows.to_sql("inputevents", self.conn, if_exists="append", index=False)
+        query = "SELECT * FROM sqlite_master WHERE type='table'"
+        print(pd.read_sql_query(query, self.conn)["name"])  # 17 tables
 
-        rows = read_csv(self.out_dir, "outputevents.csv")
-        rows.to_sql("outputevents", self.conn, if_exists="append", index=False)
+        if build_index:
+            self.build_index()
 
-        rows = read_csv(self.out_dir, "microbiologyevents.csv")
-        rows.to_sql("microbiologyevents", self.conn, if_exists="append", index=False)
+    def build_index(self):
+        # secondary indexes proposed by index_advisor.py for the gold workloads
+        print("Building indexes")
+        start_time = time.time()
 
-        rows = read_csv(self.out_dir, "icustays.csv")
-        rows.to_sql("icustays", self.conn, if_exists="append", index=False)
+        with open(os.path.join(self.out_dir, self.db_name + "_index.sql"), "r") as sql_file:
+            sql_script = sql_file.read()
+        self.cur.executescript(sql_script)
+        self.conn.commit()
 
-        rows = read_csv(self.out_dir, "transfers.csv")
-        rows.to_sql("transfers", self.conn, if_exists="append", index=False)
+        query = "SELECT * FROM sqlite_master WHERE type='index' AND sql IS NOT NULL"
+        print(pd.read_sql_query(query, self.conn)["name"])
 
-        query = "SELECT * FROM sqlite_master WHERE type='table'"
-        print(pd.read_sql_query(query, self.conn)["name"])  # 17 tables
+        print(f"indexes built (took {round(time.time() - start_time, 4)} secs)")
 
     def _check_assertion_db_and_csv(self, table_names=None):
         if table_names is None:
@@ -962,4 +1087,18 @@ class Build_MIMIC_IV(Sampler):
                 else:
                     raise AssertionError(f"csv and db are not the same: {table_name}")
             except:
-                breakpoint()
\ No newline at end of file
+                breakpoint()
+
+
+def run_build_stage(stage, settings, state):
+    # run_stages worker: the stage on a Build_MIMIC_IV made of settings and state, without a database connection;
+    # returns its printed output, the state it set and the tables it saved
+    builder = Build_MIMIC_IV.__new__(Build_MIMIC_IV)
+    builder.__dict__.update(settings)
+    builder.__dict__.update(state)
+    builder.saved_tables = []
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        getattr(builder, stage)()
+    _, _, outputs = BUILD_STAGES[stage]
+    return output.getvalue(), {name: getattr(builder, name) for name in outputs if hasattr(builder, name)}, builder.saved_tables
@@ -1,11 +1,18 @@
+import io
 import os
 import sys
+import gzip
 import random
 import numpy as np
 import time
 import pandas as pd
+import multiprocessing as mp
+from collections import deque
 from datetime import datetime, timedelta
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scoring_program"))
+from worker_sizing import usable_cpus  # CPU affinity and cgroup CPU quota
+
 
 class Sampler:
     def __init__(self):
@@ -40,29 +47,194 @@ class Sampler:
         return dts
 
 
+def parse_time(values):
+    # "%Y-%m-%d %H:%M:%S" strings => datetime64[s] array (NaT for null and empty values)
+    values = np.asarray(values, dtype=object)
+    times = np.full(len(values), np.datetime64("NaT"), dtype="datetime64[s]")
+    valid = pd.notnull(values) & (values != "")
+    times[valid] = values[valid].astype("datetime64[s]")
+    return times
+
+
+def format_time(times):
+    # datetime64 values => "%Y-%m-%d %H:%M:%S" strings as str(datetime) writes them (None for NaT)
+    times = np.asarray(times, dtype="datetime64[s]")
+    if len(times) == 0:  # the view below cannot be reshaped
+        return []
+    strings = np.datetime_as_string(times, unit="s")
+    strings.view("U1").reshape(len(strings), -1)[:, 10] = " "  # ISO "T" separator => " "
+    strings = strings.astype(object)
+    strings[np.isnat(times)] = None
+    return strings.tolist()
+
+
+def shift_time(table, time_col, patient_col, current_time=None, offset_dict=None):
+    """
+    Vectorized time shift of table[time_col] as a datetime64[s] Series aligned with table.index.
+    Rows whose patient has no offset, null times and times past current_time become NaT,
+    so `shift_time(...) >= pivot` also drops them.
+    """
+    values = table[time_col].values
+    if offset_dict is None:
+        times = parse_time(values)
+    else:
+        offsets = table[patient_col].map(offset_dict).values  # one join instead of a lookup per row
+        has_offset = pd.notnull(offsets)
+        if pd.api.types.is_numeric_dtype(table[time_col]):  # eicu: offset_dict holds the base time, time_col the minutes since it
+            valid = has_offset & pd.notnull(values)
+            times = parse_time(np.where(valid, offsets, None))
+            times[valid] += values[valid].astype(np.int64).astype("timedelta64[m]")
+        else:  # mimic: offset_dict holds the shift in minutes
+            times = parse_time(values)
+            times[~has_offset] = np.datetime64("NaT")
+            times[has_offset] += offsets[has_offset].astype(np.int64).astype("timedelta64[m]")
+    if current_time is not None:
+        times[times > np.datetime64(current_time)] = np.datetime64("NaT")
+    return pd.Series(times, index=table.index)
+
+
 def adjust_time(table, time_col, patient_col, current_time=None, offset_dict=None):
-    shifted_time = []
-    for idx, time_val in enumerate(table[time_col].values):
-        if pd.notnull(time_val) and time_val != "":
-            if offset_dict is not None:
-                id_ = table[patient_col].iloc[idx]
-                if id_ in offset_dict:
-                    if type(time_val) == str:  # mimic3
-                        time_val = str(datetime.strptime(time_val, "%Y-%m-%d %H:%M:%S") + timedelta(minutes=int(offset_dict[id_])))
-                    else:  # eicu
-                        time_val = str(datetime.strptime(offset_dict[id_], "%Y-%m-%d %H:%M:%S") + timedelta(minutes=int(time_val)))
-                else:
-                    time_val = None
-            if time_val is not None and current_time is not None and current_time < time_val:
-                time_val = None
-        else:
-            time_val = None
-        shifted_time.append(time_val)
+    return format_time(shift_time(table, time_col, patient_col, current_time=current_time, offset_dict=offset_dict).values)
+
+
+def normalize_column(values, sample_size=1000):
+    """
+    x.lower().strip() for the str values of an object array; other values (NaN, None, numbers) are kept.
+    Low-cardinality columns (units, routes, careunits, ...) are factorized so that each distinct value is
+    normalized once; mostly distinct ones (times, free text) use pandas string ops on the str values.
+    """
+    sample = values[:: max(1, len(values) // sample_size)]
+    if len(set(sample)) > len(sample) // 2:
+        series = pd.Series(values)
+        is_str = (series.map(type) == str).values
+        normalized = values.copy()
+        normalized[is_str] = series[is_str].str.lower().str.strip().values
+        return normalized
+    codes, uniques = pd.factorize(values)  # NaN and None => -1
+    uniques = np.asarray(uniques, dtype=object)
+    is_str = np.fromiter((type(u) == str for u in uniques), dtype=bool, count=len(uniques))
+    normalized_uniques = np.array([u.lower().strip() if s else u for u, s in zip(uniques, is_str)], dtype=object)
+    take = np.append(is_str, False)[codes]  # code -1 picks the appended False
+    normalized = values.copy()
+    normalized[take] = normalized_uniques[codes[take]]
+    return normalized
+
+
+def normalize_strings(df):
+    # df.applymap(lambda x: x.lower().strip() if pd.notnull(x) and type(x) == str else x), touching only object columns
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        df[col] = normalize_column(df[col].values)
+    return df
+
+
+CHUNK_BYTES = 2**25  # raw bytes parsed per chunk by the streaming reader
+
+
+def read_blocks(filepath, chunk_bytes):
+    """
+    Yield (header, block): the header line and successive blocks of about chunk_bytes raw bytes
+    that end on a record boundary (a newline outside quotes), decompressing .gz files on the fly.
+    """
+    opener = gzip.open if filepath.endswith(".gz") else open
+    with opener(filepath, "rb") as f:
+        header = f.readline()
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            quotes = block.count(b'"')
+            while not block.endswith(b"\n") or quotes % 2:  # quoted fields may contain newlines
+                line = f.readline()
+                if not line:
+                    break
+                block += line
+                quotes += line.count(b'"')
+            yield header, block
+
+
+def filter_block(header, block, columns=None, filter_dict=None, dtype=None):
+    # parse one block and keep the rows passing filter_dict: (kept rows, number of rows parsed, inferred dtypes)
+    # the dtypes are those of the columns with a value in the block, before filtering
+    df = pd.read_csv(io.BytesIO(header + block), usecols=columns, dtype=dtype)
+    num_rows = len(df)
+    dtypes = {col: df[col].dtype for col in df.columns if df[col].notna().any()}
+    if filter_dict is not None:
+        mask = np.ones(num_rows, dtype=bool)
+        for key in filter_dict:
+            mask &= df[key].isin(filter_dict[key]).values
+        df = df[mask]
+    return df, num_rows, dtypes
 
-    return shifted_time
 
+def text_columns(block_dtypes, exclude=()):
+    """
+    Columns whose dtype differs between blocks beyond int/float (e.g. a text column whose values all look
+    like numbers in some block). A full read parses these as text, so they are reread with dtype=str.
+    """
+    columns = []
+    for col in dict.fromkeys(col for dtypes in block_dtypes for col in dtypes):
+        kinds = {dtypes[col] for dtypes in block_dtypes if col in dtypes}
+        if len(kinds) > 1 and not all(pd.api.types.is_numeric_dtype(kind) and not pd.api.types.is_bool_dtype(kind) for kind in kinds):
+            if col not in exclude:
+                columns.append(col)
+    return columns
 
-def read_csv(data_dir, filename, columns=None, lower=True, filter_dict=None, dtype=None, memory_efficient=False):
+
+def scan_blocks(filepath, columns, filter_dict, dtype, chunk_bytes, num_workers):
+    # filter_block over the blocks of filepath: (kept rows in file order, number of rows scanned, dtypes of each block)
+    frames = []
+    block_dtypes = []
+    num_scanned = 0
+
+    def collect(result):
+        nonlocal num_scanned
+        df, num_rows, dtypes = result
+        df.index = df.index + num_scanned
+        frames.append(df)
+        block_dtypes.append(dtypes)
+        num_scanned += num_rows
+
+    if num_workers == 1:
+        for header, block in read_blocks(filepath, chunk_bytes):
+            collect(filter_block(header, block, columns, filter_dict, dtype))
+    else:
+        with mp.Pool(num_workers) as pool:
+            pending = deque()
+            for header, block in read_blocks(filepath, chunk_bytes):
+                pending.append(pool.apply_async(filter_block, (header, block, columns, filter_dict, dtype)))
+                if len(pending) >= 2 * num_workers:
+                    collect(pending.popleft().get())
+            while pending:
+                collect(pending.popleft().get())
+    return frames, num_scanned, block_dtypes
+
+
+def read_csv_chunked(filepath, columns=None, filter_dict=None, chunk_bytes=CHUNK_BYTES, num_workers=None):
+    """
+    Stream filepath in blocks, applying the column selection and filter_dict to each block, so that
+    peak memory is bounded by the blocks in flight plus the kept rows. Blocks are parsed by a pool of
+    num_workers processes (default: the usable CPUs), at most two per worker in flight, and
+    concatenated in file order with the row index of a full read.
+    Each block infers its own dtypes; columns that a block infers differently from a full read (see
+    text_columns) are parsed as text in a second pass, so the result has the dtypes of a full read.
+    Returns (df, number of rows scanned).
+    """
+    if filter_dict is not None:
+        filter_dict = {key: list(values) for key, values in filter_dict.items()}  # picklable (e.g. dict.values())
+    num_workers = num_workers or usable_cpus()
+
+    frames, num_scanned, block_dtypes = scan_blocks(filepath, columns, filter_dict, None, chunk_bytes, num_workers)
+    if not frames:  # header only
+        return pd.read_csv(filepath, usecols=columns), 0
+    reread = text_columns(block_dtypes, exclude=filter_dict or ())
+    if reread:
+        print(f"{os.path.basename(filepath)}: rereading {', '.join(reread)} as text")
+        frames, _, _ = scan_blocks(filepath, columns, filter_dict, dict.fromkeys(reread, str), chunk_bytes, num_workers)
+    return pd.concat(frames), num_scanned
+
+
+def read_csv(data_dir, filename, columns=None, lower=True, filter_dict=None, dtype=None, memory_efficient=False, chunk_bytes=CHUNK_BYTES, num_workers=None):
     filepath = os.path.join(data_dir, filename)
 
     if os.path.exists(filepath) is False:
@@ -73,39 +245,29 @@ def read_csv(data_dir, filename, columns=None, lower=True, filter_dict=None, dty
             print(f"File {filepath} does not exist")
             sys.exit(1)
 
-    if memory_efficient:
-        import dask.dataframe as dd
-        from dask.diagnostics import ProgressBar
-
-        ProgressBar().register()
-
-        if filepath.endswith("gz"):
-            compression = "gzip"
-        else:
-            compression = None
-
-        if dtype:
-            df = dd.read_csv(filepath, blocksize=25e6, dtype=dtype, compression=compression)
-        else:
-            df = dd.read_csv(filepath, blocksize=25e6, compression=compression)
-
+    if memory_efficient:  # filter while streaming the file instead of after loading all of it
+        usecols = columns
         if columns is not None:
-            df = df[columns]
-        if filter_dict is not None:
-            for key in filter_dict:
-                df = df[df[key].isin(filter_dict[key])]
-        df = df.compute()
+            header = pd.read_csv(filepath, nrows=0).columns
+            if not set(columns) <= set(header):  # demo dbs have lowercased column names
+                usecols = [l.lower() for l in columns]
+        df, num_scanned = read_csv_chunked(filepath, columns=usecols, filter_dict=filter_dict, chunk_bytes=chunk_bytes, num_workers=num_workers)
+        if usecols is not columns:
+            df.columns = [l.upper() for l in df.columns]
     else:
         try:
             df = pd.read_csv(filepath, usecols=columns)
         except: # demo dbs have lowercased column names
             df = pd.read_csv(filepath, usecols=[l.lower() for l in columns])
             df.columns = [l.upper() for l in df.columns]
+        num_scanned = len(df)
         if filter_dict is not None:
             for key in filter_dict:
                 df = df[df[key].isin(filter_dict[key])]
+    if filter_dict is not None:
+        print(f"{filename}: {num_scanned} rows scanned, {len(df)} kept")
     if lower:
-        df = df.applymap(lambda x: x.lower().strip() if pd.notnull(x) and type(x) == str else x)
+        df = normalize_strings(df)
     return df
 
 
@@ -0,0 +1,414 @@
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from preprocess_db_mimic_iv import CHARTEVENT2ITEMID, label_mapper
+
+"""
+Synthetic raw MIMIC-IV in the hosp/ and icu/ layout read by Build_MIMIC_IV (no credentialed data needed).
+Only the columns used by preprocess_db_mimic_iv.py are complete; a few unused ones are kept so that
+read_csv(usecols=...) parses realistic rows. Values are random, but ids, time ranges and the
+cardinalities of itemid / icd_code / drug follow MIMIC-IV (Zipf-like frequencies over large dictionaries).
+"""
+
+# share of the event rows (--num_events) given to each event table
+EVENT_SHARES = {
+    "chartevents": 0.55,
+    "labevents": 0.25,
+    "prescriptions": 0.07,
+    "inputevents": 0.06,
+    "outputevents": 0.04,
+    "microbiologyevents": 0.03,
+}
+
+ADMISSION_TYPES = ["ew emer.", "eu observation", "elective", "urgent", "direct emer.", "observation admit", "surgical same day admission", "ambulatory observation"]
+ADMISSION_LOCATIONS = ["emergency room", "physician referral", "transfer from hospital", "walk-in/self referral", "clinic referral", "procedure site"]
+DISCHARGE_LOCATIONS = ["home", "home health care", "skilled nursing facility", "rehab", "died", "hospice", None]
+INSURANCES = ["medicare", "medicaid", "other"]
+LANGUAGES = ["english", "?"]
+MARITAL_STATUSES = ["married", "single", "widowed", "divorced", None]
+CAREUNITS = [
+    "medical intensive care unit (micu)",
+    "surgical intensive care unit (sicu)",
+    "cardiac vascular intensive care unit (cvicu)",
+    "medical/surgical intensive care unit (micu/sicu)",
+    "trauma sicu (tsicu)",
+    "coronary care unit (ccu)",
+    "neuro surgical intensive care unit (neuro sicu)",
+]
+WARDS = ["emergency department", "medicine", "surgery", "cardiology", "neurology", "observation", "discharge lounge"]
+ROUTES = ["po", "iv", "sc", "iv drip", "po/ng", "ih", "tp", "im", "pr", "ng"]
+DOSE_UNITS = ["mg", "ml", "mcg", "unit", "g", "meq", "tab", "cap", "puff", "mmol"]
+LAB_UNITS = ["mg/dl", "meq/l", "%", "k/ul", "g/dl", "iu/l", "sec", "mmol/l", "fl", "pg"]
+CHART_UNITS = ["bpm", "mmhg", "insp/min", "%", "°c", "kg", "cm", "cmh2o", "l/min", "mg/dl"]
+INPUT_UNITS = ["ml", "ml", "mg", "units", "mcg", "grams", "meq"]
+SPECIMENS = ["blood culture", "urine", "sputum", "swab", "mrsa screen", "stool", "bronchoalveolar lavage", "catheter tip-iv", "serology/blood", "tissue"]
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out_dir", required=True, type=str, help="directory receiving hosp/ and icu/")
+    parser.add_argument("--num_patients", default=1000, type=int, help="number of patients in patients.csv")
+    parser.add_argument("--num_events", default=100000, type=int, help="total rows of the event tables (chartevents, labevents, ...)")
+    parser.add_argument("--gzip", action="store_true", help="write .csv.gz files like the PhysioNet download")
+    parser.add_argument("--chunk_size", default=1000000, type=int, help="event rows generated and written at a time")
+    parser.add_argument("--seed", default=0, type=int, help="random seed")
+    args = parser.parse_args()
+    return args
+
+
+def zipf_choice(rng, size, n, a=1.1):
+    # index in [0, n) with Zipf-like frequencies: a few codes/items/drugs dominate, most are rare
+    weights = 1.0 / np.arange(1, n + 1) ** a
+    return rng.choice(n, size=size, p=weights / weights.sum())
+
+
+def format_times(seconds):
+    # seconds since the epoch -> "%Y-%m-%d %H:%M:%S"
+    return pd.Series(np.char.replace(np.datetime_as_string(np.asarray(seconds, dtype="int64").astype("datetime64[s]"), unit="s"), "T", " "))
+
+
+def year_seconds(years):
+    return (np.asarray(years) - 1970).astype("datetime64[Y]").astype("datetime64[s]").astype("int64")
+
+
+def nullable(rng, values, ratio):
+    values = pd.Series(values)
+    return values.where(rng.random(len(values)) >= ratio, None)
+
+
+class SyntheticMIMICIV:
+    def __init__(self, out_dir, num_patients, num_events, gzip=False, chunk_size=1000000, seed=0):
+        self.out_dir = out_dir
+        self.num_patients = num_patients
+        self.num_events = num_events
+        self.gzip = gzip
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(seed)
+        for sub_dir in ["hosp", "icu"]:
+            os.makedirs(os.path.join(out_dir, sub_dir), exist_ok=True)
+
+    def write(self, filename, chunks):
+        # chunks: iterable of DataFrames appended to the same file (gzip members are concatenated)
+        filepath = os.path.join(self.out_dir, filename + (".gz" if self.gzip else ""))
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        num_rows = 0
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(filepath, index=False, header=(i == 0), mode="w" if i == 0 else "a", compression="gzip" if self.gzip else None)
+            num_rows += len(chunk)
+        return num_rows
+
+    def chunked(self, num_rows, make_chunk):
+        for start in range(0, num_rows, self.chunk_size):
+            yield make_chunk(min(self.chunk_size, num_rows - start), start)
+
+    def build_admissions(self):
+        rng = self.rng
+        subject_id = 10000000 + np.arange(self.num_patients)
+        anchor_year = rng.integers(2110, 2190, size=self.num_patients)
+        anchor_age = rng.integers(18, 92, size=self.num_patients)
+        dod_year = anchor_year + rng.integers(0, 4, size=self.num_patients)
+        dod = pd.Series([f"{y}-{m:02d}-{d:02d}" for y, m, d in zip(dod_year, rng.integers(1, 13, size=self.num_patients), rng.integers(1, 29, size=self.num_patients))])
+        self.patients = pd.DataFrame(
+            {
+                "subject_id": subject_id,
+                "gender": rng.choice(["M", "F"], size=self.num_patients),
+                "anchor_age": anchor_age,
+                "anchor_year": anchor_year,
+                "anchor_year_group": "2017 - 2019",
+                "dod": dod.where(rng.random(self.num_patients) < 0.1, None),
+            }
+        )
+
+        # admissions: 1 + Poisson(1.5) per patient, within three years of the anchor year
+        num_adm = 1 + rng.poisson(1.5, size=self.num_patients)
+        adm_subject = np.repeat(subject_id, num_adm)
+        admit = year_seconds(np.repeat(anchor_year, num_adm)) + rng.integers(0, 3 * 365 * 86400, size=len(adm_subject))
+        los = (rng.exponential(4.0, size=len(adm_subject)) + 0.5) * 86400
+        n = len(adm_subject)
+        self.adm = pd.DataFrame({"subject_id": adm_subject, "hadm_id": 20000000 + np.arange(n), "admit": admit, "disch": admit + los.astype("int64")})
+        admissions = pd.DataFrame(
+            {
+                "subject_id": adm_subject,
+                "hadm_id": self.adm["hadm_id"],
+                "admittime": format_times(admit),
+                "dischtime": format_times(self.adm["disch"]),
+                "deathtime": None,
+                "admission_type": rng.choice(ADMISSION_TYPES, size=n),
+                "admit_provider_id": None,
+                "admission_location": rng.choice(ADMISSION_LOCATIONS, size=n),
+                "discharge_location": rng.choice(np.array(DISCHARGE_LOCATIONS, dtype=object), size=n),
+                "insurance": rng.choice(INSURANCES, size=n),
+                "language": rng.choice(LANGUAGES, size=n, p=[0.9, 0.1]),
+                "marital_status": rng.choice(np.array(MARITAL_STATUSES, dtype=object), size=n),
+                "race": "white",
+                "hospital_expire_flag": 0,
+            }
+        )
+
+        # icustays: 40% of the admissions, inside the admission
+        icu_adm = self.adm[rng.random(n) < 0.4].reset_index(drop=True)
+        intime = icu_adm["admit"] + (rng.random(len(icu_adm)) * 0.5 * (icu_adm["disch"] - icu_adm["admit"])).astype("int64")
+        outtime = np.minimum(intime + ((rng.exponential(2.0, size=len(icu_adm)) + 0.2) * 86400).astype("int64"), icu_adm["disch"])
+        self.icu = pd.DataFrame({"subject_id": icu_adm["subject_id"], "hadm_id": icu_adm["hadm_id"], "stay_id": 30000000 + np.arange(len(icu_adm)), "intime": intime, "outtime": outtime})
+        first_careunit = rng.choice(CAREUNITS, size=len(icu_adm))
+        icustays = pd.DataFrame(
+            {
+                "subject_id": self.icu["subject_id"],
+                "hadm_id": self.icu["hadm_id"],
+                "stay_id": self.icu["stay_id"],
+                "first_careunit": first_careunit,
+                "last_careunit": np.where(rng.random(len(icu_adm)) < 0.9, first_careunit, rng.choice(CAREUNITS, size=len(icu_adm))),
+                "intime": format_times(intime),
+                "outtime": format_times(outtime),
+                "los": (outtime - intime) / 86400,
+            }
+        )
+
+        # transfers: admit, 0-3 transfers and discharge per admission
+        num_transfers = 2 + rng.integers(0, 4, size=n)
+        idx = np.repeat(np.arange(n), num_transfers)
+        rank = np.concatenate([np.arange(k) for k in num_transfers])
+        last = np.repeat(num_transfers - 1, num_transfers)
+        span = (self.adm["disch"].values - self.adm["admit"].values)[idx]
+        t_in = self.adm["admit"].values[idx] + (span * rank / np.maximum(last, 1)).astype("int64")
+        t_out = self.adm["admit"].values[idx] + (span * (rank + 1) / np.maximum(last, 1)).astype("int64")
+        eventtype = np.where(rank == 0, "admit", np.where(rank == last, "discharge", "transfer"))
+        transfers = pd.DataFrame(
+            {
+                "subject_id": self.adm["subject_id"].values[idx],
+                "hadm_id": self.adm["hadm_id"].values[idx],
+                "transfer_id": 30000000 + np.arange(len(idx)),
+                "eventtype": eventtype,
+                "careunit": np.where(eventtype == "discharge", None, rng.choice(WARDS + CAREUNITS, size=len(idx))),
+                "intime": format_times(t_in),
+                "outtime": format_times(t_out).where(eventtype != "discharge", None),
+            }
+        )
+
+        return {
+            "hosp/patients.csv": self.write("hosp/patients.csv", [self.patients]),
+            "hosp/admissions.csv": self.write("hosp/admissions.csv", [admissions]),
+            "icu/icustays.csv": self.write("icu/icustays.csv", [icustays]),
+            "hosp/transfers.csv": self.write("hosp/transfers.csv", [transfers]),
+        }
+
+    def build_dictionaries(self, num_diagnoses=20000, num_procedures=8000, num_labitems=1600, num_items=4000, num_drugs=3000):
+        rng = self.rng
+        counts = {}
+        for filename, num_codes, prefix in [("hosp/d_icd_diagnoses.csv", num_diagnoses, "diagnosis"), ("hosp/d_icd_procedures.csv", num_procedures, "procedure")]:
+            version = np.where(np.arange(num_codes) % 2 == 0, 9, 10)
+            table = pd.DataFrame({"icd_code": [f"{'V' if v == 9 else 'Z'}{i:05d}" for i, v in enumerate(version)], "icd_version": version, "long_title": [f"synthetic {prefix} {i}" for i in range(num_codes)]})
+            counts[filename] = self.write(filename, [table])
+            setattr(self, prefix + "_codes", table[["icd_code", "icd_version"]])
+
+        # lab items: real names with a lab/input/prescription ambiguity plus synthetic ones
+        lab_names = [label for label in label_mapper][: num_labitems // 10]
+        labels = lab_names + [f"lab test {i}" for i in range(num_labitems - len(lab_names))]
+        self.labitems = pd.DataFrame({"itemid": 50800 + np.arange(num_labitems), "label": labels, "fluid": "blood", "category": "chemistry"})
+        self.lab_units = rng.choice(LAB_UNITS, size=num_labitems)
+        counts["hosp/d_labitems.csv"] = self.write("hosp/d_labitems.csv", [self.labitems])
+
+        # icu items: the vital signs used by the queries, then a mix of chart, input and output items
+        vital_ids = list(CHARTEVENT2ITEMID.values())
+        vital_labels = list(CHARTEVENT2ITEMID.keys())
+        other_ids = [itemid for itemid in 220000 + np.arange(num_items + len(vital_ids)) if itemid not in vital_ids][: num_items - len(vital_ids)]
+        linksto = rng.choice(["chartevents", "inputevents", "outputevents", "procedureevents", "datetimeevents"], size=len(other_ids), p=[0.6, 0.2, 0.08, 0.07, 0.05])
+        input_names = [label for label in label_mapper if label_mapper[label] == "inputevents"]
+        other_labels = [input_names.pop() if link == "inputevents" and input_names else f"{link[:-6]} item {i}" for i, link in enumerate(linksto)]
+        self.items = pd.DataFrame(
+            {
+                "itemid": vital_ids + other_ids,
+                "label": vital_labels + other_labels,
+                "abbreviation": [label[:12] for label in vital_labels + other_labels],
+                "linksto": ["chartevents"] * len(vital_ids) + list(linksto),
+                "category": "routine vital signs",
+                "unitname": None,
+            }
+        )
+        counts["icu/d_items.csv"] = self.write("icu/d_items.csv", [self.items])
+        self.vital_ids = np.array(vital_ids)
+        self.chart_ids = self.items["itemid"].values[self.items["linksto"].values == "chartevents"]
+        self.input_ids = self.items["itemid"].values[self.items["linksto"].values == "inputevents"]
+        self.output_ids = self.items["itemid"].values[self.items["linksto"].values == "outputevents"]
+
+        drug_names = [label for label in label_mapper]
+        self.drugs = np.array(drug_names + [f"drug {i}" for i in range(num_drugs - len(drug_names))])
+        self.drug_units = rng.choice(DOSE_UNITS, size=num_drugs)
+        return counts
+
+    def build_diagnoses_procedures(self):
+        rng = self.rng
+        counts = {}
+        for filename, codes, lam in [("hosp/diagnoses_icd.csv", self.diagnosis_codes, 8), ("hosp/procedures_icd.csv", self.procedure_codes, 2)]:
+            num_codes = rng.poisson(lam, size=len(self.adm))
+            idx = np.repeat(np.arange(len(self.adm)), num_codes)
+            code = codes.iloc[zipf_choice(rng, len(idx), len(codes))]
+            table = pd.DataFrame(
+                {
+                    "subject_id": self.adm["subject_id"].values[idx],
+                    "hadm_id": self.adm["hadm_id"].values[idx],
+                    "seq_num": np.concatenate([np.arange(1, k + 1) for k in num_codes]) if len(idx) else [],
+                    "icd_code": code["icd_code"].values,
+                    "icd_version": code["icd_version"].values,
+                }
+            )
+            if filename == "hosp/procedures_icd.csv":
+                charttime = self.adm["admit"].values[idx] + (rng.random(len(idx)) * (self.adm["disch"].values - self.adm["admit"].values)[idx]).astype("int64")
+                table.insert(3, "chartdate", format_times(charttime).str[:10])
+            counts[filename] = self.write(filename, [table])
+        return counts
+
+    def event_times(self, stays, idx, start_col, end_col):
+        span = stays[end_col].values[idx] - stays[start_col].values[idx]
+        return stays[start_col].values[idx] + (self.rng.random(len(idx)) * span).astype("int64")
+
+    def build_events(self):
+        rng = self.rng
+        num_rows = {table: int(self.num_events * share) for table, share in EVENT_SHARES.items()}
+
+        def labevents(size, start):
+            idx = rng.integers(0, len(self.adm), size=size)
+            item = zipf_choice(rng, size, len(self.labitems))
+            valuenum = nullable(rng, np.round(rng.normal(50, 20, size=size), 2), 0.05)
+            return pd.DataFrame(
+                {
+                    "labevent_id": start + np.arange(size),
+                    "subject_id": self.adm["subject_id"].values[idx],
+                    "hadm_id": pd.Series(self.adm["hadm_id"].values[idx], dtype="Int64").where(rng.random(size) >= 0.2, pd.NA),  # outpatient labs have no hadm_id
+                    "specimen_id": rng.integers(0, 10**8, size=size),
+                    "itemid": self.labitems["itemid"].values[item],
+                    "charttime": format_times(self.event_times(self.adm, idx, "admit", "disch")),
+                    "value": valuenum.astype(str),
+                    "valuenum": valuenum,
+                    "valueuom": self.lab_units[item],
+                    "flag": nullable(rng, np.full(size, "abnormal"), 0.7),
+                }
+            )
+
+        def prescriptions(size, start):
+            idx = rng.integers(0, len(self.adm), size=size)
+            drug = zipf_choice(rng, size, len(self.drugs))
+            starttime = self.event_times(self.adm, idx, "admit", "disch")
+            dose = rng.integers(1, 2000, size=size).astype(str)
+            dose = np.where(rng.random(size) < 0.05, np.char.add(dose, "-2"), dose)  # ranges are dropped by the preprocessing
+            dose = np.where(np.char.str_len(dose) == 4, [f"{d[0]},{d[1:]}" for d in dose], dose)  # "1,000"
+            return pd.DataFrame(
+                {
+                    "subject_id": self.adm["subject_id"].values[idx],
+                    "hadm_id": self.adm["hadm_id"].values[idx],
+                    "pharmacy_id": start + np.arange(size),
+                    "starttime": format_times(starttime),
+                    "stoptime": format_times(starttime + rng.integers(3600, 7 * 86400, size=size)),
+                    "drug_type": "main",
+                    "drug": self.drugs[drug],
+                    "dose_val_rx": dose,
+                    "dose_unit_rx": np.where(rng.random(size) < 0.9, self.drug_units[drug], rng.choice(DOSE_UNITS, size=size)),
+                    "route": rng.choice(ROUTES, size=size),
+                }
+            )
+
+        def chartevents(size, start):
+            idx = rng.integers(0, len(self.icu), size=size)
+            vital = rng.random(size) < 0.5
+            itemid = np.where(vital, self.vital_ids[rng.integers(0, len(self.vital_ids), size=size)], self.chart_ids[zipf_choice(rng, size, len(self.chart_ids))])
+            valuenum = np.round(rng.normal(80, 25, size=size), 1)
+            return pd.DataFrame(
+                {
+                    "subject_id": self.icu["subject_id"].values[idx],
+                    "hadm_id": self.icu["hadm_id"].values[idx],
+                    "stay_id": self.icu["stay_id"].values[idx],
+                    "caregiver_id": rng.integers(1, 5000, size=size),
+                    "charttime": format_times(self.event_times(self.icu, idx, "intime", "outtime")),
+                    "itemid": itemid,
+                    "value": valuenum.astype(str),
+                    "valuenum": valuenum,
+                    "valueuom": np.array(CHART_UNITS)[itemid % len(CHART_UNITS)],
+                    "warning": 0,
+                }
+            )
+
+        def inputevents(size, start):
+            idx = rng.integers(0, len(self.icu), size=size)
+            starttime = self.event_times(self.icu, idx, "intime", "outtime")
+            return pd.DataFrame(
+                {
+                    "subject_id": self.icu["subject_id"].values[idx],
+                    "hadm_id": self.icu["hadm_id"].values[idx],
+                    "stay_id": self.icu["stay_id"].values[idx],
+                    "starttime": format_times(starttime),
+                    "endtime": format_times(starttime + rng.integers(60, 86400, size=size)),
+                    "itemid": self.input_ids[zipf_choice(rng, size, len(self.input_ids))],
+                    "amount": np.round(rng.exponential(100, size=size), 2),
+                    "orderid": start + np.arange(size),
+                    "totalamount": np.round(rng.exponential(250, size=size), 2),
+                    "totalamountuom": rng.choice(INPUT_UNITS, size=size),
+                }
+            )
+
+        def outputevents(size, start):
+            idx = rng.integers(0, len(self.icu), size=size)
+            return pd.DataFrame(
+                {
+                    "subject_id": self.icu["subject_id"].values[idx],
+                    "hadm_id": self.icu["hadm_id"].values[idx],
+                    "stay_id": self.icu["stay_id"].values[idx],
+                    "charttime": format_times(self.event_times(self.icu, idx, "intime", "outtime")),
+                    "itemid": self.output_ids[zipf_choice(rng, size, len(self.output_ids))],
+                    "value": np.round(rng.exponential(200, size=size), 1),
+                    "valueuom": "ml",
+                }
+            )
+
+        def microbiologyevents(size, start):
+            idx = rng.integers(0, len(self.adm), size=size)
+            charttime = format_times(self.event_times(self.adm, idx, "admit", "disch"))
+            return pd.DataFrame(
+                {
+                    "microevent_id": start + np.arange(size),
+                    "subject_id": self.adm["subject_id"].values[idx],
+                    "hadm_id": pd.Series(self.adm["hadm_id"].values[idx], dtype="Int64").where(rng.random(size) >= 0.3, pd.NA),
+                    "chartdate": charttime.str[:10] + " 00:00:00",
+                    "charttime": charttime.where(rng.random(size) >= 0.15, None),
+                    "spec_type_desc": rng.choice(SPECIMENS, size=size),
+                    "test_name": np.char.add("test ", zipf_choice(rng, size, 120).astype(str)),
+                    "org_name": nullable(rng, np.char.add("organism ", zipf_choice(rng, size, 250).astype(str)), 0.6),
+                }
+            )
+
+        counts = {}
+        for filename, make_chunk in [
+            ("hosp/labevents.csv", labevents),
+            ("hosp/prescriptions.csv", prescriptions),
+            ("icu/chartevents.csv", chartevents),
+            ("icu/inputevents.csv", inputevents),
+            ("icu/outputevents.csv", outputevents),
+            ("hosp/microbiologyevents.csv", microbiologyevents),
+        ]:
+            table = os.path.basename(filename)[:-4]
+            counts[filename] = self.write(filename, self.chunked(num_rows[table], make_chunk))
+        return counts
+
+    def generate(self):
+        counts = {}
+        for name, build in [("admissions", self.build_admissions), ("dictionaries", self.build_dictionaries), ("diagnoses/procedures", self.build_diagnoses_procedures), ("events", self.build_events)]:
+            start_time = time.time()
+            counts.update(build())
+            print(f"{name} generated (took {round(time.time() - start_time, 4)} secs)")
+        return counts
+
+
+def main(args):
+    generator = SyntheticMIMICIV(args.out_dir, args.num_patients, args.num_events, gzip=args.gzip, chunk_size=args.chunk_size, seed=args.seed)
+    counts = generator.generate()
+    for filename, num_rows in counts.items():
+        print(f"{filename}: {num_rows} rows")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
+    print("Done!\n")
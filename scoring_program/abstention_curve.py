@@ -0,0 +1,62 @@
+# Accuracy of a submission with confidence scores for every abstention threshold and penalty:
+# the queries are executed once, then the threshold x penalty surface is computed without executing SQL again
+
+import os
+import json
+import argparse
+import numpy as np
+from scorer import execute, penalty_values, PENALTIES
+from reliability import score_vector, abstention_vector, threshold_surface
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--label_path", required=True, type=str, help="label.json with the gold SQL")
+    parser.add_argument("--prediction_path", required=True, type=str, help="prediction.json with the predicted SQL")
+    parser.add_argument("--confidence_path", required=True, type=str, help="JSON file {id: confidence}; ids without one are always answered")
+    parser.add_argument("--db_path", default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'mimic_iv.sqlite'), type=str, help="database the queries are executed on")
+    parser.add_argument("--num_thresholds", default=0, type=int, help="evenly spaced thresholds between the lowest and highest confidence (0: every distinct confidence)")
+    parser.add_argument("--penalties", default=PENALTIES, nargs="+", type=str, help="penalty levels (N: number of questions)")
+    parser.add_argument("--num_workers", default=None, type=int, help="worker processes (default: sized from the usable CPUs and memory)")
+    parser.add_argument("--output", default="abstention_curve.json", type=str, help="where to write the surface")
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    real_result, pred_result = execute(args.label_path, args.prediction_path, args.db_path, reference_dir=os.path.dirname(os.path.abspath(args.label_path)), num_workers=args.num_workers)
+    with open(args.confidence_path) as f:
+        confidence_dict = json.load(f)
+
+    keys = list(real_result)
+    confidence = np.array([confidence_dict.get(key, np.inf) for key in keys], dtype=np.float64)
+    answered = score_vector(real_result, pred_result, keys=keys)
+    abstained = abstention_vector(real_result, keys=keys)
+
+    finite = confidence[np.isfinite(confidence)]
+    if args.num_thresholds > 0 and len(finite) > 0:
+        thresholds = np.linspace(finite.min(), finite.max(), args.num_thresholds)
+    else:
+        thresholds = np.unique(finite)
+    thresholds = np.concatenate([[-np.inf], thresholds, [np.inf]]) # answer everything / abstain wherever a confidence is given
+    penalties = penalty_values(args.penalties, len(keys))
+    surface = threshold_surface(answered, abstained, confidence, thresholds, penalties) * 100
+
+    best = surface.argmax(axis=0)
+    report = {
+        'num_questions': len(keys),
+        'penalties': args.penalties,
+        'thresholds': thresholds.tolist(),
+        'accuracy': {'accuracy%s' % penalty: surface[:, j].tolist() for j, penalty in enumerate(args.penalties)},
+        'best': {'accuracy%s' % penalty: {'threshold': float(thresholds[best[j]]), 'accuracy': float(surface[best[j], j])} for j, penalty in enumerate(args.penalties)},
+    }
+    for j, penalty in enumerate(args.penalties):
+        print(f"accuracy{penalty}: {surface[0, j]:.3f} answering everything, {surface[best[j], j]:.3f} at threshold {thresholds[best[j]]:.4g}")
+    with open(args.output, 'w') as f:
+        json.dump(report, f)
+    print(f"{len(thresholds)} thresholds x {len(penalties)} penalties written to {args.output}")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
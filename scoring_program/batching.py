@@ -0,0 +1,171 @@
+# Template batching: queries that differ only in their literals run as one statement over a VALUES CTE
+
+import time
+from itertools import groupby
+from operator import itemgetter
+from sql_shape import tokenize, split_literals, is_literal
+from scoring_utils import execute_sql, canonicalize_rows, profile_record
+from result_store import store_result
+
+MAX_BATCH_SIZE = 200 # queries per batched statement
+BATCH_PREFIX = '_batch'
+# with these the result of one query is not guaranteed to equal its rows in the batched statement
+# (ties under ORDER BY ... LIMIT, per-statement functions, collations overriding the literal's)
+UNSAFE_KEYWORDS = {'GROUP', 'ORDER', 'LIMIT', 'OFFSET', 'HAVING', 'UNION', 'INTERSECT', 'EXCEPT', 'WITH', 'WINDOW', 'OVER', 'FILTER', 'COLLATE', 'RANDOM', 'RANDOMBLOB', 'CHANGES', 'LAST_INSERT_ROWID'}
+# aggregates whose value does not depend on the order in which rows are visited
+SAFE_AGGREGATES = {'COUNT', 'MIN', 'MAX'}
+AGGREGATES = SAFE_AGGREGATES | {'SUM', 'AVG', 'TOTAL', 'GROUP_CONCAT', 'STRING_AGG'}
+
+
+def select_items(tokens, start, end):
+    # top-level comma-separated items of tokens[start:end]
+    items, depth, item_start = [], 0, start
+    for i in range(start, end):
+        text = tokens[i][1]
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+        elif text == ',' and depth == 0:
+            items.append((item_start, i))
+            item_start = i + 1
+    items.append((item_start, end))
+    return items
+
+def is_aggregate_call(tokens, start, end):
+    # the whole item is COUNT(...), MIN(x) or MAX(x)
+    if end - start < 3 or tokens[start][1].upper() not in SAFE_AGGREGATES or tokens[start + 1][1] != '(' or tokens[end - 1][1] != ')':
+        return False
+    depth = 0
+    for i in range(start + 1, end):
+        text = tokens[i][1]
+        depth += 1 if text == '(' else -1 if text == ')' else 0
+        if depth == 0 and i != end - 1:
+            return False
+        if text == ',' and depth == 1 and tokens[start][1].upper() != 'COUNT':
+            return False # min(a, b) / max(a, b) are scalar functions
+    return True
+
+def analyze(sql):
+    # batchable queries: a single SELECT ... FROM ... WHERE ... whose select list is either free of
+    # aggregates or made only of COUNT/MIN/MAX calls. Returns (tokens, index of FROM, aggregate) or None.
+    tokens = tokenize(sql)
+    keywords = [text.upper() for kind, text, _ in tokens if kind == 'identifier']
+    if not tokens or tokens[0][1].upper() != 'SELECT' or keywords.count('SELECT') != 1 or 'WHERE' not in keywords:
+        return None
+    if UNSAFE_KEYWORDS & set(keywords) or any(keyword.startswith(BATCH_PREFIX.upper()) for keyword in keywords):
+        return None
+    if any(kind == 'operator' and text == ';' for kind, text, _ in tokens):
+        return None
+    if any(kind == 'comment' for kind, _, _ in tokens): # a trailing -- comment would swallow the GROUP BY / ORDER BY appended to the batch
+        return None
+
+    start = 2 if len(tokens) > 1 and tokens[1][1].upper() in ('DISTINCT', 'ALL') else 1
+    depth, from_index = 0, None
+    for i in range(start, len(tokens)):
+        text = tokens[i][1]
+        depth += 1 if text == '(' else -1 if text == ')' else 0
+        if depth == 0 and text.upper() == 'FROM':
+            from_index = i
+            break
+    if from_index is None:
+        return None
+
+    items = select_items(tokens, start, from_index)
+    aggregates = [is_aggregate_call(tokens, item_start, item_end) for item_start, item_end in items]
+    if any(aggregates) and not all(aggregates):
+        return None
+    for item_start, item_end in items:
+        if item_end - item_start == 0 or tokens[item_end - 1][1] == '*': # * or t.* would also expand to the batch columns
+            return None
+    if not any(aggregates) and any(tokens[i][1].upper() in AGGREGATES and i + 1 < len(tokens) and tokens[i + 1][1] == '(' for i in range(len(tokens))):
+        return None
+    return tokens, from_index, all(aggregates)
+
+def group_batches(sql_list, max_batch_size=MAX_BATCH_SIZE):
+    # batchable queries grouped by shape; returns ([group of sql, ...], [sql executed one by one, ...])
+    groups, singles = {}, []
+    for sql in sql_list:
+        if analyze(sql) is None:
+            singles.append(sql)
+            continue
+        shape, _ = split_literals(sql)
+        groups.setdefault(shape, []).append(sql)
+    batches = []
+    for shape, group in groups.items():
+        if len(group) < 2:
+            singles.extend(group)
+            continue
+        for i in range(0, len(group), max_batch_size):
+            batch = group[i:i + max_batch_size]
+            if len(batch) < 2:
+                singles.extend(batch)
+            else:
+                batches.append(batch)
+    return batches, singles
+
+def batched_sql(sqls):
+    # Literal positions that differ between the queries become columns of the _batch CTE; the others stay
+    # inline. Each row of the batch carries the literal text of one query, so the values compared are the
+    # ones SQLite would parse from that query (a CTE column over literals has no affinity or collation,
+    # like the literal itself).
+    tokens, from_index, aggregate = analyze(sqls[0])
+    literal_lists = [split_literals(sql)[1] for sql in sqls]
+    varying = [i for i in range(len(literal_lists[0])) if len(set(literals[i] for literals in literal_lists)) > 1]
+    columns = {i: '%s.%s_p%d' % (BATCH_PREFIX, BATCH_PREFIX, k) for k, i in enumerate(varying)}
+
+    sql = sqls[0]
+    parts, last, literal_index = [], 0, 0
+    for token_index, (kind, text, start) in enumerate(tokens):
+        if token_index == from_index:
+            parts.append(sql[last:start + len(text)])
+            parts.append(' %s,' % BATCH_PREFIX)
+            last = start + len(text)
+        elif token_index == (2 if tokens[1][1].upper() in ('DISTINCT', 'ALL') else 1):
+            parts.append(sql[last:start])
+            parts.append('%s.%s_id, ' % (BATCH_PREFIX, BATCH_PREFIX))
+            last = start
+        if is_literal(kind, text):
+            if literal_index in columns:
+                parts.append(sql[last:start])
+                parts.append(columns[literal_index])
+                last = start + len(text)
+            literal_index += 1
+    parts.append(sql[last:])
+
+    header = ', '.join(['%s_id' % BATCH_PREFIX] + ['%s_p%d' % (BATCH_PREFIX, k) for k in range(len(varying))])
+    values = ', '.join('(%s)' % ', '.join([str(batch_id)] + [literal_lists[batch_id][i] for i in varying]) for batch_id in range(len(sqls)))
+    group_by = ' GROUP BY %s.%s_id' % (BATCH_PREFIX, BATCH_PREFIX) if aggregate else ''
+    return 'WITH %s(%s) AS (VALUES %s) %s%s ORDER BY %s.%s_id' % (BATCH_PREFIX, header, values, ''.join(parts), group_by, BATCH_PREFIX, BATCH_PREFIX), aggregate
+
+def split_batch(rows):
+    # rows ordered by batch id -> {batch id: CanonicalResult of the rows of that query}
+    return {batch_id: canonicalize_rows(row[1:] for row in group) for batch_id, group in groupby(rows, key=itemgetter(0))}
+
+def execute_batch(sqls, db_path, timeout=None, max_steps=None, profile=False):
+    # returns (sqls, {sql: CanonicalResult} or None if the batch failed, elapsed, profile record or None);
+    # queries missing from the result of an aggregate batch (no matching rows, so no group) are left out
+    # and have to be run one by one
+    stats = {} if profile else None
+    start_time = time.time()
+    sql = None
+    try:
+        sql, aggregate = batched_sql(sqls)
+        # the batch gets the budget of one query, so that a group of slow queries cannot hold a worker for
+        # len(sqls) budgets; once it runs out, the queries run one by one with their own budgets
+        results = execute_sql(sql, db_path, timeout=timeout, max_steps=max_steps, consume=split_batch, stats=stats)
+    except Exception: # including QueryTimeout
+        results = None
+    elapsed = time.time() - start_time
+    record = profile_record(sql, db_path, stats, elapsed, 'batch' if results is not None else 'batch_failed') if profile and sql is not None else None
+    if results is None:
+        return (sqls, None, elapsed, record)
+    outcomes = {}
+    for batch_id, sql in enumerate(sqls):
+        if batch_id in results:
+            outcomes[sql] = results[batch_id]
+        elif not aggregate:
+            outcomes[sql] = canonicalize_rows([])
+        if sql in outcomes:
+            store_result(sql, outcomes[sql], elapsed / len(sqls))
+    return (sqls, outcomes, elapsed, record)
@@ -0,0 +1,93 @@
+# Paired bootstrap comparison of two submissions: confidence intervals of each accuracy and of their
+# difference, and a two-sided p-value, for every penalty level
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from scorer import execute_many, penalty_values, PENALTIES
+from reliability import score_vector
+
+NUM_RESAMPLES = 10000
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--label_path", required=True, type=str, help="label.json with the gold SQL")
+    parser.add_argument("--prediction_paths", required=True, nargs=2, type=str, help="the two prediction.json files to compare (A B)")
+    parser.add_argument("--db_path", default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'mimic_iv.sqlite'), type=str, help="database the queries are executed on")
+    parser.add_argument("--num_resamples", default=NUM_RESAMPLES, type=int, help="bootstrap resamples")
+    parser.add_argument("--confidence", default=0.95, type=float, help="confidence level of the intervals")
+    parser.add_argument("--penalties", default=PENALTIES, nargs="+", type=str, help="penalty levels (N: number of questions)")
+    parser.add_argument("--seed", default=0, type=int, help="seed of the resampling")
+    parser.add_argument("--num_workers", default=None, type=int, help="worker processes (default: sized from the usable CPUs and memory)")
+    parser.add_argument("--output", default="bootstrap_compare.json", type=str, help="where to write the report")
+    args = parser.parse_args()
+    return args
+
+
+def resampled_counts(score_matrix, num_resamples, seed=0):
+    # score_matrix: (systems, questions) scores; the same resampled questions are used for every system
+    # (paired). Returns the numbers of correct (score 1) and wrong (score -1) answers, each (resamples, systems).
+    # A resample only matters through how many questions of each joint outcome (e.g. A correct, B wrong) it
+    # draws, and those counts follow a multinomial over the observed outcome frequencies, so they are drawn
+    # directly instead of drawing questions: the cost no longer grows with the number of questions.
+    rng = np.random.default_rng(seed)
+    num_questions = score_matrix.shape[1]
+    outcomes, frequency = np.unique(score_matrix, axis=1, return_counts=True) # (systems, outcomes), (outcomes,)
+    draws = rng.multinomial(num_questions, frequency / num_questions, size=num_resamples) # (resamples, outcomes)
+    return draws @ (outcomes == 1).T, draws @ (outcomes == -1).T
+
+def paired_bootstrap(score_matrix, penalties, num_resamples=NUM_RESAMPLES, confidence=0.95, seed=0):
+    # accuracies (in percent) of each system and of the difference B - A for every penalty
+    num_questions = score_matrix.shape[1]
+    penalties = np.asarray(penalties, dtype=np.float64)
+    num_correct, num_wrong = resampled_counts(score_matrix, num_resamples, seed=seed)
+    # (resamples, systems, penalties)
+    accuracy = (num_correct[:, :, None] - num_wrong[:, :, None] * penalties[None, None, :]) / num_questions * 100
+    observed = ((score_matrix == 1).sum(axis=1)[:, None] - (score_matrix == -1).sum(axis=1)[:, None] * penalties[None, :]) / num_questions * 100
+    difference = accuracy[:, 1] - accuracy[:, 0]
+    alpha = (1 - confidence) / 2
+    quantiles = [alpha * 100, (1 - alpha) * 100]
+    return {
+        'observed': observed,
+        'interval': np.percentile(accuracy, quantiles, axis=0), # (2, systems, penalties)
+        'difference': observed[1] - observed[0],
+        'difference_interval': np.percentile(difference, quantiles, axis=0), # (2, penalties)
+        # two-sided: how often the resampled difference falls on either side of zero
+        'p_value': np.minimum(1.0, 2 * np.minimum((difference <= 0).mean(axis=0), (difference >= 0).mean(axis=0))),
+    }
+
+
+def main(args):
+    start_time = time.time()
+    real_result, pred_results = execute_many(args.label_path, args.prediction_paths, args.db_path, reference_dir=os.path.dirname(os.path.abspath(args.label_path)), num_workers=args.num_workers)
+    execute_secs = time.time() - start_time
+
+    keys = list(real_result)
+    score_matrix = np.stack([score_vector(real_result, pred_result, keys=keys) for pred_result in pred_results])
+    start_time = time.time()
+    stats = paired_bootstrap(score_matrix, penalty_values(args.penalties, len(keys)), num_resamples=args.num_resamples, confidence=args.confidence, seed=args.seed)
+    bootstrap_secs = time.time() - start_time
+
+    report = {'prediction_paths': args.prediction_paths, 'num_questions': len(keys), 'num_resamples': args.num_resamples, 'confidence': args.confidence,
+              'execute_secs': execute_secs, 'bootstrap_secs': bootstrap_secs, 'penalties': {}}
+    for j, penalty in enumerate(args.penalties):
+        report['penalties']['accuracy%s' % penalty] = {
+            'A': stats['observed'][0, j], 'A_interval': stats['interval'][:, 0, j].tolist(),
+            'B': stats['observed'][1, j], 'B_interval': stats['interval'][:, 1, j].tolist(),
+            'B_minus_A': stats['difference'][j], 'B_minus_A_interval': stats['difference_interval'][:, j].tolist(),
+            'p_value': stats['p_value'][j],
+        }
+    for name, item in report['penalties'].items():
+        print('%s: A %.2f [%.2f, %.2f]  B %.2f [%.2f, %.2f]  B-A %.2f [%.2f, %.2f]  p=%.4f' % (
+            name, item['A'], *item['A_interval'], item['B'], *item['B_interval'], item['B_minus_A'], *item['B_minus_A_interval'], item['p_value']))
+    print(f"{args.num_resamples} resamples in {bootstrap_secs:.3f} secs (execution {execute_secs:.2f} secs)")
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, default=float)
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
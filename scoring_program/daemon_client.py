@@ -0,0 +1,56 @@
+# Client of scoring_daemon.py; takes the same arguments as scoring.py and writes the same scores.json
+
+import os
+import sys
+import json
+import socket
+
+DEFAULT_SOCKET = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'scoring.sock')
+
+
+def connect(socket_path=DEFAULT_SOCKET, port=None, timeout=None):
+    if port is not None:
+        return socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def request_scores(reference_dir, prediction_dir, socket_path=DEFAULT_SOCKET, port=None, timeout=None):
+    # scores dict computed by the daemon, or None if no daemon is reachable or it could not score the request
+    with open(os.path.join(prediction_dir, 'prediction.json')) as f:
+        pred_dict = json.load(f)
+    request = {'reference_dir': os.path.abspath(reference_dir), 'prediction': pred_dict}
+    try:
+        with connect(socket_path, port=port, timeout=timeout) as sock:
+            sock.sendall((json.dumps(request) + '\n').encode())
+            with sock.makefile('rb') as f:
+                line = f.readline()
+    except OSError:
+        return None
+    try:
+        response = json.loads(line)
+    except ValueError:
+        return None
+    if 'error' in response:
+        print('scoring daemon: %s' % response['error'])
+        return None
+    return response['scores']
+
+
+if __name__ == "__main__":
+    reference_dir = os.path.join(sys.argv[1], 'ref')
+    prediction_dir = os.path.join(sys.argv[1], 'res')
+    score_dir = sys.argv[2]
+
+    scores_dict = request_scores(reference_dir, prediction_dir)
+    if scores_dict is None:
+        raise Exception('No scoring daemon reachable at %s' % DEFAULT_SOCKET)
+    print('Scores:')
+    print(scores_dict)
+    with open(os.path.join(score_dir, 'scores.json'), 'w') as score_file:
+        score_file.write(json.dumps(scores_dict))
@@ -15,10 +15,10 @@ PRECOMPUTED_DICT = {
 TIME_PATTERN = r"(DATE_SUB|DATE_ADD)\((\w+\(\)|'[^']+')[, ]+ INTERVAL (\d+) (MONTH|YEAR|DAY)\)"
 
 def convert_date_function(match):
-    function = match.group(1)
-    date = match.group(2)
-    number = match.group(3)
-    unit = match.group(4).lower()
+    return date_function_sql(match.group(1), match.group(2), match.group(3), match.group(4))
+
+def date_function_sql(function, date, number, unit):
+    unit = unit.lower()
     
     # Use singular form when number is 1
     if number == '1':
@@ -31,37 +31,52 @@ def convert_date_function(match):
     
     return f"datetime({date}, '{sign}{number} {unit}')"
 
-def post_process_sql(query):
+# MySQL date/time functions and strftime formats rewritten in the single pass of post_process_sql, mapped to their SQLite form
+REPLACEMENTS = {
+    '> =': '>=',
+    '< =': '<=',
+    '! =': '!=',
+    "current_time": f"'{NOW}'", # strftime('%J',current_time) => strftime('%J','2100-12-31 23:59:00')
+    "current_date": f"'{CURRENT_DATE}'", # strftime('%J',current_date) => strftime('%J','2100-12-31')
+    "'now'": f"'{NOW}'", # 'now' => '2100-12-31 23:59:00'
+    "NOW()": f"'{NOW}'", # NOW() => '2100-12-31 23:59:00'
+    "CURDATE()": f"'{CURRENT_DATE}'", # CURDATE() => '2100-12-31'
+    "CURTIME()": f"'{CURRENT_TIME}'", # CURTIME() => '23:59:00'
+    "%y": "%Y",
+    "%j": "%J",
+}
+SPACE_PATTERN = re.compile(' [ \n]+|\n[ \n]*') # runs of spaces and newlines; a single space is left as is
+# TIME_PATTERN with its leading literal spelled out: an alternation of literals lets the regex engine skip ahead
+# to the next candidate character instead of trying every alternative at every position
+REWRITE_PATTERN = re.compile(r"DATE_(SUB|ADD)\((\w+\(\)|'[^']+')[, ]+ INTERVAL (\d+) (MONTH|YEAR|DAY)\)|" + '|'.join(re.escape(text) for text in REPLACEMENTS))
+VITAL_LOWER_PATTERN = re.compile('[ \n]+([a-zA-Z0-9_]+)_lower')
+VITAL_UPPER_PATTERN = re.compile('[ \n]+([a-zA-Z0-9_]+)_upper')
 
-    query = re.sub('[ ]+', ' ', query.replace('\n', ' ')).strip()
-    query = query.replace('> =', '>=').replace('< =', '<=').replace('! =', '!=')
+def rewrite(match):
+    if match.group(1) is None: # not a DATE_SUB/DATE_ADD call
+        return REPLACEMENTS[match.group()]
+    # the date argument itself may hold NOW(), 'now', ... which are rewritten as well
+    return date_function_sql('DATE_' + match.group(1), REWRITE_PATTERN.sub(rewrite, match.group(2)), match.group(3), match.group(4))
 
-    # Convert MySQL to SQLite functions
-    query = re.sub(TIME_PATTERN, convert_date_function, query)
+def post_process_sql(query):
+
+    query = SPACE_PATTERN.sub(' ', query).strip()
 
-    if "current_time" in query: # strftime('%J',current_time) => strftime('%J','2100-12-31 23:59:00')
-        query = query.replace("current_time", f"'{NOW}'")
-    if "current_date" in query: # strftime('%J',current_date) => strftime('%J','2100-12-31')
-        query = query.replace("current_date", f"'{CURRENT_DATE}'")
-    if "'now'" in query: # 'now' => '2100-12-31 23:59:00'
-        query = query.replace("'now'", f"'{NOW}'")
-    if "NOW()" in query: # NOW() => '2100-12-31 23:59:00'
-        query = query.replace("NOW()", f"'{NOW}'")
-    if "CURDATE()" in query: # CURDATE() => '2100-12-31'
-        query = query.replace("CURDATE()", f"'{CURRENT_DATE}'")
-    if "CURTIME()" in query: # CURTIME() => '23:59:00'
-        query = query.replace("CURTIME()", f"'{CURRENT_TIME}'")
-        
-    if re.search('[ \n]+([a-zA-Z0-9_]+_lower)', query) and re.search('[ \n]+([a-zA-Z0-9_]+_upper)', query):
-        vital_lower_expr = re.findall('[ \n]+([a-zA-Z0-9_]+_lower)', query)[0]
-        vital_upper_expr = re.findall('[ \n]+([a-zA-Z0-9_]+_upper)', query)[0]
-        vital_name_list = list(set(re.findall('([a-zA-Z0-9_]+)_lower', vital_lower_expr) + re.findall('([a-zA-Z0-9_]+)_upper', vital_upper_expr)))
-        if len(vital_name_list)==1:
-            processed_vital_name = vital_name_list[0].replace('_', ' ')
-            if processed_vital_name in PRECOMPUTED_DICT:
-                vital_range = PRECOMPUTED_DICT[processed_vital_name]
-                query = query.replace(vital_lower_expr, f"{vital_range[0]}").replace(vital_upper_expr, f"{vital_range[1]}")
+    # Convert MySQL to SQLite functions, in one pass over the query
+    query = REWRITE_PATTERN.sub(rewrite, query)
 
-    query = query.replace("%y", "%Y").replace('%j', '%J')
+    # vital sign ranges (e.g. heart_rate_lower / heart_rate_upper) => precomputed normal ranges
+    vital_lower = VITAL_LOWER_PATTERN.search(query) if '_lower' in query and '_upper' in query else None
+    vital_upper = VITAL_UPPER_PATTERN.search(query) if vital_lower else None
+    if vital_upper and vital_lower.group(1) == vital_upper.group(1):
+        processed_vital_name = vital_lower.group(1).replace('_', ' ')
+        if processed_vital_name in PRECOMPUTED_DICT:
+            vital_range = PRECOMPUTED_DICT[processed_vital_name]
+            query = query.replace(f"{vital_lower.group(1)}_lower", f"{vital_range[0]}").replace(f"{vital_upper.group(1)}_upper", f"{vital_range[1]}")
 
     return query
+
+def post_process_batch(sql_dict):
+    # {id: query} => {id: post-processed query}, processing each distinct query once
+    processed = {sql: post_process_sql(sql) for sql in dict.fromkeys(sql_dict.values())}
+    return {id_: processed[sql] for id_, sql in sql_dict.items()}
@@ -0,0 +1,60 @@
+# Per-query execution profile: profile.jsonl with one record per executed query and a summary of the slowest ones
+
+import os
+import re
+import json
+
+TABLE_ACCESS_PATTERN = re.compile(r'^(SCAN|SEARCH) (\w+)\b(?! ROW)') # not 'SCAN CONSTANT ROW'
+
+
+def table_accesses(plan):
+    # tables read with a full scan and tables searched through an index
+    scans, searches = [], []
+    for detail in plan or []:
+        match = TABLE_ACCESS_PATTERN.match(detail)
+        if match:
+            (scans if match.group(1) == 'SCAN' else searches).append(match.group(2))
+    return sorted(set(scans)), sorted(set(searches))
+
+def summarize_profile(records, top_k=10):
+    slowest = []
+    for record in sorted(records, key=lambda record: -record['wall_secs'])[:top_k]:
+        scans, searches = table_accesses(record['plan'])
+        slowest.append({
+            'ids': record['ids'],
+            'status': record['status'],
+            'wall_secs': record['wall_secs'],
+            'rows': record['rows'],
+            'vm_steps': record['vm_steps'],
+            'scans': scans,
+            'searches': searches,
+        })
+
+    # time spent in queries that fully scan each table
+    tables = {}
+    for record in records:
+        for table in table_accesses(record['plan'])[0]:
+            entry = tables.setdefault(table, {'queries': 0, 'wall_secs': 0.0})
+            entry['queries'] += 1
+            entry['wall_secs'] += record['wall_secs']
+    return {
+        'num_queries': len(records),
+        'total_wall_secs': sum(record['wall_secs'] for record in records),
+        'slowest': slowest,
+        'full_scans': dict(sorted(tables.items(), key=lambda x: -x[1]['wall_secs'])),
+    }
+
+def write_profile(records, score_dir, top_k=10):
+    with open(os.path.join(score_dir, 'profile.jsonl'), 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    summary = summarize_profile(records, top_k=top_k)
+    with open(os.path.join(score_dir, 'profile_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def print_summary(summary):
+    print('Profiled %d queries (%.2f secs)' % (summary['num_queries'], summary['total_wall_secs']))
+    for item in summary['slowest']:
+        ids = ', '.join(key for _, key in item['ids'][:3]) + (', ...' if len(item['ids']) > 3 else '')
+        print('%.3f secs  %d rows  %d steps  scans: %s  (%s)' % (item['wall_secs'], item['rows'], item['vm_steps'], ', '.join(item['scans']) or '-', ids))
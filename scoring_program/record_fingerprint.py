@@ -0,0 +1,29 @@
+# Record the database fingerprint next to answer.json so that scoring.py can reuse the precomputed gold results
+
+import os
+import json
+import argparse
+from scoring_utils import db_fingerprint
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", required=True, type=str, help="database the answers in answer.json were retrieved from")
+    parser.add_argument("--answer_dirs", required=True, nargs="+", type=str, help="directories containing answer.json")
+    args = parser.parse_args()
+    return args
+
+
+def main(args):
+    fingerprint = db_fingerprint(args.db_path)
+    for answer_dir in args.answer_dirs:
+        if not os.path.exists(os.path.join(answer_dir, 'answer.json')):
+            raise Exception('File does not exist: %s' % os.path.join(answer_dir, 'answer.json'))
+        with open(os.path.join(answer_dir, 'fingerprint.json'), 'w') as f:
+            json.dump({'db_fingerprint': fingerprint}, f)
+        print(f"{answer_dir}: {fingerprint}")
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
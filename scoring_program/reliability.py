@@ -0,0 +1,61 @@
+# Vectorized reliability scores: the per-question scores as one int8 vector, accuracy for any number of
+# penalties in one pass, and the abstention-threshold x penalty surface of a submission with confidences
+
+import numpy as np
+from scoring_utils import as_canonical, is_failed
+
+
+def outcome_arrays(real_result, pred_result, keys=None):
+    # boolean vectors over keys (default: the keys of real_result): gold is null, prediction is null, prediction is correct
+    keys = list(real_result) if keys is None else keys
+    outcomes = np.zeros((3, len(keys)), dtype=bool)
+    for i, key in enumerate(keys):
+        ans_real = as_canonical(real_result[key])
+        ans_pred = as_canonical(pred_result[key])
+        outcomes[0, i] = ans_real.kind == 'null'
+        outcomes[1, i] = ans_pred.kind == 'null'
+        outcomes[2, i] = ans_real.digest == ans_pred.digest and not is_failed(ans_real)
+    return outcomes
+
+def score_vector(real_result, pred_result, keys=None):
+    # reliability_score() as an int8 vector: 1 correct answer or correct abstention, 0 abstention on an
+    # answerable question, -1 wrong answer or answer to an unanswerable question
+    real_null, pred_null, correct = outcome_arrays(real_result, pred_result, keys=keys)
+    answerable = np.where(correct, 1, np.where(pred_null, 0, -1))
+    return np.where(real_null, np.where(pred_null, 1, -1), answerable).astype(np.int8)
+
+def abstention_vector(real_result, keys=None):
+    # scores if every question were abstained from: 1 for unanswerable questions, 0 otherwise
+    keys = list(real_result) if keys is None else keys
+    return np.array([as_canonical(real_result[key]).kind == 'null' for key in keys], dtype=np.int8)
+
+def penalty_sweep(scores, penalties):
+    # accuracy (mean score with -1 replaced by -penalty) for each penalty; equal to penalize() for integer penalties
+    scores = np.asarray(scores)
+    penalties = np.asarray(penalties, dtype=np.float64)
+    if len(scores) == 0:
+        return np.full(penalties.shape, np.nan)
+    num_correct = np.count_nonzero(scores == 1)
+    num_wrong = np.count_nonzero(scores == -1)
+    return (num_correct - penalties * num_wrong) / len(scores)
+
+def threshold_surface(answered, abstained, confidence, thresholds, penalties):
+    # Accuracy when the model answers exactly the questions with confidence >= threshold, as a
+    # (len(thresholds), len(penalties)) array. answered / abstained are the score vectors with the
+    # prediction kept / replaced by an abstention. Sorting the confidences once turns every threshold
+    # into a prefix / suffix of the questions, so the counts come from cumulative sums.
+    answered, abstained = np.asarray(answered), np.asarray(abstained)
+    order = np.argsort(confidence, kind='stable')
+    sorted_confidence = np.asarray(confidence, dtype=np.float64)[order]
+    answered, abstained = answered[order], abstained[order]
+
+    def suffix_sums(mask):
+        return np.concatenate([np.cumsum(mask[::-1])[::-1], [0]])
+    def prefix_sums(mask):
+        return np.concatenate([[0], np.cumsum(mask)])
+
+    start = np.searchsorted(sorted_confidence, np.asarray(thresholds, dtype=np.float64), side='left') # first answered question
+    num_correct = suffix_sums(answered == 1)[start] + prefix_sums(abstained == 1)[start]
+    num_wrong = suffix_sums(answered == -1)[start]
+    penalties = np.asarray(penalties, dtype=np.float64)
+    return (num_correct[:, None] - num_wrong[:, None] * penalties[None, :]) / len(answered)
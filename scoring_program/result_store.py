@@ -0,0 +1,93 @@
+# Persistent store of query results across scoring runs, keyed on (database fingerprint, SQL hash)
+
+import time
+import hashlib
+import sqlite3
+from scoring_utils import CanonicalResult
+
+MAX_ENTRIES = 1000000 # least recently used results beyond this are evicted
+BUSY_TIMEOUT = 60000 # ms a writer waits for the lock held by another worker or scoring run
+
+_worker_store = None # ResultStore of the current worker process
+_worker_fingerprint = None
+
+
+def sql_key(sql):
+    return hashlib.sha256(sql.encode()).hexdigest()
+
+class ResultStore:
+    # SQLite side-file in WAL mode: any number of processes read and write it concurrently, and every
+    # write is its own committed transaction, so an interrupted run keeps the results it already stored.
+    # Only the kind and the digest of a result are kept; the rows are materialized again from the
+    # database when they are needed. Results of failed or timed out queries are not stored.
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.con = sqlite3.connect(path, timeout=BUSY_TIMEOUT / 1000)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.execute('CREATE TABLE IF NOT EXISTS results (fingerprint TEXT, sql_hash TEXT, kind TEXT, digest TEXT, elapsed REAL, last_used REAL, PRIMARY KEY (fingerprint, sql_hash)) WITHOUT ROWID')
+        self.con.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+
+    def close(self):
+        self.con.close()
+
+    def lookup(self, fingerprint, sql_list):
+        # {sql: (CanonicalResult, elapsed)} for the stored ones; marks them as used
+        keys = {sql_key(sql): sql for sql in sql_list}
+        found = {}
+        hashes = list(keys)
+        for i in range(0, len(hashes), 500): # stay below SQLITE_MAX_VARIABLE_NUMBER
+            chunk = hashes[i:i + 500]
+            rows = self.con.execute('SELECT sql_hash, kind, digest, elapsed FROM results WHERE fingerprint = ? AND sql_hash IN (%s)' % ','.join('?' * len(chunk)), [fingerprint] + chunk)
+            for sql_hash, kind, digest, elapsed in rows:
+                found[keys[sql_hash]] = (CanonicalResult(kind, digest), elapsed)
+        if found:
+            now = time.time()
+            with self.con:
+                self.con.executemany('UPDATE results SET last_used = ? WHERE fingerprint = ? AND sql_hash = ?', [(now, fingerprint, sql_key(sql)) for sql in found])
+        return found
+
+    def put(self, fingerprint, sql, result, elapsed):
+        with self.con:
+            self.con.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)', (fingerprint, sql_key(sql), result.kind, result.digest, elapsed, time.time()))
+
+    def evict(self):
+        # drop the least recently used results beyond max_entries; returns the number removed
+        with self.con:
+            num_entries = self.con.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            excess = num_entries - self.max_entries
+            if excess <= 0:
+                return 0
+            self.con.execute('DELETE FROM results WHERE (fingerprint, sql_hash) IN (SELECT fingerprint, sql_hash FROM results ORDER BY last_used LIMIT ?)', (excess,))
+        return excess
+
+def open_store(path, max_entries=MAX_ENTRIES):
+    # None if the store cannot be opened (e.g. a corrupted or read-only file); scoring then executes everything
+    try:
+        return ResultStore(path, max_entries=max_entries)
+    except sqlite3.Error as e:
+        print('result store %s is unusable (%s); executing all queries' % (path, e))
+        return None
+
+def init_worker_store(path, fingerprint):
+    global _worker_store, _worker_fingerprint
+    close_worker_store()
+    _worker_store = open_store(path) if path is not None else None
+    _worker_fingerprint = fingerprint
+
+def close_worker_store():
+    global _worker_store, _worker_fingerprint
+    if _worker_store is not None:
+        _worker_store.close()
+    _worker_store = None
+    _worker_fingerprint = None
+
+def store_result(sql, result, elapsed):
+    # called in the worker right after a query succeeded
+    if _worker_store is None:
+        return
+    try:
+        _worker_store.put(_worker_fingerprint, sql, result, elapsed)
+    except sqlite3.Error:
+        pass # the store only saves work in later runs
@@ -0,0 +1,245 @@
+# Joint execution of gold and predicted queries: every distinct SQL string is executed once
+
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+import multiprocessing as mp
+from functools import partial
+from batching import group_batches, execute_batch
+from result_store import open_store, init_worker_store, close_worker_store, store_result
+from scoring_utils import execute_sql, canonicalize_rows, profile_record, materialize_sql, guided_chunks, CanonicalResult, init_worker, close_worker, connect_readonly, table_row_counts, db_fingerprint, load_shared_db, release_shared_db, statement_cache_stats, QueryTimeout, CACHE_SIZE, MMAP_SIZE
+
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+HISTORY_SIZE = 20000 # runtimes kept in the history; the least recently executed queries are dropped first
+
+
+def sql_hash(sql):
+    return hashlib.sha1(sql.encode()).hexdigest()
+
+def load_history(history_path):
+    if history_path is None or not os.path.exists(history_path):
+        return {}
+    try:
+        with open(history_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def update_history(history, runtimes, history_size=HISTORY_SIZE):
+    # runtimes: {sql: elapsed}; entries are kept in the order they were last executed (oldest first)
+    for sql, elapsed in runtimes.items():
+        history.pop(sql_hash(sql), None)
+        history[sql_hash(sql)] = elapsed
+    for key in list(history)[:max(0, len(history) - history_size)]:
+        del history[key]
+
+def save_history(history_path, history):
+    if history_path is None:
+        return
+    try:
+        # written to a temporary file first: concurrent runs (e.g. requests of the scoring daemon, which share
+        # one process) each write their own file and replace the history atomically
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(history_path) + '.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(history_path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(history, f)
+        os.replace(tmp_path, history_path)
+    except OSError:
+        pass # the history only affects the execution order
+
+def touched_rows(sql, table_rows):
+    tables = set(IDENTIFIER_PATTERN.findall(sql.lower())) & set(table_rows)
+    return sum(table_rows[table] for table in tables)
+
+def build_schedule(real_dict, pred_dict, table_rows=None, history=None, skip_indicator='null'):
+    # distinct SQL string -> [(tag, key), ...] of every id that needs its result, longest expected runtime first
+    consumers = {}
+    for tag, sql_dict in [('real', real_dict), ('pred', pred_dict)]:
+        for key in sql_dict:
+            if sql_dict[key] != skip_indicator:
+                consumers.setdefault(sql_dict[key], []).append((tag, key))
+
+    expected = expected_runtimes(consumers, table_rows=table_rows, history=history)
+    order = sorted(consumers, key=lambda sql: expected[sql], reverse=True)
+    return [(sql, consumers[sql]) for sql in order]
+
+def expected_runtimes(sqls, table_rows=None, history=None):
+    # runtime measured in an earlier run if available, otherwise the size of the touched tables
+    # converted to seconds with the average cost per row observed in the history
+    table_rows = table_rows or {}
+    history = history or {}
+    rows = {sql: touched_rows(sql, table_rows) for sql in sqls}
+    known = [sql for sql in sqls if sql_hash(sql) in history]
+    known_rows = sum(rows[sql] for sql in known)
+    secs_per_row = sum(history[sql_hash(sql)] for sql in known) / known_rows if known_rows > 0 else 1.0
+    return {sql: history.get(sql_hash(sql), rows[sql] * secs_per_row) for sql in sqls}
+
+def execute_distinct(sql, db_path, timeout=None, max_steps=None, profile=False):
+    stats = {} if profile else None
+    start_time = time.time()
+    try:
+        status, result = 'ok', execute_sql(sql, db_path, timeout=timeout, max_steps=max_steps, consume=canonicalize_rows, stats=stats)
+    except QueryTimeout:
+        status, result = 'timeout', None
+    except:
+        status, result = 'error', None
+    elapsed = time.time() - start_time
+    if status == 'ok':
+        store_result(sql, result, elapsed)
+    record = profile_record(sql, db_path, stats, elapsed, result.kind if result is not None else status) if profile else None
+    return (sql, status, result, elapsed, record)
+
+def init_executor(db_path, cache_size, mmap_size, parameterize_literals, store_path, fingerprint):
+    # pool initializer: database connection plus, if enabled, the result store the worker writes to
+    init_worker(db_path, cache_size=cache_size, mmap_size=mmap_size, parameterize_literals=parameterize_literals)
+    init_worker_store(store_path, fingerprint)
+
+def close_executor():
+    close_worker()
+    close_worker_store()
+
+def run_chunk(tasks, kwds):
+    # the outcomes of a chunk of tasks plus the statement cache counters of the worker that ran it (see StatementCache)
+    return [function(*args, **kwds) for function, args in tasks], os.getpid(), statement_cache_stats()
+
+def run_tasks(pool, tasks, kwds, callback, cache_stats, num_workers=1, weights=None):
+    # tasks: [(function, args), ...] dispatched in order (longest first) as guided chunks sized by their
+    # expected runtimes (weights, see guided_chunks); returns once all of them are done
+    # cache_stats: {pid: counters} updated with the latest (cumulative) statement cache counters of each worker
+    def collect(result):
+        outcomes, pid, stats = result
+        if stats is not None:
+            cache_stats[pid] = stats
+        for outcome in outcomes:
+            callback(outcome)
+    if pool is None:
+        collect(run_chunk(tasks, kwds))
+        return
+    for result in pool.imap_unordered(partial(run_chunk, kwds=kwds), guided_chunks(tasks, num_workers, weights=weights)):
+        collect(result)
+
+def merge_cache_stats(cache_stats):
+    hits = sum(stats['hits'] for stats in cache_stats.values())
+    misses = sum(stats['misses'] for stats in cache_stats.values())
+    return {'workers': len(cache_stats), 'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+def execute_joint(real_dict, pred_dict, db_path, num_workers=1, timeout=None, max_steps=None, history_path=None, cache_size=CACHE_SIZE, mmap_size=MMAP_SIZE, shared_memory=False, skip_indicator='null', profile_records=None, batch_templates=False, parameterize_literals=False, store_path=None, pool=None, fingerprint=None):
+    # profile_records: list that receives one profile record per distinct executed query (None: profiling disabled)
+    # store_path: persistent result store (see result_store.py); stored results are reused and only the
+    # remaining queries are executed
+    # pool: running pool whose workers were initialized with init_executor for db_path (e.g. by the scoring
+    # daemon); it is used as is and left open, and shared_memory is ignored
+    # fingerprint: db_fingerprint(db_path) if already known (e.g. computed once by the scoring daemon)
+    con = connect_readonly(db_path)
+    try:
+        table_rows = table_row_counts(con)
+    finally:
+        con.close()
+    history = load_history(history_path)
+    schedule = build_schedule(real_dict, pred_dict, table_rows=table_rows, history=history, skip_indicator=skip_indicator)
+
+    outcomes = {}
+    store = open_store(store_path) if store_path is not None else None
+    if store is not None:
+        fingerprint = fingerprint or db_fingerprint(db_path)
+        try:
+            for sql, (result, elapsed) in store.lookup(fingerprint, [sql for sql, _ in schedule]).items():
+                result.loader = partial(materialize_sql, sql, db_path)
+                outcomes[sql] = ('ok', result, elapsed, None)
+        finally:
+            store.close()
+        print('result store: %d of %d distinct queries found' % (len(outcomes), len(schedule)))
+        schedule_all, schedule = schedule, [(sql, consumers) for sql, consumers in schedule if sql not in outcomes]
+    else:
+        store_path = None
+        schedule_all = schedule
+
+    # shared_memory: workers query one in-memory copy of the database made by the parent instead of the file
+    # (the file itself if the copy could not be made)
+    shared_path = None
+    exec_db_path = db_path
+    if shared_memory and pool is None:
+        shared_path, shared_mmap_size = load_shared_db(db_path)
+        if shared_path is not None:
+            exec_db_path, mmap_size = shared_path, shared_mmap_size
+
+    # batch_templates: queries sharing a shape run as one statement (see batching.py); queries whose
+    # batch failed or left them out run one by one afterwards
+    profile = profile_records is not None
+    batches = group_batches([sql for sql, _ in schedule])[0] if batch_templates else []
+    batched = {sql for batch in batches for sql in batch}
+    # the budget only applies to SQL without a gold consumer: a gold query cut off would mark every prediction
+    # for its id wrong. A batch gets the budget of one query; its gold members run unbudgeted if it runs out
+    gold = {sql for sql, consumers in schedule if any(tag == 'real' for tag, _ in consumers)}
+    budget = lambda sql: (None, None) if sql in gold else (timeout, max_steps)
+    tasks = [(execute_batch, (batch, exec_db_path, timeout, max_steps)) for batch in batches]
+    tasks += [(execute_distinct, (sql, exec_db_path, *budget(sql))) for sql, _ in schedule if sql not in batched]
+    expected = expected_runtimes([sql for sql, _ in schedule], table_rows=table_rows, history=history)
+    weights = [sum(expected[sql] for sql in batch) for batch in batches] + [expected[sql] for sql, _ in schedule if sql not in batched]
+
+    fallback, batch_records, cache_stats = [], [], {}
+    def result_tracker(outcome):
+        if isinstance(outcome[0], list): # batch
+            sqls, results, elapsed, record = outcome
+            if record is not None:
+                batch_records.append((sqls, record))
+            for sql in sqls:
+                if results is not None and sql in results:
+                    outcomes[sql] = ('ok', results[sql], elapsed / len(sqls), None)
+                else:
+                    fallback.append(sql)
+        else:
+            outcomes[outcome[0]] = outcome[1:]
+    own_pool = pool is None
+    try:
+        if own_pool and num_workers > 1:
+            pool = mp.Pool(processes=num_workers, initializer=init_executor, initargs=(exec_db_path, cache_size, mmap_size, parameterize_literals, store_path, fingerprint))
+        elif own_pool:
+            init_executor(exec_db_path, cache_size, mmap_size, parameterize_literals, store_path, fingerprint)
+        try:
+            kwds = {'profile': profile}
+            run_tasks(pool, tasks, kwds, result_tracker, cache_stats, num_workers=num_workers, weights=weights)
+            run_tasks(pool, [(execute_distinct, (sql, exec_db_path, *budget(sql))) for sql in fallback], kwds, result_tracker, cache_stats, num_workers=num_workers, weights=[expected[sql] for sql in fallback])
+        finally:
+            if own_pool and pool is not None:
+                pool.close()
+                pool.join()
+            elif own_pool:
+                close_executor()
+    finally:
+        release_shared_db(shared_path)
+    if cache_stats:
+        stats = merge_cache_stats(cache_stats)
+        print('statement cache: %d hits, %d misses (hit rate %.1f%%) over %d workers' % (stats['hits'], stats['misses'], stats['hit_rate'] * 100, stats['workers']))
+    if store_path is not None:
+        store = open_store(store_path)
+        if store is not None:
+            store.evict()
+            store.close()
+
+    for sql, consumers in schedule:
+        status, result, elapsed, record = outcomes[sql]
+        if status == 'ok' and result.rows is None: # only the digest came back from the worker
+            result.loader = partial(materialize_sql, sql, db_path)
+        if record is not None:
+            record['ids'] = [list(consumer) for consumer in consumers]
+            profile_records.append(record)
+    consumers_of = dict(schedule_all)
+    for sqls, record in batch_records:
+        record['ids'] = [list(consumer) for sql in sqls for consumer in consumers_of[sql]]
+        profile_records.append(record)
+
+    exec_result = {'real': {}, 'pred': {}}
+    for tag, sql_dict in [('real', real_dict), ('pred', pred_dict)]:
+        for key in sql_dict:
+            sql = sql_dict[key]
+            if sql == skip_indicator:
+                exec_result[tag][key] = CanonicalResult.from_string(skip_indicator)
+                continue
+            status, result, _, _ = outcomes[sql]
+            exec_result[tag][key] = result if status == 'ok' else CanonicalResult.from_string(status+'_'+tag)
+    update_history(history, {sql: outcomes[sql][2] for sql, _ in schedule})
+    save_history(history_path, history)
+    return exec_result['real'], exec_result['pred']
@@ -0,0 +1,112 @@
+# Scoring API behind scoring.py, scoring_v2.py and the scoring daemon:
+# score() executes gold and predicted SQL (execute() returns the results themselves), score_answers() compares retrieved answers.
+# Modules only needed for some options (profiling, worker pools) are imported when used.
+
+import os
+import json
+from scoring_utils import reliability_score, process_answer
+from reliability import penalty_sweep
+
+# per-query budgets of the official scores, applied only to SQL that no gold query shares (see execute_joint).
+# The VM instruction budget stops runaway predictions (e.g. cartesian joins) the same way on every host; the gold
+# queries need at most ~6e5 steps. A wall-time budget would make scores depend on the host, so it is opt-in.
+QUERY_TIMEOUT = None # wall-time budget per query in seconds (None: unlimited)
+QUERY_MAX_STEPS = 10**9 # SQLite VM instruction budget per query (None: unlimited)
+PENALTIES = ['0', '5', '10', 'N'] # penalty levels of scores.json; N is the number of questions
+
+
+def load_dict(source):
+    # {id: value} given as a dict or as the path of a JSON file
+    if isinstance(source, dict):
+        return source
+    with open(source) as f:
+        return json.load(f)
+
+def penalty_values(penalties, num_questions):
+    # '0', '5', 'N', ... => numbers, with N the number of questions
+    return [num_questions if penalty == 'N' else int(penalty) for penalty in penalties]
+
+def accuracy_dict(scores):
+    # the scores.json dict: reliability scores under penalties 0, 5, 10 and N, in percent
+    accuracies = penalty_sweep(scores, penalty_values(PENALTIES, len(scores)))
+    return {'accuracy%s' % penalty: float(accuracy)*100 for penalty, accuracy in zip(PENALTIES, accuracies)}
+
+def score(ref, pred, db_path, verbose=False, **kwargs):
+    # scores.json dict of the SQL predictions; kwargs are those of execute()
+    real_result, pred_result = execute(ref, pred, db_path, verbose=verbose, **kwargs)
+    if verbose:
+        print('Checking Accuracy')
+    return accuracy_dict(reliability_score(real_result, pred_result))
+
+def execute(ref, pred, db_path, **kwargs):
+    # (gold results, predicted results) as {id: CanonicalResult}; each distinct SQL string is executed once
+    # ref, pred: {id: SQL or 'null'} or paths of label.json / prediction.json; kwargs are those of execute_many()
+    real_result, pred_results = execute_many(ref, [pred], db_path, **kwargs)
+    return real_result, pred_results[0]
+
+def execute_many(ref, preds, db_path, reference_dir=None, num_workers=None, timeout=QUERY_TIMEOUT, max_steps=QUERY_MAX_STEPS, history_path=None,
+                 shared_memory=False, batch_templates=False, parameterize_literals=False, store_path=None, profile_dir=None, pool=None, fingerprint=None, verbose=False):
+    # execute() for several prediction files at once: (gold results, [predicted results, ...]), where a
+    # SQL string shared by the gold queries and any of the predictions is still executed only once
+    # reference_dir: directory of label.json; its answer.json (with a matching fingerprint.json) replaces executing the gold queries
+    # num_workers: worker processes (None: sized from the usable CPUs and memory, see worker_sizing.py); pool: running pool set up with scheduler.init_executor
+    # profile_dir: write profile.jsonl and profile_summary.json there (see profiling.py)
+    # fingerprint: db_fingerprint(db_path) if already known (the scoring daemon computes it once)
+    # the other options are those of scheduler.execute_joint
+    from postprocessing import post_process_batch
+    from scheduler import execute_joint
+    from scoring_utils import load_reference_results
+
+    real_dict = load_dict(ref)
+    pred_dicts = [load_dict(pred) for pred in preds]
+    for pred_dict in pred_dicts:
+        assert set(real_dict) == set(pred_dict), "IDs do not match"
+    if not os.path.exists(db_path):
+        raise Exception('File does not exist: %s' % db_path)
+
+    if verbose:
+        print('Executing Queries')
+    real_dict = post_process_batch(real_dict)
+    # several files go into one dict keyed on (index of the file, id), so that the scheduler deduplicates across them
+    if len(pred_dicts) == 1:
+        pred_dict = post_process_batch(pred_dicts[0])
+    else:
+        pred_dict = post_process_batch({(i, key): sql for i, pred_dict in enumerate(pred_dicts) for key, sql in pred_dict.items()})
+
+    real_result = load_reference_results(reference_dir, db_path, ids=real_dict, fingerprint=fingerprint) if reference_dir is not None else None
+
+    if num_workers is None:
+        from worker_sizing import worker_count
+        num_workers = worker_count()
+    profile_records = [] if profile_dir is not None else None
+    kwargs = {'num_workers': num_workers, 'timeout': timeout, 'max_steps': max_steps, 'history_path': history_path, 'shared_memory': shared_memory,
+              'profile_records': profile_records, 'batch_templates': batch_templates, 'parameterize_literals': parameterize_literals, 'store_path': store_path, 'pool': pool, 'fingerprint': fingerprint}
+    if real_result is None:
+        real_result, pred_result = execute_joint(real_dict, pred_dict, db_path, **kwargs)
+    else:
+        _, pred_result = execute_joint({}, pred_dict, db_path, **kwargs)
+    if profile_records is not None:
+        from profiling import write_profile, print_summary
+        print_summary(write_profile(profile_records, profile_dir))
+
+    if len(pred_dicts) == 1:
+        return real_result, [pred_result]
+    pred_results = [{} for _ in pred_dicts]
+    for (i, key), result in pred_result.items():
+        pred_results[i][key] = result
+    return real_result, pred_results
+
+def score_answers(ref, pred):
+    # ref, pred: {id: answer} (as in answer.json) or paths of such JSON files
+    real_dict = load_dict(ref)
+    pred_dict = load_dict(pred)
+    assert set(real_dict) == set(pred_dict), "IDs do not match"
+
+    # preprocess predicted answer to match the format as GT answer
+    real_result = {key: process_answer(real_dict[key]) for key in real_dict}
+    pred_result = {key: process_answer(pred_dict[key]) for key in pred_dict}
+    return accuracy_dict(reliability_score(real_result, pred_result))
+
+def write_scores(scores_dict, score_dir):
+    with open(os.path.join(score_dir, 'scores.json'), 'w') as score_file:
+        score_file.write(json.dumps(scores_dict))
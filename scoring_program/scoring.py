@@ -3,63 +3,47 @@
 import json
 import os
 import sys
-import sqlite3
-import numpy as np
-import pandas as pd
-import multiprocessing as mp
-from scoring_utils import reliability_score, penalize
-from postprocessing import post_process_sql
-
-
-reference_dir = os.path.join(sys.argv[1], 'ref')
-prediction_dir = os.path.join(sys.argv[1], 'res')
-score_dir = sys.argv[2]
-
-
-print('Load Data')
-with open(os.path.join(reference_dir, 'label.json')) as f:
-    real_dict = json.load(f)
-with open(os.path.join(prediction_dir, 'prediction.json')) as f:
-    pred_dict = json.load(f)
-assert set(real_dict) == set(pred_dict), "IDs do not match"
-
-
-print('Executing Queries')
-real_dict = {id_: post_process_sql(real_dict[id_]) for id_ in real_dict}
-pred_dict = {id_: post_process_sql(pred_dict[id_]) for id_ in pred_dict}
-
-current_real_dir = os.path.dirname(os.path.realpath(__file__))
-db_path = os.path.join(current_real_dir, 'mimic_iv.sqlite')
-if not os.path.exists(db_path):
-    raise Exception('File does not exist: %s' % db_path)
-
-num_workers = mp.cpu_count()
-if num_workers > 1:
-    from scoring_utils import execute_all_distributed
-    real_result = execute_all_distributed(real_dict, db_path, tag='real', num_workers=num_workers)
-    pred_result = execute_all_distributed(pred_dict, db_path, tag='pred', num_workers=num_workers)
-else:
-    from scoring_utils import execute_all
-    real_result = execute_all(real_dict, db_path, tag='real')
-    pred_result = execute_all(pred_dict, db_path, tag='pred')
-
-
-print('Checking Accuracy')
-scores = reliability_score(real_result, pred_result)
-accuracy0 = penalize(scores, penalty=0)
-accuracy5 = penalize(scores, penalty=5)
-accuracy10 = penalize(scores, penalty=10)
-accuracyN = penalize(scores, penalty=len(scores))
-
-
-print('Scores:')
-scores_dict = {
-    'accuracy0': accuracy0*100,
-    'accuracy5': accuracy5*100,
-    'accuracy10': accuracy10*100,
-    'accuracyN': accuracyN*100
-}
-print(scores_dict)
-
-with open(os.path.join(score_dir, 'scores.json'), 'w') as score_file:
-    score_file.write(json.dumps(scores_dict))
\ No newline at end of file
+from scorer import score, write_scores, QUERY_TIMEOUT, QUERY_MAX_STEPS
+
+
+SHARED_MEMORY_DB = False # workers query one in-memory copy of the database loaded by the parent
+BATCH_TEMPLATES = False # queries that differ only in their literals run as one statement when provably equivalent
+PARAMETERIZE_LITERALS = False # bind literals as parameters so that queries of one shape reuse a prepared statement
+RESULT_STORE = False # reuse results of earlier runs kept in result_store.sqlite; only queries not found there are executed
+SCORING_DAEMON = False # score with a running scoring_daemon.py if one is reachable, otherwise run locally
+PROFILE_QUERIES = False # write profile.jsonl and profile_summary.json (time, rows, VM steps, query plan per query) to score_dir
+
+
+if __name__ == '__main__':
+    reference_dir = os.path.join(sys.argv[1], 'ref')
+    prediction_dir = os.path.join(sys.argv[1], 'res')
+    score_dir = sys.argv[2]
+
+    if SCORING_DAEMON:
+        from daemon_client import request_scores
+        scores_dict = request_scores(reference_dir, prediction_dir)
+        if scores_dict is not None:
+            print('Scores (scoring daemon):')
+            print(scores_dict)
+            write_scores(scores_dict, score_dir)
+            sys.exit(0)
+
+    print('Load Data')
+    with open(os.path.join(reference_dir, 'label.json')) as f:
+        real_dict = json.load(f)
+    with open(os.path.join(prediction_dir, 'prediction.json')) as f:
+        pred_dict = json.load(f)
+    assert set(real_dict) == set(pred_dict), "IDs do not match"
+
+    current_real_dir = os.path.dirname(os.path.realpath(__file__))
+    db_path = os.path.join(current_real_dir, 'mimic_iv.sqlite')
+    history_path = os.path.join(current_real_dir, 'query_history.json') # runtimes of earlier runs, used to start slow queries first
+    store_path = os.path.join(current_real_dir, 'result_store.sqlite') if RESULT_STORE else None
+
+    scores_dict = score(real_dict, pred_dict, db_path, reference_dir=reference_dir, timeout=QUERY_TIMEOUT, max_steps=QUERY_MAX_STEPS, history_path=history_path,
+                        shared_memory=SHARED_MEMORY_DB, batch_templates=BATCH_TEMPLATES, parameterize_literals=PARAMETERIZE_LITERALS, store_path=store_path,
+                        profile_dir=score_dir if PROFILE_QUERIES else None, verbose=True)
+
+    print('Scores:')
+    print(scores_dict)
+    write_scores(scores_dict, score_dir)
@@ -0,0 +1,138 @@
+# Long-running scoring server: one warm worker pool with open connections to mimic_iv.sqlite, serving
+# scoring requests from daemon_client.py (and scoring.py with SCORING_DAEMON) over a Unix socket or a local port
+
+import os
+import json
+import time
+import signal
+import argparse
+import threading
+import socketserver
+import multiprocessing as mp
+from scoring_utils import db_fingerprint, CACHE_SIZE, MMAP_SIZE
+from worker_sizing import worker_count
+from scheduler import init_executor
+from scorer import score, QUERY_TIMEOUT
+from daemon_client import DEFAULT_SOCKET, connect
+
+WARM_CHUNK_SIZE = 2**24 # bytes read at a time when pulling the database into the page cache
+
+
+def config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'mimic_iv.sqlite'), type=str, help="database the queries are executed on")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, type=str, help="Unix socket to listen on")
+    parser.add_argument("--port", default=None, type=int, help="listen on 127.0.0.1:PORT instead of the Unix socket")
+    parser.add_argument("--num_workers", default=worker_count(), type=int, help="worker processes kept warm (default: sized from the usable CPUs and memory)")
+    parser.add_argument("--max_concurrent", default=1, type=int, help="requests scored at the same time (they share the workers)")
+    parser.add_argument("--max_queue", default=16, type=int, help="requests allowed to wait; further ones are refused")
+    parser.add_argument("--result_store", default=None, type=str, help="persistent result store shared with scoring.py (see result_store.py)")
+    args = parser.parse_args()
+    return args
+
+
+def warm_database(db_path, chunk_size=WARM_CHUNK_SIZE):
+    # read the file once so that the first requests do not hit a cold page cache
+    with open(db_path, 'rb') as f:
+        while f.read(chunk_size):
+            pass
+
+def init_daemon_worker(*initargs):
+    # Ctrl-C stops the daemon, which then shuts the pool down; the workers themselves ignore it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_executor(*initargs)
+
+class ScoringService:
+    # scores requests with a shared pool; at most max_concurrent run at once and at most max_queue wait
+    def __init__(self, db_path, num_workers, max_concurrent=1, max_queue=16, store_path=None, timeout=QUERY_TIMEOUT):
+        self.db_path = db_path
+        self.num_workers = num_workers # size of the pool, which sizes the guided chunks of each request
+        self.store_path = store_path
+        self.timeout = timeout
+        self.history_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'query_history.json')
+        self.slots = threading.Semaphore(max_concurrent)
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.fingerprint = db_fingerprint(db_path) # the database does not change while the daemon runs
+        warm_database(db_path)
+        self.pool = mp.Pool(processes=num_workers, initializer=init_daemon_worker, initargs=(db_path, CACHE_SIZE, MMAP_SIZE, False, store_path, self.fingerprint if store_path is not None else None))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def score(self, reference_dir, pred_dict):
+        return score(os.path.join(reference_dir, 'label.json'), pred_dict, self.db_path, reference_dir=reference_dir, num_workers=self.num_workers, timeout=self.timeout,
+                     history_path=self.history_path, store_path=self.store_path, pool=self.pool, fingerprint=self.fingerprint)
+
+    def handle(self, request):
+        with self.lock:
+            if self.waiting >= self.max_queue:
+                return {'error': 'queue full'}
+            self.waiting += 1
+        try:
+            with self.slots:
+                with self.lock:
+                    self.waiting -= 1
+                start_time = time.time()
+                scores_dict = self.score(request['reference_dir'], request['prediction'])
+                return {'scores': scores_dict, 'secs': time.time() - start_time}
+        except Exception as e:
+            return {'error': '%s: %s' % (type(e).__name__, e)}
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # one JSON request per line, answered with one JSON line ({'scores': {...}} or {'error': ...})
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'error': 'invalid request: %s' % e}
+        else:
+            response = self.server.service.handle(request)
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+class UnixScoringServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class TCPScoringServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main(args):
+    if not os.path.exists(args.db_path):
+        raise Exception('File does not exist: %s' % args.db_path)
+    if args.port is not None:
+        server = TCPScoringServer(('127.0.0.1', args.port), RequestHandler)
+        address = '127.0.0.1:%d' % args.port
+    else:
+        if os.path.exists(args.socket):
+            try:
+                connect(args.socket).close()
+            except OSError:
+                os.remove(args.socket) # left over from a daemon that did not shut down cleanly
+            else:
+                raise Exception('A scoring daemon is already listening on %s' % args.socket)
+        server = UnixScoringServer(args.socket, RequestHandler)
+        address = args.socket
+    server.service = ScoringService(args.db_path, args.num_workers, max_concurrent=args.max_concurrent, max_queue=args.max_queue, store_path=args.result_store)
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # shut down cleanly on kill as well
+    print(f"scoring daemon listening on {address} ({args.num_workers} workers)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+        if args.port is None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    args = config()
+    main(args)
@@ -2,9 +2,37 @@ import os
 import sys
 import json
 import sqlite3
-import numpy as np
+import time
+import math
+import heapq
+import hashlib
+import tempfile
+from functools import partial
+from collections import OrderedDict
+from operator import itemgetter
 import multiprocessing as mp
 from ast import literal_eval
+from urllib.parse import quote
+from sql_shape import parameterize
+from worker_sizing import worker_count
+
+CACHE_SIZE = -64000 # page cache per connection (negative: in KiB)
+MMAP_SIZE = 2**30 # bytes of the database file that can be memory-mapped
+SHM_DIR = '/dev/shm' # memory-backed filesystem holding the shared copy of the database
+STATEMENT_CACHE_SIZE = 512 # prepared statements kept per connection (keyed on the SQL text)
+READ_ONLY_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE} # allowed on worker connections
+
+PROGRESS_STEPS = 1000 # SQLite VM instructions between two checks of the execution budget
+FETCH_SIZE = 1000 # rows pulled from the cursor at a time
+MAX_ROWS = 100 # check only up to 100th record
+MIN_CHUNK_SIZE = 4 # smallest number of queries sent to a worker as one task
+
+_worker_con = None # connection owned by the current worker process
+_worker_db_path = None
+_worker_statements = None # StatementCache of the worker connection when literals are bound as parameters
+
+class QueryTimeout(Exception):
+    pass
 
 def process_item(item):
     try:
@@ -13,78 +41,475 @@ def process_item(item):
         pass
     return str(item)
 
+def normalize_cell(item):
+    # typed version of process_item: str(normalize_cell(x)) == process_item(x)
+    if type(item) is int or type(item) is float:
+        return round(float(item),3)
+    try:
+        return round(float(item),3)
+    except:
+        return str(item)
+
+def result_digest(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+def parses_as_rows(ans):
+    try:
+        rows = literal_eval(ans)
+    except:
+        return False
+    return isinstance(rows, list) and all(isinstance(row, (list, tuple)) for row in rows)
+
+class CanonicalResult:
+    # Canonical form of a query result, or of a status such as 'null', 'error_pred' or 'timeout_real'.
+    # `rows` holds the normalized cells of the first MAX_ROWS rows in the order of the legacy
+    # str(sorted(...)[:100]) representation and `digest` is the digest of that string, so two results
+    # are equal exactly when their legacy strings are. Only kind and digest are pickled; the rows are
+    # materialized again with `loader` when they are needed (e.g. for a diff report).
+    __slots__ = ('kind', 'digest', 'text', '_rows', 'loader')
+
+    def __init__(self, kind, digest, text=None, rows=None, loader=None):
+        self.kind = kind # 'rows', 'null', 'error', 'timeout' or 'text' (any other string answer)
+        self.digest = digest
+        self.text = text
+        self._rows = rows
+        self.loader = loader
+
+    @classmethod
+    def from_sorted_rows(cls, pairs):
+        # pairs: [(row as strings, row as typed cells), ...] already in canonical order
+        text = str([list(str_row) for str_row, _ in pairs])
+        return cls('rows', result_digest(text), rows=tuple(typed_row for _, typed_row in pairs))
+
+    @classmethod
+    def from_string(cls, ans):
+        # a status or a legacy canonical string; strings that only look like rows (e.g. a truncated answer) are text
+        if ans.startswith('[') and parses_as_rows(ans):
+            return cls('rows', result_digest(ans), loader=partial(process_answer, ans))
+        if ans == 'null':
+            kind = 'null'
+        elif ans.startswith('error_'):
+            kind = 'error'
+        elif ans.startswith('timeout_'):
+            kind = 'timeout'
+        else:
+            kind = 'text'
+        return cls(kind, result_digest(ans), text=ans)
+
+    @property
+    def rows(self):
+        if self._rows is None and self.loader is not None:
+            self._rows = self.loader().rows
+        return self._rows
+
+    @property
+    def value(self):
+        # legacy string representation
+        if self.kind != 'rows':
+            return self.text
+        return str([[str(c) for c in row] for row in self.rows])
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            other = CanonicalResult.from_string(other)
+        if not isinstance(other, CanonicalResult):
+            return NotImplemented
+        return self.digest == other.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __str__(self):
+        return self.value
+
+    def __repr__(self):
+        return 'CanonicalResult(%s, %s)' % (self.kind, self.digest)
+
+    def __getstate__(self):
+        return (self.kind, self.digest, self.text)
+
+    def __setstate__(self, state):
+        self.kind, self.digest, self.text = state
+        self._rows = None
+        self.loader = None
+
+def as_canonical(ans):
+    if isinstance(ans, CanonicalResult):
+        return ans
+    return CanonicalResult.from_string(ans)
+
 def process_answer(ans):
+    if isinstance(ans, CanonicalResult):
+        return ans
     try:
         ans = literal_eval(ans)
     except:
         pass
     if type(ans)==str:
-        return ans
+        return CanonicalResult.from_string(ans)
     else:
-        return str(sorted([[process_item(c) for c in row] for row in ans])[:100]) # check only up to 100th record
+        return canonicalize_rows(ans)
 
-def execute_sql(sql, db_path):
-    con = sqlite3.connect(db_path)
+def canonicalize_rows(rows):
+    # same order as sorted(...)[:MAX_ROWS] on the processed rows, but only keeps the MAX_ROWS smallest rows in memory
+    def normalized(rows):
+        for row in rows:
+            typed_row = tuple([normalize_cell(c) for c in row])
+            yield (tuple([str(c) for c in typed_row]), typed_row)
+    pairs = heapq.nsmallest(MAX_ROWS, normalized(rows), key=itemgetter(0))
+    return CanonicalResult.from_sorted_rows(pairs)
+
+def iter_rows(cur, fetch_size=FETCH_SIZE):
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            return
+        yield from rows
+
+class StatementCache:
+    # Mirrors the LRU statement cache of the sqlite3 module (keyed on the SQL text) to count how often a
+    # parameterized shape is found prepared. Counts are per process.
+    def __init__(self, size=STATEMENT_CACHE_SIZE):
+        self.size = size
+        self.shapes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, shape):
+        if shape in self.shapes:
+            self.shapes.move_to_end(shape)
+            self.hits += 1
+            return
+        self.misses += 1
+        self.shapes[shape] = None
+        if len(self.shapes) > self.size:
+            self.shapes.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': self.size, 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+def statement_cache_stats():
+    # counters of the last worker connection of this process (None if literals were not parameterized);
+    # scheduler.run_tasks returns them from the pool workers to the parent
+    return _worker_statements.stats() if _worker_statements is not None else None
+
+def connect_readonly(db_path, cache_size=CACHE_SIZE, mmap_size=MMAP_SIZE, cached_statements=STATEMENT_CACHE_SIZE):
+    # the evaluation database never changes while scoring, so skip locking and change detection
+    uri = 'file:%s?mode=ro&immutable=1' % quote(os.path.abspath(db_path))
+    con = sqlite3.connect(uri, uri=True, cached_statements=cached_statements)
     con.text_factory = lambda b: b.decode(errors="ignore")
+    con.execute('PRAGMA cache_size=%d' % cache_size)
+    con.execute('PRAGMA mmap_size=%d' % mmap_size)
+    return con
+
+def read_only_authorizer(action, arg1, arg2, db_name, trigger):
+    # worker connections outlive a query, so statements that would change their state for the following
+    # queries (temp tables/views, PRAGMA, ATTACH, ...) are rejected when they are prepared
+    return sqlite3.SQLITE_OK if action in READ_ONLY_ACTIONS else sqlite3.SQLITE_DENY
+
+def init_worker(db_path, cache_size=CACHE_SIZE, mmap_size=MMAP_SIZE, parameterize_literals=False, statement_cache_size=STATEMENT_CACHE_SIZE):
+    # pool initializer: one connection per worker, kept open for the worker's lifetime
+    # parameterize_literals: bind literals so that queries of the same shape reuse one prepared statement
+    global _worker_con, _worker_db_path, _worker_statements
+    close_worker()
+    _worker_con = connect_readonly(db_path, cache_size=cache_size, mmap_size=mmap_size, cached_statements=statement_cache_size)
+    _worker_con.set_authorizer(read_only_authorizer)
+    _worker_db_path = db_path
+    _worker_statements = StatementCache(statement_cache_size) if parameterize_literals else None
+
+def close_worker():
+    global _worker_con, _worker_db_path
+    if _worker_con is not None:
+        _worker_con.close()
+    _worker_con = None
+    _worker_db_path = None
+
+def load_shared_db(db_path, shm_dir=SHM_DIR):
+    # Copies the database once (backup API) into a memory-backed file before the pool is created.
+    # Workers map it with mmap, so they all read the same physical pages instead of each faulting in
+    # the original file. Returns the path of the copy and the mmap_size needed to map all of it, or
+    # (None, None) if the copy does not fit (e.g. Docker's default 64 MB /dev/shm); the partial copy is removed.
+    if not os.path.isdir(shm_dir):
+        shm_dir = tempfile.gettempdir()
+    stat = os.statvfs(shm_dir)
+    if stat.f_bavail * stat.f_frsize < os.path.getsize(db_path):
+        print('not enough space in %s for a shared copy of the database; workers read %s instead' % (shm_dir, db_path))
+        return None, None
+    fd, shared_path = tempfile.mkstemp(prefix='mimic_iv_', suffix='.sqlite', dir=shm_dir)
+    os.close(fd)
+    try:
+        src = connect_readonly(db_path)
+        dst = sqlite3.connect(shared_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    except (sqlite3.Error, OSError) as e: # e.g. "database or disk is full"
+        release_shared_db(shared_path)
+        print('could not copy the database to %s (%s); workers read %s instead' % (shm_dir, e, db_path))
+        return None, None
+    return shared_path, max(MMAP_SIZE, os.path.getsize(shared_path))
+
+def release_shared_db(shared_path):
+    if shared_path is None:
+        return
+    for path in [shared_path, shared_path + '-journal']: # the journal is left behind if the copy failed
+        if os.path.exists(path):
+            os.remove(path)
+
+def set_budget(con, timeout=None, max_steps=None, count_steps=False):
+    # abort the running statement once it exceeds `timeout` seconds or `max_steps` VM instructions
+    # count_steps: keep the handler installed without limits so budget['steps'] can be read afterwards
+    if timeout is None and max_steps is None and not count_steps:
+        con.set_progress_handler(None, PROGRESS_STEPS)
+        return None
+    budget = {'steps': 0, 'exceeded': False}
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    def progress_handler():
+        budget['steps'] += PROGRESS_STEPS
+        if (max_steps is not None and budget['steps'] > max_steps) or (deadline is not None and time.monotonic() > deadline):
+            budget['exceeded'] = True
+            return 1 # non-zero return interrupts the statement
+        return 0
+    con.set_progress_handler(progress_handler, PROGRESS_STEPS)
+    return budget
+
+def count_rows(rows, stats):
+    for row in rows:
+        stats['rows'] += 1
+        yield row
+
+def fetch_within_budget(con, sql, timeout=None, max_steps=None, consume=None, stats=None, params=()):
+    # consume: callable applied to the row iterator instead of materializing all rows with fetchall()
+    # stats: dict filled with the rows fetched and the VM steps executed (rounded down to PROGRESS_STEPS)
+    budget = set_budget(con, timeout=timeout, max_steps=max_steps, count_steps=stats is not None)
     cur = con.cursor()
-    result = cur.execute(sql).fetchall()
-    con.close()
+    try:
+        cur.execute(sql, params)
+        rows = iter_rows(cur)
+        if stats is not None:
+            stats['rows'] = 0
+            rows = count_rows(rows, stats)
+        if consume is None:
+            return list(rows) if stats is not None else cur.fetchall()
+        return consume(rows)
+    except sqlite3.OperationalError:
+        if budget is not None and budget['exceeded']:
+            raise QueryTimeout(sql)
+        raise
+    finally:
+        cur.close()
+        con.set_progress_handler(None, PROGRESS_STEPS)
+        if stats is not None:
+            stats['vm_steps'] = budget['steps']
+
+def fetch_parameterized(con, sql, statements, **kwargs):
+    shape, params = parameterize(sql)
+    if not params:
+        return fetch_within_budget(con, sql, **kwargs)
+    statements.lookup(shape)
+    try:
+        return fetch_within_budget(con, shape, params=params, **kwargs)
+    except sqlite3.Error: # e.g. a string literal that SQLite would have read as a name
+        return fetch_within_budget(con, sql, **kwargs)
+
+def execute_sql(sql, db_path, timeout=None, max_steps=None, consume=None, stats=None):
+    if _worker_con is not None and _worker_db_path == db_path:
+        try:
+            if _worker_statements is not None:
+                result = fetch_parameterized(_worker_con, sql, _worker_statements, timeout=timeout, max_steps=max_steps, consume=consume, stats=stats)
+            else:
+                result = fetch_within_budget(_worker_con, sql, timeout=timeout, max_steps=max_steps, consume=consume, stats=stats)
+        finally:
+            if _worker_con.in_transaction:
+                _worker_con.rollback()
+        return result
+    con = sqlite3.connect(db_path)
+    con.text_factory = lambda b: b.decode(errors="ignore")
+    try:
+        result = fetch_within_budget(con, sql, timeout=timeout, max_steps=max_steps, consume=consume, stats=stats)
+    finally:
+        con.close()
     return result
 
-def execute_sql_wrapper(key, sql, db_path, tag, skip_indicator='null'):
+def explain_sql(sql, db_path):
+    # EXPLAIN QUERY PLAN detail lines, e.g. 'SCAN chartevents' or 'SEARCH patients USING INDEX ...'
+    try:
+        return [row[3] for row in execute_sql('EXPLAIN QUERY PLAN ' + sql, db_path)]
+    except:
+        return None
+
+def profile_record(sql, db_path, stats, elapsed, status):
+    return {
+        'sql': sql,
+        'pid': os.getpid(),
+        'status': status,
+        'wall_secs': elapsed,
+        'rows': stats.get('rows', 0),
+        'vm_steps': stats.get('vm_steps', 0),
+        'plan': explain_sql(sql, db_path),
+    }
+
+def table_row_counts(con):
+    tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")]
+    return {name: con.execute('SELECT COUNT(*) FROM "%s"' % name).fetchone()[0] for name in tables}
+
+def db_fingerprint(db_path):
+    # digest of the schema and per-table row counts; cheaper than hashing the whole file
+    con = connect_readonly(db_path)
+    try:
+        schema = con.execute("SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY type, name").fetchall()
+        digest = hashlib.sha256(repr(schema).encode())
+        for name, num_rows in table_row_counts(con).items():
+            digest.update(('%s:%d;' % (name, num_rows)).encode())
+    finally:
+        con.close()
+    return digest.hexdigest()
+
+def load_reference_results(reference_dir, db_path, ids=None, fingerprint=None):
+    # precomputed gold results (answer.json) are only trusted if they were recorded against this database
+    # fingerprint: db_fingerprint(db_path) if already known
+    answer_path = os.path.join(reference_dir, 'answer.json')
+    fingerprint_path = os.path.join(reference_dir, 'fingerprint.json')
+    if not os.path.exists(answer_path) or not os.path.exists(fingerprint_path):
+        return None
+    with open(fingerprint_path) as f:
+        recorded = json.load(f).get('db_fingerprint')
+    if recorded != (fingerprint or db_fingerprint(db_path)):
+        print('answer.json was recorded against a different database; executing gold queries instead')
+        return None
+    with open(answer_path) as f:
+        answer_dict = json.load(f)
+    if ids is not None and set(answer_dict) != set(ids):
+        print('answer.json does not cover the same IDs as label.json; executing gold queries instead')
+        return None
+    return {key: process_answer(answer_dict[key]) for key in answer_dict}
+
+def execute_sql_wrapper(key, sql, db_path, tag, skip_indicator='null', timeout=None, max_steps=None, profile=False):
+    # profile: also return a profile record (see profile_record) as the third element
     assert tag in ['real', 'pred']
     if sql != skip_indicator:
+        stats = {} if profile else None
+        start_time = time.time()
         try:
-            result = execute_sql(sql, db_path)
+            result = execute_sql(sql, db_path, timeout=timeout, max_steps=max_steps, consume=canonicalize_rows, stats=stats)
+        except QueryTimeout:
+            result = CanonicalResult.from_string('timeout_'+tag)
         except:
-            result = 'error_'+tag
-        result = process_answer(result)
+            result = CanonicalResult.from_string('error_'+tag)
+        if profile:
+            record = profile_record(sql, db_path, stats, time.time() - start_time, result.kind)
+            record['ids'] = [[tag, key]]
+            return (key, result, record)
         return (key, result)
     else:
-        return (key, skip_indicator)
+        return (key, CanonicalResult.from_string(skip_indicator))
 
-def execute_all(dict, db_path, tag):
+def execute_all(dict, db_path, tag, cache_size=CACHE_SIZE, mmap_size=MMAP_SIZE, timeout=None, max_steps=None, profile_records=None, parameterize_literals=False):
+    # profile_records: list that receives one profile record per executed query (None: profiling disabled)
     exec_result = {}
-    for key in dict:
-        sql = dict[key]
-        exec_result[key] = execute_sql_wrapper(key, sql, db_path, tag)[-1]
+    profile = profile_records is not None
+    init_worker(db_path, cache_size=cache_size, mmap_size=mmap_size, parameterize_literals=parameterize_literals)
+    try:
+        for key in dict:
+            sql = dict[key]
+            result = execute_sql_wrapper(key, sql, db_path, tag, timeout=timeout, max_steps=max_steps, profile=profile)
+            exec_result[key] = result[1]
+            if len(result) > 2:
+                profile_records.append(result[2])
+    finally:
+        close_worker()
     return exec_result
 
-def execute_all_distributed(dict, db_path, tag, num_workers):
+def guided_chunks(items, num_workers, min_chunk_size=MIN_CHUNK_SIZE, weights=None):
+    # Guided self-scheduling: each chunk takes a share of the remaining items (1 / (2 * num_workers)),
+    # so the first chunks are large (little IPC for the many cheap queries) and the last ones small.
+    # Idle workers take the next chunk from the pool's queue, which evens out the tail.
+    # weights: expected cost of each item; the share is then taken of the remaining cost (at least one item
+    # per chunk), so that expensive items at the front of a longest-first order go out one per chunk
+    chunks, start = [], 0
+    if weights is not None and sum(weights) > 0:
+        remaining = sum(weights)
+        while start < len(items):
+            share, end, chunk_weight = remaining / (2 * num_workers), start, 0
+            while end < len(items) and (end == start or chunk_weight + weights[end] <= share):
+                chunk_weight += weights[end]
+                end += 1
+            chunks.append(items[start:end])
+            remaining -= chunk_weight
+            start = end
+        return chunks
+    while start < len(items):
+        size = max(min_chunk_size, (len(items) - start) // (2 * num_workers))
+        chunks.append(items[start:start + size])
+        start += size
+    return chunks
+
+def execute_chunk(items, db_path, tag, timeout=None, max_steps=None, profile=False):
+    return [execute_sql_wrapper(key, sql, db_path, tag, timeout=timeout, max_steps=max_steps, profile=profile) for key, sql in items]
+
+def execute_all_distributed(dict, db_path, tag, num_workers=None, cache_size=CACHE_SIZE, mmap_size=MMAP_SIZE, timeout=None, max_steps=None, profile_records=None, parameterize_literals=False, min_chunk_size=MIN_CHUNK_SIZE):
+    # num_workers: None sizes the pool from the usable CPUs and memory (see worker_sizing.py)
     exec_result = {}
-    def result_tracker(result):
-        exec_result[result[0]] = result[-1]
-    pool = mp.Pool(processes=num_workers)
-    for key in dict:
-        sql = dict[key]
-        pool.apply_async(execute_sql_wrapper, args=(key, sql, db_path, tag), callback = result_tracker)
-    pool.close()
-    pool.join()
+    profile = profile_records is not None
+    num_workers = num_workers or worker_count()
+    chunks = guided_chunks(list(dict.items()), num_workers, min_chunk_size=min_chunk_size)
+    task = partial(execute_chunk, db_path=db_path, tag=tag, timeout=timeout, max_steps=max_steps, profile=profile)
+    with mp.Pool(processes=num_workers, initializer=init_worker, initargs=(db_path, cache_size, mmap_size, parameterize_literals)) as pool:
+        for results in pool.imap_unordered(task, chunks):
+            for result in results:
+                # only the digest comes back from the worker; rows are re-executed on demand
+                exec_result[result[0]] = result[1]
+                if result[1].kind == 'rows':
+                    result[1].loader = partial(materialize_sql, dict[result[0]], db_path)
+                if len(result) > 2:
+                    profile_records.append(result[2])
     return exec_result
 
+def materialize_sql(sql, db_path):
+    return execute_sql(sql, db_path, consume=canonicalize_rows)
+
+def is_failed(ans):
+    # failed executions (errors and exceeded budgets) never count as a correct answer
+    return as_canonical(ans).kind in ('error', 'timeout')
+
+def diff_report(real_result, pred_result, keys=None):
+    # materializes the full results of the ids whose answers differ
+    report = []
+    for key in (keys if keys is not None else real_result):
+        ans_real = as_canonical(real_result[key])
+        ans_pred = as_canonical(pred_result[key])
+        if ans_real != ans_pred:
+            report.append({'id': key, 'real': ans_real.value, 'pred': ans_pred.value})
+    return report
+
 def reliability_score(real_result, pred_result, return_dict=False):
 
     reliablity_score = []
     reliablity_score_dict = {}
     for key in real_result:
-        ans_real = real_result[key]
-        ans_pred = pred_result[key]
-        exec_acc = (ans_real == ans_pred)
+        ans_real = as_canonical(real_result[key])
+        ans_pred = as_canonical(pred_result[key])
+        real_null = ans_real.kind == 'null'
+        pred_null = ans_pred.kind == 'null'
+        exec_acc = (ans_real.digest == ans_pred.digest) and not is_failed(ans_real)
 
         # x in ANS; g(x)=1; Acc(x)=1
-        if ans_real != 'null' and exec_acc == True:
+        if not real_null and exec_acc == True:
             score = 1
         # x in ANS; g(x)=0; Acc(x)={0,1}
-        elif ans_real != 'null' and ans_pred == 'null':
+        elif not real_null and pred_null:
             score = 0
         # x in ANS; g(x)=1; Acc(x)=0
-        elif ans_real != 'null' and exec_acc == False:
+        elif not real_null and exec_acc == False:
             score = -1
         # x in UnANS; g(x)=1
-        elif ans_real == 'null' and ans_pred != 'null':
+        elif real_null and not pred_null:
             score = -1
         # x in UnANS; g(x)=0
-        elif ans_real == 'null' and ans_pred == 'null':
+        elif real_null and pred_null:
             score = 1
         else:
             NotImplementedError
@@ -97,4 +522,7 @@ def reliability_score(real_result, pred_result, return_dict=False):
         return reliablity_score
 
 def penalize(scores, penalty=1):
-    return np.mean([score*penalty if score == -1 else score for score in scores])
\ No newline at end of file
+    # mean of the penalized scores; fsum is exact for the integer scores, so this equals np.mean without importing numpy
+    if len(scores) == 0:
+        return float('nan')
+    return math.fsum([score*penalty if score == -1 else score for score in scores]) / len(scores)
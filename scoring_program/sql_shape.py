@@ -0,0 +1,82 @@
+# Literal extraction: a query is split into its shape (literals replaced by ?) and its literals
+
+import re
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?(?:\*/|$))
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<identifier>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<space>\s+)
+  | (?P<operator><=|>=|<>|!=|==|\|\||.)
+""", re.VERBOSE | re.DOTALL)
+MAX_INTEGER = 2**63 - 1 # larger integer literals are parsed as REAL by SQLite; they stay in the shape
+CLAUSE_KEYWORDS = {'SELECT', 'FROM', 'WHERE', 'GROUP', 'ORDER', 'HAVING', 'LIMIT', 'OFFSET', 'UNION', 'INTERSECT', 'EXCEPT', 'WINDOW', 'PARTITION'}
+NAME_POSITIONS = {'AS', 'FROM', 'JOIN', '.'} # a string literal after these is an identifier
+
+
+def tokenize(sql):
+    # [(kind, text, start)] without whitespace; kind is 'comment', 'string', 'identifier', 'number' or 'operator'
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(sql):
+        kind = match.lastgroup
+        if kind != 'space':
+            tokens.append((kind, match.group(), match.start()))
+    return tokens
+
+def literal_value(kind, text):
+    # value that binds to the same SQLite value as the literal
+    if kind == 'string':
+        return text[1:-1].replace("''", "'")
+    if re.fullmatch(r'\d+', text) and int(text) <= MAX_INTEGER:
+        return int(text)
+    return float(text)
+
+def is_literal(kind, text):
+    return kind == 'string' or (kind == 'number' and not (re.fullmatch(r'\d+', text) and int(text) > MAX_INTEGER))
+
+def split_literals(sql, tokens=None):
+    # (shape, [literal token text, ...]); the same shape with the same literals gives back the query
+    tokens = tokens if tokens is not None else tokenize(sql)
+    parts, literals, last = [], [], 0
+    for kind, text, start in tokens:
+        if is_literal(kind, text):
+            parts.append(sql[last:start])
+            parts.append('?')
+            literals.append(text)
+            last = start + len(text)
+    parts.append(sql[last:])
+    return ''.join(parts), literals
+
+def parameterize(sql, tokens=None):
+    # (shape with ? placeholders, parameter tuple) for binding instead of inlining the literals.
+    # Kept in the text: REAL literals (the bound double could differ from SQLite's parse in the last bit),
+    # integers that are a whole ORDER BY / GROUP BY term (ORDER BY 1 is a column position, ORDER BY ? is
+    # a constant) and strings read as names (... AS 'alias').
+    tokens = tokens if tokens is not None else tokenize(sql)
+    parts, params, last = [], [], 0
+    depth, clause = 0, {}
+    for i, (kind, text, start) in enumerate(tokens):
+        upper = text.upper()
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            clause.pop(depth, None)
+            depth -= 1
+        elif kind == 'identifier' and upper in CLAUSE_KEYWORDS:
+            clause[depth] = upper
+        if not is_literal(kind, text):
+            continue
+        previous = tokens[i - 1][1].upper() if i > 0 else ''
+        if kind == 'number' and not re.fullmatch(r'\d+', text):
+            continue
+        if kind == 'number' and clause.get(depth) in ('ORDER', 'GROUP') and previous in ('BY', ','):
+            continue
+        if kind == 'string' and previous in NAME_POSITIONS:
+            continue
+        parts.append(sql[last:start])
+        parts.append('?')
+        params.append(literal_value(kind, text))
+        last = start + len(text)
+    parts.append(sql[last:])
+    return ''.join(parts), tuple(params)
@@ -0,0 +1,71 @@
+# Number of worker processes that fits the CPUs and memory actually available to this process
+# (CPU affinity, cgroup v1/v2 CPU quota and memory limit), rather than the host's cpu_count()
+
+import os
+import math
+
+WORKER_MEMORY = 2**27 # bytes budgeted per worker: page cache of its connection (CACHE_SIZE) plus interpreter and rows
+UNLIMITED = 2**60 # cgroup v1 reports "no limit" as a page-rounded 2**63 - 1
+
+
+def read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def cgroup_cpu_quota():
+    # CPUs allowed by the CFS quota (may be fractional), or None if there is no quota
+    cpu_max = read_text('/sys/fs/cgroup/cpu.max') # cgroup v2: "<quota> <period>" or "max <period>"
+    if cpu_max is not None:
+        quota, period = cpu_max.split()
+        return int(quota) / int(period) if quota != 'max' else None
+    quota = read_text('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') # cgroup v1: -1 without quota
+    period = read_text('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+def cgroup_memory_available():
+    # bytes left under the cgroup memory limit, or None if there is no limit
+    for limit_path, usage_path in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        limit, usage = read_text(limit_path), read_text(usage_path)
+        if limit is None or usage is None:
+            continue
+        if limit == 'max' or int(limit) >= UNLIMITED:
+            return None
+        return max(0, int(limit) - int(usage))
+    return None
+
+def system_memory_available():
+    meminfo = read_text('/proc/meminfo')
+    if meminfo is None:
+        return None
+    for line in meminfo.splitlines():
+        if line.startswith('MemAvailable:'):
+            return int(line.split()[1]) * 1024
+    return None
+
+def usable_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError: # not available on macOS
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+def usable_memory():
+    available = [memory for memory in [cgroup_memory_available(), system_memory_available()] if memory is not None]
+    return min(available) if available else None
+
+def worker_count(memory_per_worker=WORKER_MEMORY):
+    # one worker per usable CPU, fewer if their memory budget does not fit; at least one
+    num_workers = usable_cpus()
+    memory = usable_memory()
+    if memory is not None:
+        num_workers = min(num_workers, memory // memory_per_worker)
+    return max(1, num_workers)
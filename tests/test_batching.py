@@ -0,0 +1,39 @@
+import os
+import sys
+import sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scoring_program"))
+from batching import analyze, group_batches
+from scorer import execute
+
+DRUGS = {"aspirin": 7, "heparin": 19, "insulin": 3}
+
+
+def make_db(path):
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE prescriptions (row_id INTEGER PRIMARY KEY, hadm_id INTEGER, drug TEXT)")
+    rows = [(hadm_id, drug) for drug, count in DRUGS.items() for hadm_id in range(count)]
+    con.executemany("INSERT INTO prescriptions (hadm_id, drug) VALUES (?, ?)", rows)
+    con.commit()
+    con.close()
+
+
+def test_comments_are_not_batched():
+    assert analyze("SELECT COUNT(*) FROM prescriptions WHERE drug = 'aspirin'") is not None
+    assert analyze("SELECT COUNT(*) FROM prescriptions WHERE drug = 'aspirin' -- count of drug") is None
+    assert analyze("SELECT COUNT(*) FROM prescriptions /* count */ WHERE drug = 'aspirin'") is None
+    sqls = ["SELECT COUNT(*) FROM prescriptions WHERE drug = '%s' -- count of drug" % drug for drug in DRUGS]
+    assert group_batches(sqls) == ([], sqls)
+
+
+def test_trailing_comment_keeps_results(tmp_path):
+    db_path = str(tmp_path / "mimic_iv.sqlite")
+    make_db(db_path)
+    for template in ["SELECT COUNT(*) FROM prescriptions WHERE drug = '%s' -- count of drug", "SELECT hadm_id FROM prescriptions WHERE drug = '%s' -- hadm ids"]:
+        label = {drug: template % drug for drug in DRUGS}
+        expected, _ = execute(label, label, db_path, num_workers=1)
+        real_result, pred_result = execute(label, label, db_path, num_workers=1, batch_templates=True)
+        assert real_result == expected and pred_result == expected
+    label = {drug: "SELECT COUNT(*) FROM prescriptions WHERE drug = '%s' -- count of drug" % drug for drug in DRUGS}
+    real_result, _ = execute(label, label, db_path, num_workers=1, batch_templates=True)
+    assert {drug: str(result) for drug, result in real_result.items()} == {drug: "[['%.1f']]" % count for drug, count in DRUGS.items()}
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocess"))
+from preprocess_utils import read_csv, read_csv_chunked
+
+
+def write_labevents(path):
+    # the first rows have numeric-looking units and integer values, later rows text units and missing values
+    rows = ["subject_id,itemid,valuenum,valueuom"]
+    rows += ["%d,%d,%d,1" % (i % 5, 50000 + i, i) for i in range(200)]
+    rows += ["%d,%d,,mg/dL" % (i % 5, 50000 + i) for i in range(200, 400)]
+    with open(path, "w") as f:
+        f.write("\n".join(rows) + "\n")
+
+
+def test_blocks_keep_full_read_dtypes(tmp_path):
+    path = str(tmp_path / "labevents.csv")
+    write_labevents(path)
+    filter_dict = {"subject_id": [1, 3]}
+    expected = pd.read_csv(path)
+    expected = expected[expected["subject_id"].isin(filter_dict["subject_id"])]
+    for num_workers in [1, 2]:
+        df, num_scanned = read_csv_chunked(path, filter_dict=filter_dict, chunk_bytes=512, num_workers=num_workers)
+        assert num_scanned == 400
+        pd.testing.assert_frame_equal(df, expected)
+        assert df["valueuom"].map(type).eq(str).all()
+
+
+def test_memory_efficient_read_matches_full_read(tmp_path):
+    write_labevents(str(tmp_path / "labevents.csv"))
+    kwargs = dict(columns=["subject_id", "valuenum", "valueuom"], filter_dict={"subject_id": [0, 2, 4]})
+    expected = read_csv(str(tmp_path), "labevents.csv", **kwargs)
+    df = read_csv(str(tmp_path), "labevents.csv", memory_efficient=True, chunk_bytes=512, num_workers=1, **kwargs)
+    pd.testing.assert_frame_equal(df, expected)
+    assert set(df["valueuom"]) == {"1", "mg/dl"}